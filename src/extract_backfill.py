@@ -0,0 +1,284 @@
+import json
+import logging
+import math
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pg8000.native import identifier
+
+try:
+    from src.runtime_context import context as runtime
+    from src.extract_database import (
+        DEFAULT_WATERMARK,
+        EXTRACT_WORKERS,
+        INTEGER_TYPES,
+        ConnectionPool,
+        build_upper_bound_query,
+        describe_tables,
+        incremental_conditions,
+    )
+    from src.extract_storage import (
+        EXTRACT_COMPRESSION,
+        EXTRACT_FORMAT,
+        extract_bucket,
+        extract_extension,
+        upload_rows,
+        write_watermark,
+    )
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+    from extract_database import (
+        DEFAULT_WATERMARK,
+        EXTRACT_WORKERS,
+        INTEGER_TYPES,
+        ConnectionPool,
+        build_upper_bound_query,
+        describe_tables,
+        incremental_conditions,
+    )
+    from extract_storage import (
+        EXTRACT_COMPRESSION,
+        EXTRACT_FORMAT,
+        extract_bucket,
+        extract_extension,
+        upload_rows,
+        write_watermark,
+    )
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_PREFIX = "_control/backfill"
+BACKFILL_SHARD_ROWS = int(os.environ.get("BACKFILL_SHARD_ROWS", "100000"))
+
+
+def plan_backfill(db, catalog, tables=None, shard_rows=BACKFILL_SHARD_ROWS):
+    """Plans a backfill of tables, or of every table with a last_updated
+    column. Each table is split into shards of about shard_rows rows, using
+    the planner's row estimate from pg_class.reltuples, so no table is
+    counted. Tables with a single integer primary key are split into equal
+    primary key ranges between its minimum and maximum; any other table is
+    one shard. Every shard is bounded by the (last_updated, primary key) of
+    the table's latest row when the plan is made, which becomes its
+    watermark, so the incremental extract carries on from exactly there.
+    Returns the plan, with a JSON serialisable list of shards
+    """
+    estimates = dict(
+        db.run(
+            """
+            SELECT c.relname, greatest(c.reltuples, 0)::bigint FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND c.relkind = 'r';
+            """
+        )
+    )
+    plan = {"plan_id": uuid.uuid4().hex, "tables": {}, "shards": []}
+    for table_name, table in catalog.items():
+        if tables is not None and table_name not in tables:
+            continue
+        columns = dict(table["columns"])
+        if "last_updated" not in columns:
+            logger.warning(f"{table_name} has no last_updated column, skipping")
+            continue
+        primary_key = table["primary_key"]
+        query, params = build_upper_bound_query(
+            table_name, primary_key, (DEFAULT_WATERMARK, None)
+        )
+        latest_row = db.run(query, **params)
+        if not latest_row:
+            continue
+        upper = [
+            latest_row[0][0].isoformat(),
+            latest_row[0][1] if primary_key else None,
+        ]
+
+        ranges = [(None, None)]
+        if primary_key and columns[primary_key] in INTEGER_TYPES:
+            shard_count = max(1, math.ceil(estimates.get(table_name, 0) / shard_rows))
+            [[lowest, highest]] = db.run(
+                f"SELECT min({identifier(primary_key)}), max({identifier(primary_key)})"
+                f" FROM {identifier(table_name)};"
+            )
+            width = math.ceil((highest - lowest + 1) / shard_count)
+            ranges = [
+                (start, min(start + width, highest + 1))
+                for start in range(lowest, highest + 1, width)
+            ]
+
+        plan["tables"][table_name] = {"upper": upper, "shards": len(ranges)}
+        for shard, (lower, upper_key) in enumerate(ranges, start=1):
+            plan["shards"].append(
+                {
+                    "plan_id": plan["plan_id"],
+                    "table": table_name,
+                    "shard": shard,
+                    "primary_key": primary_key,
+                    "lower": lower,
+                    "upper_key": upper_key,
+                    "upper": upper,
+                }
+            )
+    logger.info(
+        f"Planned {len(plan['shards'])} backfill shards for {', '.join(plan['tables'])}"
+    )
+    return plan
+
+
+def build_shard_query(shard):
+    """Builds the query selecting the rows of one backfill shard: its primary
+    key range, up to the upper bound of the plan. Returns the query and its
+    parameters
+    """
+    primary_key = shard["primary_key"]
+    upper = (datetime.fromisoformat(shard["upper"][0]), shard["upper"][1])
+    conditions, params, _ = incremental_conditions(
+        primary_key, (DEFAULT_WATERMARK, None), upper
+    )
+    if shard["lower"] is not None:
+        conditions.append(f"{identifier(primary_key)} >= :lower")
+        conditions.append(f"{identifier(primary_key)} < :upper_key")
+        params["lower"], params["upper_key"] = shard["lower"], shard["upper_key"]
+    order = identifier(primary_key) if primary_key else "last_updated"
+    return (
+        f"""
+        SELECT * FROM {identifier(shard['table'])}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {order};
+        """,
+        params,
+    )
+
+
+def start_backfill(plan, bucket_name=None, client=None):
+    """Saves the plan and moves each planned table's watermark to the plan's
+    upper bound, so scheduled extracts only pick up rows changed after it
+    while the shards run
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+    client.put_object(
+        Bucket=bucket_name,
+        Key=f"{BACKFILL_PREFIX}/plan.json",
+        Body=json.dumps(plan).encode("utf-8"),
+        ContentType="application/json",
+    )
+    for table_name, table in plan["tables"].items():
+        last_updated, pk = table["upper"]
+        write_watermark(
+            table_name,
+            (datetime.fromisoformat(last_updated), pk),
+            bucket_name,
+            client,
+        )
+
+
+def read_backfill_plan(bucket_name=None, client=None):
+    """Returns the last backfill plan saved by start_backfill"""
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+    file_obj = client.get_object(Bucket=bucket_name, Key=f"{BACKFILL_PREFIX}/plan.json")
+    return json.loads(file_obj["Body"].read())
+
+
+def _shard_marker(shard):
+    return (
+        f"{BACKFILL_PREFIX}/{shard['plan_id']}/{shard['table']}_{shard['shard']:04d}.done"
+    )
+
+
+def completed_shards(plan, bucket_name, client):
+    """Returns the marker keys of the shards of plan that have finished"""
+    paginator = client.get_paginator("list_objects_v2")
+    return {
+        obj["Key"]
+        for page in paginator.paginate(
+            Bucket=bucket_name, Prefix=f"{BACKFILL_PREFIX}/{plan['plan_id']}/"
+        )
+        for obj in page.get("Contents", [])
+    }
+
+
+def run_backfill_shard(
+    db,
+    shard,
+    bucket_name=None,
+    client=None,
+    file_format=EXTRACT_FORMAT,
+    compression=EXTRACT_COMPRESSION,
+):
+    """Extracts one backfill shard to its own part of the table's extract
+    output, then writes a marker object recording that it has finished, so
+    a resumed backfill skips it. Raises if the upload failed
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+
+    table_name = shard["table"]
+    query, params = build_shard_query(shard)
+    rows = db.run(query, **params)
+    if rows:
+        column_names = [column["name"] for column in db.columns]
+        s3_key = datetime.strftime(
+            datetime.today(),
+            f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S_backfill{shard['shard']:04d}."
+            + extract_extension(file_format, compression),
+        )
+        column_types = dict(describe_tables(db).get(table_name, {}).get("columns", []))
+        if not upload_rows(
+            rows, column_names, s3_key, bucket_name, client, file_format, column_types
+        ):
+            raise RuntimeError(f"Failed to upload backfill shard {s3_key}")
+    client.put_object(Bucket=bucket_name, Key=_shard_marker(shard), Body=b"")
+    logger.info(f"Backfilled {len(rows)} rows of {table_name} shard {shard['shard']}")
+    return len(rows)
+
+
+def dispatch_backfill(
+    db, plan, context=None, bucket_name=None, client=None, workers=EXTRACT_WORKERS
+):
+    """Runs the shards of plan that have not finished yet. In AWS each shard
+    is sent to its own asynchronous invocation of this lambda; anywhere else
+    they are run on a thread pool of workers connections. Returns the number
+    of shards started
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+    done = completed_shards(plan, bucket_name, client)
+    shards = [shard for shard in plan["shards"] if _shard_marker(shard) not in done]
+
+    function_arn = getattr(context, "invoked_function_arn", None)
+    if function_arn is not None:
+        for shard in shards:
+            runtime.client("lambda").invoke(
+                FunctionName=function_arn,
+                InvocationType="Event",
+                Payload=json.dumps({"backfill_shard": shard}).encode("utf-8"),
+            )
+        return len(shards)
+
+    if workers <= 1:
+        for shard in shards:
+            run_backfill_shard(db, shard, bucket_name, client)
+        return len(shards)
+
+    pool = ConnectionPool(workers)
+
+    def pooled_shard(shard):
+        with pool.connection() as shard_db:
+            return run_backfill_shard(shard_db, shard, bucket_name, client)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(pooled_shard, shards))
+    finally:
+        pool.close()
+    return len(shards)
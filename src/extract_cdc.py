@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, time as time_of_day
+from decimal import Decimal
+
+try:
+    from src.runtime_context import context as runtime
+    from src.extract_database import describe_tables
+    from src.extract_deletes import upload_deletes
+    from src.extract_storage import (
+        EXTRACT_FORMAT,
+        EXTRACT_FORMAT_EXTENSIONS,
+        extract_bucket,
+        extract_extension,
+        upload_rows,
+        write_watermark,
+    )
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+    from extract_database import describe_tables
+    from extract_deletes import upload_deletes
+    from extract_storage import (
+        EXTRACT_FORMAT,
+        EXTRACT_FORMAT_EXTENSIONS,
+        extract_bucket,
+        extract_extension,
+        upload_rows,
+        write_watermark,
+    )
+
+logger = logging.getLogger(__name__)
+
+CDC_SLOT_NAME = os.environ.get("CDC_SLOT_NAME", "bentley_extract")
+CDC_BATCH_SIZE = int(os.environ.get("CDC_BATCH_SIZE", "10000"))
+
+
+def ensure_replication_slot(db, slot_name=CDC_SLOT_NAME):
+    """Creates the wal2json logical replication slot slot_name if it does not
+    exist yet. The database needs wal_level = logical and the wal2json plugin,
+    and changes are only retained from the moment the slot is created, so a
+    new slot should be paired with a polled extract to catch up first
+    """
+    rows = db.run(
+        "SELECT 1 FROM pg_replication_slots WHERE slot_name = :slot_name;",
+        slot_name=slot_name,
+    )
+    if not rows:
+        db.run(
+            "SELECT pg_create_logical_replication_slot(:slot_name, 'wal2json');",
+            slot_name=slot_name,
+        )
+        logger.info(f"Created replication slot {slot_name}")
+
+
+def read_replication_changes(db, slot_name=CDC_SLOT_NAME, batch_size=CDC_BATCH_SIZE):
+    """Returns up to batch_size decoded changes from the replication slot as
+    (lsn, wal2json record) rows, without consuming them. Decoding stops at a
+    transaction boundary, so a batch can run over batch_size to finish one
+    """
+    return db.run(
+        """
+        SELECT lsn::text, data FROM pg_logical_slot_peek_changes(
+        :slot_name, NULL, :batch_size,
+        'format-version', '2', 'include-types', 'false');
+        """,
+        slot_name=slot_name,
+        batch_size=batch_size,
+    )
+
+
+def advance_replication_slot(db, lsn, slot_name=CDC_SLOT_NAME):
+    """Consumes every change in the replication slot up to and including lsn"""
+    db.run(
+        "SELECT pg_replication_slot_advance(:slot_name, CAST(:lsn AS pg_lsn));",
+        slot_name=slot_name,
+        lsn=lsn,
+    )
+
+
+def parse_replicated_value(value, data_type):
+    """Converts a wal2json column value to the Python type pg8000 would have
+    returned for data_type, so change files match polled extracts
+    """
+    if value is None:
+        return None
+    if data_type.startswith("timestamp"):
+        return datetime.fromisoformat(value)
+    if data_type == "date":
+        return date.fromisoformat(value)
+    if data_type.startswith("time"):
+        return time_of_day.fromisoformat(value)
+    return value
+
+
+def decode_changes(rows, catalog):
+    """Batches wal2json format-version 2 records into a dictionary of table
+    name to {"upserts": [...], "deletes": [...]}, each a list of column name to
+    value dictionaries. Changes to the same primary key are collapsed to the
+    last one, so a row inserted and then deleted in one batch is only
+    deleted. Tables outside the catalog are ignored. Also returns the lsn
+    of the last complete transaction, or None if there was none
+    """
+    changes = {}
+    last_commit = None
+    for lsn, data in rows:
+        record = json.loads(data, parse_float=Decimal)
+        action = record["action"]
+        if action == "C":
+            last_commit = lsn
+            continue
+        if action not in ("I", "U", "D") or record["table"] not in catalog:
+            continue
+
+        table = catalog[record["table"]]
+        column_types = dict(table["columns"])
+        values = {
+            column["name"]: parse_replicated_value(
+                column["value"], column_types.get(column["name"], "")
+            )
+            for column in record["columns" if action != "D" else "identity"]
+        }
+        table_changes = changes.setdefault(record["table"], {})
+        key = values.get(table["primary_key"]) if table["primary_key"] else None
+        # rows without a primary key cannot be matched up, so are all kept
+        if key is None:
+            key = (lsn, len(table_changes))
+        table_changes.pop(key, None)
+        table_changes[key] = (action, values)
+
+    batched = {}
+    for table_name, table_changes in changes.items():
+        batched[table_name] = {"upserts": [], "deletes": []}
+        for action, values in table_changes.values():
+            batched[table_name]["deletes" if action == "D" else "upserts"].append(
+                values
+            )
+    return batched, last_commit
+
+
+def lsn_suffix(lsn):
+    """Returns an lsn such as "16/B374D848" as 16 zero padded hex digits, so
+    it can go in an object key and keys sort in lsn order
+    """
+    high, low = lsn.split("/")
+    return f"{int(high, 16):08X}{int(low, 16):08X}"
+
+
+def upload_changes(
+    table_name, table_changes, table, bucket_name, client, file_format, lsn=None
+):
+    """Uploads a table's batched changes to the extract bucket. Inserts and
+    updates are written in the same layout as a polled extract, and deletes
+    as the primary keys of the deleted rows under DELETES_PREFIX. The keys
+    carry lsn, the commit lsn of the batch, as several batches can be
+    uploaded within the same second. Returns False if an upload failed
+    """
+    extension = extract_extension(file_format)
+    column_types = dict(table["columns"])
+    batch = f"_{lsn_suffix(lsn)}" if lsn else ""
+    if table_changes["upserts"]:
+        column_names = [column for column, _ in table["columns"]]
+        s3_key = datetime.strftime(
+            datetime.today(),
+            f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S_changes{batch}.{extension}",
+        )
+        rows = [
+            [values.get(column) for column in column_names]
+            for values in table_changes["upserts"]
+        ]
+        if not upload_rows(
+            rows, column_names, s3_key, bucket_name, client, file_format, column_types
+        ):
+            return False
+    if table_changes["deletes"]:
+        primary_key = table["primary_key"]
+        keys = [
+            values.get(primary_key) if primary_key else json.dumps(values, default=str)
+            for values in table_changes["deletes"]
+        ]
+        return upload_deletes(
+            table_name,
+            primary_key or "identity",
+            column_types.get(primary_key, "text"),
+            keys,
+            bucket_name,
+            client,
+            file_format,
+            batch=batch,
+        )
+    return True
+
+
+def _replicated_watermark(table_changes, primary_key, watermark):
+    """Returns the later of watermark and the (last_updated, primary key) of
+    the newest upserted row, so polling can take over from the slot"""
+    for values in table_changes["upserts"]:
+        if values.get("last_updated") is None:
+            continue
+        candidate = (values["last_updated"], values.get(primary_key))
+        if watermark is None:
+            watermark = candidate
+        elif primary_key is None:
+            # the watermark holds boundary row hashes rather than a key
+            if candidate[0] > watermark[0]:
+                watermark = candidate
+        elif (candidate[0], candidate[1] or 0) > (watermark[0], watermark[1] or 0):
+            watermark = candidate
+    return watermark
+
+
+def process_replication_changes(
+    db,
+    watermarks,
+    client=None,
+    bucket_name=None,
+    slot_name=CDC_SLOT_NAME,
+    batch_size=CDC_BATCH_SIZE,
+    file_format=EXTRACT_FORMAT,
+    out_of_time=None,
+):
+    """Change data capture alternative to process_and_upload_tables. Reads
+    inserts, updates and deletes from the logical replication slot in batches
+    of batch_size changes, uploads them as per table change files, and only
+    then advances the slot, so a failed upload is retried by the next run.
+    The cost scales with the number of changes rather than the size of the
+    tables. Watermarks are kept up to date too, so the extract can switch
+    back to polling at any time. Returns the same status dictionary as
+    process_and_upload_tables, with the deleted tables under "deleted"
+    """
+    if file_format not in EXTRACT_FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown extract format: {file_format}")
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+
+    load_status = {
+        "updated": [],
+        "no change": [],
+        "deleted": [],
+        "timings": {},
+        "remaining": [],
+    }
+    catalog = describe_tables(db)
+    ensure_replication_slot(db, slot_name)
+    start = time.perf_counter()
+    while True:
+        rows = read_replication_changes(db, slot_name, batch_size)
+        changes, last_commit = decode_changes(rows, catalog)
+        if last_commit is None:
+            break
+
+        for table_name, table_changes in changes.items():
+            if not upload_changes(
+                table_name,
+                table_changes,
+                catalog[table_name],
+                bucket_name,
+                client,
+                file_format,
+                lsn=last_commit,
+            ):
+                raise RuntimeError(f"Failed to upload changes for {table_name}")
+            if table_changes["upserts"] and table_name not in load_status["updated"]:
+                load_status["updated"].append(table_name)
+            if table_changes["deletes"] and table_name not in load_status["deleted"]:
+                load_status["deleted"].append(table_name)
+            watermark = watermarks.get(table_name)
+            new_watermark = _replicated_watermark(
+                table_changes, catalog[table_name]["primary_key"], watermark
+            )
+            if new_watermark != watermark:
+                write_watermark(table_name, new_watermark, bucket_name, client)
+                watermarks[table_name] = new_watermark
+        advance_replication_slot(db, last_commit, slot_name)
+        logger.info(f"Replication slot {slot_name} advanced to {last_commit}")
+
+        if len(rows) < batch_size or (out_of_time is not None and out_of_time()):
+            break
+
+    seconds = round(time.perf_counter() - start, 3)
+    for table_name in catalog:
+        if table_name in load_status["updated"] or table_name in load_status["deleted"]:
+            load_status["timings"][table_name] = seconds
+        else:
+            load_status["no change"].append(table_name)
+    return load_status
@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from pg8000.native import Connection, InterfaceError, identifier, literal
+
+try:
+    from src.runtime_context import context as runtime
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WATERMARK = datetime(1990, 1, 1)
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "1"))
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+
+# column and primary key metadata from describe_tables, kept across warm invocations
+_catalog = {}
+
+
+class DBConnectionException(Exception):
+    """Wraps pg8000.native Error or DatabaseError."""
+
+    def __init__(self, e):
+        """Initialise with provided error message."""
+        self.message = str(e)
+        super().__init__(self.message)
+
+
+def retrieve_secrets():
+    secret_name = "bentley-secrets"
+    # cached across warm invocations and refreshed after SECRET_TTL_SECONDS
+    return runtime.secret(secret_name)
+
+
+def connect_to_database() -> Connection:
+    try:
+        secrets = json.loads(retrieve_secrets())
+        host = secrets["host"]
+        port = secrets["port"]
+        user = secrets["user"]
+        password = secrets["password"]
+        database = secrets["database"]
+
+        return Connection(
+            database=database, user=user, password=password, host=host, port=port
+        )
+    except InterfaceError as i:
+        logger.error(f"Interface error: {i}")
+        raise DBConnectionException("Failed to connect to database")
+
+
+class ConnectionPool:
+    """Bounded pool of database connections for the extract workers.
+    Connections are opened lazily, at most max_size are ever checked out
+    at once, and a connection that raised is closed rather than reused
+    """
+
+    def __init__(self, max_size, connect=None):
+        self.max_size = max_size
+        self._connect = connect or connect_to_database
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = self._connect()
+                with self._lock:
+                    self._opened.append(db)
+            try:
+                yield db
+            except Exception:
+                self._discard(db)
+                raise
+            self._idle.put(db)
+        finally:
+            self._slots.release()
+
+    def _discard(self, db):
+        with self._lock:
+            self._opened.remove(db)
+        try:
+            db.close()
+        except Exception as e:
+            logger.warning(f"Error closing database connection: {e}")
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for db in opened:
+            try:
+                db.close()
+            except Exception as e:
+                logger.warning(f"Error closing database connection: {e}")
+
+
+@contextmanager
+def repeatable_read(db, snapshot_id=None, export=False):
+    """Runs the body in a read only REPEATABLE READ transaction on db, so
+    every query in it sees the database at the same instant. With export
+    set, the transaction's snapshot is exported and its id yielded, and
+    with snapshot_id given, the transaction attaches to that exported
+    snapshot instead, so several connections can share one point in time
+    """
+    db.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+    try:
+        if snapshot_id is not None:
+            db.run(f"SET TRANSACTION SNAPSHOT {literal(snapshot_id)};")
+        elif export:
+            snapshot_id = db.run("SELECT pg_export_snapshot();")[0][0]
+            logger.info(f"Exported snapshot {snapshot_id}")
+        yield snapshot_id
+    except Exception:
+        try:
+            db.run("ROLLBACK;")
+        except Exception as e:
+            logger.warning(f"Error rolling back transaction: {e}")
+        raise
+    db.run("COMMIT;")
+
+
+def describe_tables(db, refresh=False):
+    """Returns a dictionary of table name to its ordered (column name, data type)
+    list and single column primary key for every public base table, from one
+    catalog query. The result is cached for the lifetime of the process, so
+    warm invocations skip the query entirely unless refresh is set
+    """
+    if _catalog and not refresh:
+        return _catalog
+
+    rows = db.run(
+        """
+        SELECT c.table_name, c.column_name, c.data_type,
+        kcu.column_name IS NOT NULL AS is_primary_key
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+        ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        LEFT JOIN information_schema.table_constraints tc
+        ON tc.table_schema = c.table_schema AND tc.table_name = c.table_name
+        AND tc.constraint_type = 'PRIMARY KEY'
+        LEFT JOIN information_schema.key_column_usage kcu
+        ON kcu.constraint_name = tc.constraint_name
+        AND kcu.table_schema = tc.table_schema AND kcu.column_name = c.column_name
+        WHERE c.table_schema='public' AND c.table_name != '_prisma_migrations'
+        AND t.table_type='BASE TABLE'
+        ORDER BY c.table_name, c.ordinal_position;
+        """
+    )
+    catalog = {}
+    for table_name, column_name, data_type, is_primary_key in rows:
+        table = catalog.setdefault(table_name, {"columns": [], "primary_keys": []})
+        table["columns"].append((column_name, data_type))
+        if is_primary_key:
+            table["primary_keys"].append(column_name)
+    for table in catalog.values():
+        primary_keys = table.pop("primary_keys")
+        table["primary_key"] = primary_keys[0] if len(primary_keys) == 1 else None
+
+    _catalog.clear()
+    _catalog.update(catalog)
+    return _catalog
+
+
+def probe_changed_tables(db, catalog, watermarks):
+    """Finds the latest last_updated value after each table's watermark in a
+    single query, and returns a dictionary of table name to that value for
+    the tables with new rows only. Tables without a last_updated column
+    cannot be extracted incrementally and are left out. A table without a
+    primary key whose boundary rows have been recorded only counts as
+    changed once it has a row updated after its watermark, as extract_table
+    drops the boundary rows it has already extracted
+    """
+    probes = []
+    for table_name, table in catalog.items():
+        if "last_updated" not in [column for column, _ in table["columns"]]:
+            logger.warning(f"{table_name} has no last_updated column, skipping")
+            continue
+        watermark = watermarks.get(table_name, (DEFAULT_WATERMARK, None))
+        conditions, params, _ = incremental_conditions(
+            table["primary_key"], watermark
+        )
+        if table["primary_key"] is None and watermark[1]:
+            conditions[0] = "last_updated > :latest"
+        probes.append(
+            inline_parameters(
+                f"""SELECT {literal(table_name)}, max(last_updated)
+                FROM {identifier(table_name)} WHERE {' AND '.join(conditions)}""",
+                params,
+            )
+        )
+    if not probes:
+        return {}
+
+    rows = db.run(" UNION ALL ".join(probes) + ";")
+    return {table_name: latest for table_name, latest in rows if latest is not None}
+
+
+def incremental_conditions(primary_key, watermark, upper=None):
+    """Returns the WHERE conditions, their parameters and the ordering columns
+    selecting the rows after a watermark, and up to an upper bound if given.
+    The watermark of a table without a primary key holds boundary row hashes
+    in place of the key, which do not take part in the query
+    """
+    last_updated, pk = watermark
+    key_columns = ["last_updated"]
+    if primary_key is not None:
+        key_columns.append(identifier(primary_key))
+    key = f"({', '.join(key_columns)})"
+
+    if primary_key is None or pk is None:
+        conditions = ["last_updated >= :latest"]
+        params = {"latest": last_updated}
+    else:
+        conditions = [f"{key} > (:latest, :pk)"]
+        params = {"latest": last_updated, "pk": pk}
+
+    if upper is not None:
+        if primary_key is None:
+            conditions.append("last_updated <= :upper_latest")
+            params["upper_latest"] = upper[0]
+        else:
+            conditions.append(f"{key} <= (:upper_latest, :upper_pk)")
+            params["upper_latest"], params["upper_pk"] = upper
+    return conditions, params, key_columns
+
+
+def build_incremental_query(
+    table_name, primary_key, watermark, upper=None, limit=None
+):
+    """Builds the query selecting every row of a table after its watermark,
+    or only the first limit rows of them. Rows are compared on the
+    (last_updated, primary key) tuple, so a row on the boundary is never
+    extracted twice. Without a primary key, or before the first primary key
+    has been recorded, last_updated alone is used and the boundary is
+    inclusive, and extract_table drops the boundary rows it has already
+    extracted. Returns the query and its parameters
+    """
+    conditions, params, key_columns = incremental_conditions(
+        primary_key, watermark, upper
+    )
+    limit_clause = f"\n        LIMIT {int(limit)}" if limit else ""
+    return (
+        f"""
+        SELECT * FROM {identifier(table_name)}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(key_columns)}{limit_clause};
+        """,
+        params,
+    )
+
+
+def build_upper_bound_query(table_name, primary_key, watermark):
+    """Builds the query returning the (last_updated, primary key) of the
+    last row after a table's watermark, which becomes the next watermark
+    """
+    conditions, params, key_columns = incremental_conditions(primary_key, watermark)
+    return (
+        f"""
+        SELECT {', '.join(key_columns)} FROM {identifier(table_name)}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(column + ' DESC' for column in key_columns)}
+        LIMIT 1;
+        """,
+        params,
+    )
+
+
+def inline_parameters(query, params):
+    """Replaces each :name placeholder with the quoted literal value, for
+    statements such as COPY that cannot take bind parameters
+    """
+    return re.sub(
+        r"(?<!:):(\w+)", lambda match: literal(params[match.group(1)]), query
+    )
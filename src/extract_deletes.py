@@ -0,0 +1,244 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from pg8000.native import identifier, literal
+
+try:
+    from src.extract_database import INTEGER_TYPES
+    from src.extract_storage import EXTRACT_FORMAT, extract_extension, upload_rows
+except ImportError:  # packaged alongside this module in the lambda zip
+    from extract_database import INTEGER_TYPES
+    from extract_storage import EXTRACT_FORMAT, extract_extension, upload_rows
+
+logger = logging.getLogger(__name__)
+
+DELETES_PREFIX = "_deletes"
+FINGERPRINT_PREFIX = "_fingerprints"
+FINGERPRINT_BLOCK_SIZE = int(os.environ.get("FINGERPRINT_BLOCK_SIZE", "1024"))
+
+
+def upload_deletes(
+    table_name,
+    key_column,
+    key_type,
+    keys,
+    bucket_name,
+    client,
+    file_format,
+    batch="",
+):
+    """Uploads tombstones for the deleted rows of a table, as the deleted
+    primary keys and the time the deletes were found, under DELETES_PREFIX.
+    batch is added to the end of the key, to keep several uploads within one
+    second apart. Returns False if the upload failed
+    """
+    extension = extract_extension(file_format)
+    deleted_at = datetime.today()
+    s3_key = datetime.strftime(
+        deleted_at,
+        f"{DELETES_PREFIX}/{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S{batch}."
+        + extension,
+    )
+    return upload_rows(
+        [[key, deleted_at] for key in keys],
+        [key_column, "deleted_at"],
+        s3_key,
+        bucket_name,
+        client,
+        file_format,
+        {key_column: key_type, "deleted_at": "timestamp without time zone"},
+    )
+
+
+def block_hash(keys):
+    """Hashes a block of integer primary keys the same way the database does
+    in summarise_key_blocks: the md5 of the sorted keys joined by commas
+    """
+    return hashlib.md5(",".join(str(key) for key in sorted(keys)).encode()).hexdigest()
+
+
+def encode_block(keys, block, block_size):
+    """Packs the primary keys of a block into a base64 bitmap of block_size bits"""
+    bitmap = bytearray((block_size + 7) // 8)
+    for key in keys:
+        offset = key - block * block_size
+        bitmap[offset // 8] |= 1 << (offset % 8)
+    return base64.b64encode(bytes(bitmap)).decode("ascii")
+
+
+def decode_block(encoded, block, block_size):
+    """Unpacks a bitmap written by encode_block into its primary keys"""
+    bitmap = base64.b64decode(encoded)
+    return [
+        block * block_size + offset
+        for offset in range(block_size)
+        if bitmap[offset // 8] >> (offset % 8) & 1
+    ]
+
+
+def read_fingerprint(table_name, bucket_name, client):
+    """Returns the primary key fingerprint of a table from the extract bucket
+    as {"block_size": ..., "blocks": {block number: bitmap}}, or None if the
+    table has not been fingerprinted yet
+    """
+    try:
+        file_obj = client.get_object(
+            Bucket=bucket_name, Key=f"{FINGERPRINT_PREFIX}/{table_name}.json"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        logger.error(f"Error reading fingerprint for {table_name}: {e}")
+        raise
+    record = json.loads(file_obj["Body"].read())
+    return {
+        "block_size": record["block_size"],
+        "blocks": {int(block): bitmap for block, bitmap in record["blocks"].items()},
+    }
+
+
+def write_fingerprint(table_name, fingerprint, bucket_name, client):
+    """Persists the primary key fingerprint of a table to the extract bucket"""
+    record = {
+        "table": table_name,
+        "block_size": fingerprint["block_size"],
+        "blocks": {str(block): bitmap for block, bitmap in fingerprint["blocks"].items()},
+    }
+    client.put_object(
+        Bucket=bucket_name,
+        Key=f"{FINGERPRINT_PREFIX}/{table_name}.json",
+        Body=json.dumps(record).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def _block_expression(primary_key, block_size):
+    return f"floor({identifier(primary_key)} / {int(block_size)}::numeric)::bigint"
+
+
+def summarise_key_blocks(db, tables, block_size=FINGERPRINT_BLOCK_SIZE):
+    """Splits the primary keys of each table into blocks of block_size
+    consecutive values and hashes each block in the database, in one query
+    for all tables. Only the block hashes are returned, as a dictionary of
+    table name to {block number: hash}, so no rows leave the database
+    """
+    summaries = [
+        f"""SELECT {literal(table_name)}, {_block_expression(primary_key, block_size)},
+        md5(string_agg({identifier(primary_key)}::text, ',' ORDER BY {identifier(primary_key)}))
+        FROM {identifier(table_name)} GROUP BY 2"""
+        for table_name, primary_key in tables.items()
+    ]
+    blocks = {table_name: {} for table_name in tables}
+    for table_name, block, digest in db.run(" UNION ALL ".join(summaries) + ";"):
+        blocks[table_name][block] = digest
+    return blocks
+
+
+def fetch_block_keys(db, table_name, primary_key, blocks, block_size):
+    """Returns the primary keys in the given blocks of a table, as a
+    dictionary of block number to keys. Each block is read as a primary key
+    range, so the query only touches those parts of the index. With blocks
+    set to None, every key in the table is returned
+    """
+    query = f"SELECT {identifier(primary_key)} FROM {identifier(table_name)}"
+    if blocks is not None:
+        query += " WHERE " + " OR ".join(
+            f"({identifier(primary_key)} >= {block * block_size}"
+            f" AND {identifier(primary_key)} < {(block + 1) * block_size})"
+            for block in sorted(blocks)
+        )
+    keys = {block: [] for block in blocks or []}
+    for (key,) in db.run(query + ";"):
+        keys.setdefault(key // block_size, []).append(key)
+    return keys
+
+
+def detect_deleted_rows(
+    db,
+    catalog,
+    bucket_name,
+    client,
+    file_format=EXTRACT_FORMAT,
+    block_size=FINGERPRINT_BLOCK_SIZE,
+):
+    """Finds rows deleted from the database since the last run, without
+    reading whole tables. Each table's primary keys are kept in the extract
+    bucket as a fingerprint of fixed size blocks, and compared against block
+    hashes computed in the database. Only blocks whose hash has changed are
+    read back, and keys missing from them are uploaded as tombstones with
+    upload_deletes before the fingerprint is updated. The first run only
+    builds the fingerprint. Tables without a single integer primary key are
+    skipped. Returns the names of the tables with deleted rows
+    """
+    tables = {
+        table_name: table["primary_key"]
+        for table_name, table in catalog.items()
+        if table["primary_key"]
+        and dict(table["columns"]).get(table["primary_key"]) in INTEGER_TYPES
+    }
+    if not tables:
+        return []
+
+    deleted_tables = []
+    summaries = summarise_key_blocks(db, tables, block_size)
+    for table_name, primary_key in tables.items():
+        fingerprint = read_fingerprint(table_name, bucket_name, client)
+        if fingerprint is not None and fingerprint["block_size"] != block_size:
+            logger.info(f"Block size changed, rebuilding fingerprint for {table_name}")
+            fingerprint = None
+        stored = fingerprint["blocks"] if fingerprint else {}
+        stored_keys = {
+            block: decode_block(bitmap, block, block_size)
+            for block, bitmap in stored.items()
+        }
+        current = summaries[table_name]
+        changed = [
+            block
+            for block, digest in current.items()
+            if block not in stored_keys or block_hash(stored_keys[block]) != digest
+        ]
+        emptied = [block for block in stored_keys if block not in current]
+        if not changed and not emptied:
+            continue
+
+        if fingerprint is None:
+            block_keys = fetch_block_keys(db, table_name, primary_key, None, block_size)
+        elif changed:
+            block_keys = fetch_block_keys(
+                db, table_name, primary_key, changed, block_size
+            )
+        else:
+            block_keys = {}
+        deleted = []
+        if fingerprint is not None:
+            for block in changed + emptied:
+                deleted.extend(
+                    sorted(set(stored_keys.get(block, [])) - set(block_keys.get(block, [])))
+                )
+        if deleted:
+            logger.info(f"Found {len(deleted)} deleted rows in {table_name}")
+            if not upload_deletes(
+                table_name,
+                primary_key,
+                dict(catalog[table_name]["columns"])[primary_key],
+                deleted,
+                bucket_name,
+                client,
+                file_format,
+            ):
+                raise RuntimeError(f"Failed to upload deletes for {table_name}")
+            deleted_tables.append(table_name)
+
+        for block in emptied:
+            stored.pop(block)
+        for block, keys in block_keys.items():
+            stored[block] = encode_block(keys, block, block_size)
+        write_fingerprint(
+            table_name, {"block_size": block_size, "blocks": stored}, bucket_name, client
+        )
+    return deleted_tables
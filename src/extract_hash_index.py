@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import struct
+
+from botocore.exceptions import ClientError
+
+HASH_INDEX_PREFIX = "_hashes"
+HASH_SHARD_SIZE = int(os.environ.get("HASH_SHARD_SIZE", "65536"))
+# bumped by the source on every write, so left out of the row content hash
+AUDIT_COLUMNS = ("created_at", "last_updated")
+
+
+class RowHashIndex:
+    """Remembers a hash of the non-audit columns of every row extracted from
+    a table, so rows whose last_updated has moved but whose content has not
+    can be dropped. The index lives in the extract bucket under
+    HASH_INDEX_PREFIX, split by primary key into shards of shard_size keys,
+    each a packed array of (primary key, 64 bit hash) pairs. Only the shards
+    touched by a chunk are read, and only changed shards are written back
+    """
+
+    def __init__(
+        self, table_name, primary_key, bucket_name, client, shard_size=HASH_SHARD_SIZE
+    ):
+        self.table_name = table_name
+        self.primary_key = primary_key
+        self.bucket_name = bucket_name
+        self.client = client
+        self.shard_size = shard_size
+        self._shards = {}
+        self._dirty = set()
+
+    @staticmethod
+    def row_hash(values):
+        digest = hashlib.blake2b(
+            json.dumps(values, default=str).encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    def _key(self, shard):
+        return f"{HASH_INDEX_PREFIX}/{self.table_name}/{shard}.bin"
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            try:
+                body = self.client.get_object(
+                    Bucket=self.bucket_name, Key=self._key(shard)
+                )["Body"].read()
+                self._shards[shard] = dict(struct.iter_unpack("<qQ", body))
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                    raise
+                self._shards[shard] = {}
+        return self._shards[shard]
+
+    def changed_rows(self, rows, column_names):
+        """Returns the rows whose content differs from the last extracted
+        version, recording their new hashes to be written by save
+        """
+        key_index = column_names.index(self.primary_key)
+        content_indexes = [
+            index
+            for index, column in enumerate(column_names)
+            if column not in AUDIT_COLUMNS
+        ]
+        changed = []
+        for row in rows:
+            key = row[key_index]
+            shard = key // self.shard_size
+            hashes = self._shard(shard)
+            digest = self.row_hash([row[index] for index in content_indexes])
+            if hashes.get(key) == digest:
+                continue
+            hashes[key] = digest
+            self._dirty.add(shard)
+            changed.append(row)
+        return changed
+
+    def save(self):
+        """Writes back the shards changed since the last save"""
+        for shard in sorted(self._dirty):
+            self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=self._key(shard),
+                Body=b"".join(
+                    struct.pack("<qQ", key, digest)
+                    for key, digest in sorted(self._shards[shard].items())
+                ),
+            )
+        self._dirty.clear()
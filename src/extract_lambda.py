@@ -1,13 +1,84 @@
-import csv
+import hashlib
 import json
 import logging
-import re
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import StringIO
 
-import boto3
 from botocore.exceptions import ClientError
-from pg8000.native import Connection, InterfaceError, identifier
+
+try:
+    from src.runtime_context import context as runtime
+    from src.extract_backfill import (
+        dispatch_backfill,
+        plan_backfill,
+        read_backfill_plan,
+        run_backfill_shard,
+        start_backfill,
+    )
+    from src.extract_cdc import process_replication_changes
+    from src.extract_database import (
+        DEFAULT_WATERMARK,
+        EXTRACT_WORKERS,
+        INTEGER_TYPES,
+        ConnectionPool,
+        build_incremental_query,
+        connect_to_database,
+        describe_tables,
+        probe_changed_tables,
+        repeatable_read,
+    )
+    from src.extract_deletes import detect_deleted_rows
+    from src.extract_hash_index import RowHashIndex
+    from src.extract_storage import (
+        EXTRACT_COMPRESSION,
+        EXTRACT_FORMAT,
+        extract_bucket,
+        extract_extension,
+        read_watermarks,
+        stream_table_to_s3,
+        upload_rows,
+        write_watermark,
+    )
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+    from extract_backfill import (
+        dispatch_backfill,
+        plan_backfill,
+        read_backfill_plan,
+        run_backfill_shard,
+        start_backfill,
+    )
+    from extract_cdc import process_replication_changes
+    from extract_database import (
+        DEFAULT_WATERMARK,
+        EXTRACT_WORKERS,
+        INTEGER_TYPES,
+        ConnectionPool,
+        build_incremental_query,
+        connect_to_database,
+        describe_tables,
+        probe_changed_tables,
+        repeatable_read,
+    )
+    from extract_deletes import detect_deleted_rows
+    from extract_hash_index import RowHashIndex
+    from extract_storage import (
+        EXTRACT_COMPRESSION,
+        EXTRACT_FORMAT,
+        extract_bucket,
+        extract_extension,
+        read_watermarks,
+        stream_table_to_s3,
+        upload_rows,
+        write_watermark,
+    )
+
+try:
+    import pyarrow as pa
+except ImportError:  # only needed for the parquet and arrow extract formats
+    pa = None
 
 logger = logging.getLogger(__name__)
 
@@ -20,222 +91,637 @@ logging.basicConfig(
 
 logging.getLogger("botocore").setLevel(logging.WARNING)
 
-
-class DBConnectionException(Exception):
-    """Wraps pg8000.native Error or DatabaseError."""
-
-    def __init__(self, e):
-        """Initialise with provided error message."""
-        self.message = str(e)
-        super().__init__(self.message)
+STREAM_EXTRACT = os.environ.get("EXTRACT_STREAMING", "false").lower() == "true"
+EXTRACT_CHUNK_SIZE = int(os.environ.get("EXTRACT_CHUNK_SIZE", "50000"))
+# stop starting new chunks once fewer than this many seconds of the invocation are left
+EXTRACT_TIME_MARGIN_SECONDS = int(os.environ.get("EXTRACT_TIME_MARGIN_SECONDS", "20"))
+EXTRACT_SELF_INVOKE = os.environ.get("EXTRACT_SELF_INVOKE", "false").lower() == "true"
+CONTINUATION_KEY = "_control/continuation.json"
+# "poll" extracts rows by last_updated, "cdc" reads a logical replication slot
+EXTRACT_MODE = os.environ.get("EXTRACT_MODE", "poll").lower()
+DETECT_DELETES = os.environ.get("EXTRACT_DETECT_DELETES", "false").lower() == "true"
+SUPPRESS_UNCHANGED = (
+    os.environ.get("EXTRACT_SUPPRESS_UNCHANGED", "false").lower() == "true"
+)
+SCHEDULE_KEY = "_control/schedule.json"
+# how many of a table's most recent changes are kept to estimate its change rate
+CHANGE_HISTORY = 8
+# allows for jitter in the 30 minute trigger, so a table due at the next run is not missed
+POLL_GRACE_SECONDS = 120
+DEFAULT_POLICY = {
+    "mode": "incremental",
+    "chunk_size": None,
+    "min_interval": 0,
+    "max_interval": 4 * 3600,
+    "priority": 5,
+}
+# "mode" is "incremental" or "snapshot", a full reload of the table whenever it
+# changes. A chunk_size of None uses EXTRACT_CHUNK_SIZE. Intervals are in
+# seconds and lower priorities are extracted first
+TABLE_POLICIES = {
+    "sales_order": {"min_interval": 0, "max_interval": 0, "priority": 1},
+    "transaction": {"min_interval": 0, "max_interval": 0, "priority": 1},
+    "payment": {"min_interval": 0, "max_interval": 0, "priority": 1},
+    "purchase_order": {"min_interval": 0, "max_interval": 0, "priority": 1},
+    "staff": {"min_interval": 0, "max_interval": 3600, "priority": 4},
+    "counterparty": {"min_interval": 0, "max_interval": 3600, "priority": 4},
+    "address": {"min_interval": 0, "max_interval": 3600, "priority": 4},
+    "currency": {
+        "mode": "snapshot",
+        "min_interval": 3600,
+        "max_interval": 86400,
+        "priority": 9,
+    },
+    "department": {
+        "mode": "snapshot",
+        "min_interval": 3600,
+        "max_interval": 86400,
+        "priority": 9,
+    },
+    "design": {"min_interval": 3600, "max_interval": 86400, "priority": 8},
+    "payment_type": {
+        "mode": "snapshot",
+        "min_interval": 3600,
+        "max_interval": 86400,
+        "priority": 9,
+    },
+}
+TABLE_POLICIES.update(json.loads(os.environ.get("EXTRACT_POLICIES", "{}")))
 
 
 def lambda_handler(event, context):
-    """This lambda function connects to the Totesys database, lists the contents of the ingestion bucket,
-    and converts all tables to CSV and if any of those tables do not exist in, or are different to the ones in s3, it uploads them
-    it uses 3 helper functions to achieve these 3 functionalities
+    """Connects to the Totesys database, reads each table's watermark from the
+    extract bucket and uploads the rows changed since, in EXTRACT_FORMAT, with
+    process_and_upload_tables. The database connection is kept open for the
+    next warm invocation, and the polling schedule is saved after each run.
+    If the invocation runs short of time, the extract stops cleanly and the
+    tables left over are saved as a continuation, which the next invocation
+    extracts first. With EXTRACT_MODE set to "cdc", changes are read from a
+    logical replication slot instead of polling each table.
+    A {"backfill": ...} event plans a backfill with plan_backfill and runs it
+    with dispatch_backfill, and a {"backfill_shard": ...} event runs one shard
     """
-    db = None
+    event = event or {}
     try:
-        db = connect_to_database()
-        existing_files = list_existing_s3_files()
-        any_changes = process_and_upload_tables(db, existing_files)
+        db = runtime.connection("totesys", connect_to_database)
+        if "backfill_shard" in event:
+            run_backfill_shard(db, event["backfill_shard"])
+            return {"statusCode": 200, "body": json.dumps("Backfill shard extracted.")}
+        if "backfill" in event:
+            options = event["backfill"] if isinstance(event["backfill"], dict) else {}
+            if options.get("resume"):
+                plan = read_backfill_plan()
+            else:
+                plan = plan_backfill(db, describe_tables(db), options.get("tables"))
+                start_backfill(plan)
+            shards = dispatch_backfill(db, plan, context)
+            return {
+                "statusCode": 200,
+                "body": json.dumps(
+                    f"Backfill {plan['plan_id']} started {shards} shards."
+                ),
+            }
+
+        watermarks = read_watermarks()
+        if EXTRACT_MODE == "cdc":
+            continuation = []
+            any_changes = process_replication_changes(
+                db, watermarks, out_of_time=time_budget(context)
+            )
+        else:
+            continuation = read_continuation()
+            schedule = read_schedule()
+            any_changes = process_and_upload_tables(
+                db,
+                watermarks,
+                out_of_time=time_budget(context),
+                priority=continuation,
+                schedule=schedule,
+            )
+            write_schedule(schedule)
+        if any_changes["remaining"] or continuation:
+            write_continuation(any_changes["remaining"])
+        if any_changes["remaining"]:
+            logger.warning(
+                f"Stopped before the deadline, remaining: {', '.join(any_changes['remaining'])}"
+            )
+            if EXTRACT_SELF_INVOKE:
+                invoke_continuation(context)
 
+        if any_changes.get("deleted"):
+            logger.info(f"Deletes extracted for {', '.join(any_changes['deleted'])}")
         if not any_changes["updated"]:
             logger.info("No changes detected in the database.")
             return {
                 "statusCode": 200,
-                "body": json.dumps("No changes detected, no CSV files were uploaded."),
+                "body": json.dumps("No changes detected, no extracts were uploaded."),
             }
-        return {
-            "statusCode": 200,
-            "body": json.dumps(
-                f"""CSV files processed for {', '.join(any_changes['updated'])} and uploaded successfully.{
-                'The following tables were not updated: '+', '.join(any_changes['no change']) if any_changes['no change'] else ''}"""
-            ),
-        }
+        message = (
+            f"Extracts of {', '.join(any_changes['updated'])} uploaded successfully."
+        )
+        if any_changes["no change"]:
+            message += (
+                " The following tables were not updated: "
+                + ", ".join(any_changes["no change"])
+            )
+        return {"statusCode": 200, "body": json.dumps(message)}
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
+        runtime.discard_connection("totesys")
         return {"statusCode": 500, "body": json.dumps("Internal server error.")}
-    finally:
-        if db:
-            db.close()
 
 
-def retrieve_secrets():
-    secret_name = "bentley-secrets"
-    region_name = "eu-west-2"
+def time_budget(context, margin=EXTRACT_TIME_MARGIN_SECONDS):
+    """Returns a function reporting whether fewer than margin seconds are left
+    in the invocation, according to context.get_remaining_time_in_millis().
+    Without a Lambda context there is no deadline, so it always returns False
+    """
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining_time is None:
+        return lambda: False
+    return lambda: get_remaining_time() < margin * 1000
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
 
+def read_continuation(bucket_name=None, client=None):
+    """Returns the tables left unfinished by the previous invocation, in the
+    order they should be picked up, or an empty list if there are none.
+    Their progress within each table is held by the watermark manifest
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        file_obj = client.get_object(Bucket=bucket_name, Key=CONTINUATION_KEY)
     except ClientError as e:
-        logger.error(f"Failed to retrieve secret {secret_name}: {str(e)}")
-        raise e
-    except KeyError:
-        logger.error(f"Secret {secret_name} does not contain a SecretString")
-        raise ValueError(f"Secret {secret_name} does not contain a SecretString")
-
-    return get_secret_value_response["SecretString"]
-
-
-def connect_to_database() -> Connection:
-    try:
-        secrets = json.loads(retrieve_secrets())
-        host = secrets["host"]
-        port = secrets["port"]
-        user = secrets["user"]
-        password = secrets["password"]
-        database = secrets["database"]
-
-        return Connection(
-            database=database, user=user, password=password, host=host, port=port
-        )
-    except InterfaceError as i:
-        logger.error(f"Interface error: {i}")
-        raise DBConnectionException("Failed to connect to database")
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return []
+        logger.error(f"Error reading continuation: {e}")
+        raise
+    return json.loads(file_obj["Body"].read())["tables"]
 
 
-def extract_bucket(client=None):
+def write_continuation(tables, bucket_name=None, client=None):
+    """Saves the tables the next invocation should pick up first. An empty
+    list marks the previous continuation as finished
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
     if client is None:
-        client = boto3.client("s3")
-    response = client.list_buckets()
-    extract_bucket_filter = [
-        bucket["Name"] for bucket in response["Buckets"] if "extract" in bucket["Name"]
-    ]
+        client = runtime.client("s3")
+    client.put_object(
+        Bucket=bucket_name,
+        Key=CONTINUATION_KEY,
+        Body=json.dumps(
+            {"tables": list(tables), "created_at": datetime.today().isoformat()}
+        ).encode("utf-8"),
+        ContentType="application/json",
+    )
 
-    if not extract_bucket_filter:
-        raise ValueError("No extract_bucket found")
 
-    return extract_bucket_filter[0]
+def invoke_continuation(context):
+    """Asynchronously invokes this lambda again to carry on with the
+    continuation, rather than waiting for the next scheduled run
+    """
+    function_arn = getattr(context, "invoked_function_arn", None)
+    if function_arn is None:
+        return
+    runtime.client("lambda").invoke(
+        FunctionName=function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({"continuation": True}).encode("utf-8"),
+    )
+    logger.info("Invoked a continuation of the extract")
 
 
-def list_existing_s3_files(bucket_name=None, client=None):
-    """Creates a dictionary and populates it with the
-    results of listing the contents of the s3 bucket, then
-    returns the populated dictionary
+def table_policy(table_name, policies=None):
+    """Returns the extract policy of a table, DEFAULT_POLICY overlaid with its
+    entry in policies, TABLE_POLICIES by default
     """
+    policies = TABLE_POLICIES if policies is None else policies
+    return {**DEFAULT_POLICY, **policies.get(table_name, {})}
 
-    logging.info("Listing existing S3 files")
-    existing_files = {}
 
+def read_schedule(bucket_name=None, client=None):
+    """Returns the polling schedule kept by update_schedule, a dictionary of
+    table name to {"last_polled": iso timestamp, "interval": seconds,
+    "first_polled": iso timestamp, "changes": [iso timestamps]}, or an empty
+    dictionary before the first scheduled run
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
     try:
-        if client is None:
-            client = boto3.client("s3")
-        if bucket_name is None:
-            bucket_name = extract_bucket(client)
-
-        response = client.list_objects_v2(Bucket=bucket_name)
-
-        if "Contents" in response:
-            for obj in response["Contents"]:
-                s3_key = obj["Key"]
-                try:
-                    file_obj = client.get_object(Bucket=bucket_name, Key=s3_key)
-                    file_content = file_obj["Body"].read().decode("utf-8")
-                    existing_files[s3_key] = file_content
-                except ClientError as e:
-                    logger.error(f"Error retrieving S3 object {s3_key}: {e}")
-        else:
-            logger.error("The bucket is empty")
-            return None
-
-    except ValueError as ve:
-        logger.error(f"Error listing S3 objects: {ve}")
+        file_obj = client.get_object(Bucket=bucket_name, Key=SCHEDULE_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}
+        logger.error(f"Error reading schedule: {e}")
         raise
-    except ClientError as ce:
-        logger.error(f"Error listing S3 objects: {ce}")
-
-    return existing_files
+    return json.loads(file_obj["Body"].read())
 
 
-def get_latest_timestamp(existing_files):
-    if existing_files:
-        all_datetimes = []
-        for file_name in existing_files.keys():
-            match = re.search(r"\/(.+/).+_(.+)\.csv", file_name)
-            if match:
-                datetime_str = "".join(match.group(1, 2))
-                all_datetimes.append(
-                    datetime.strptime(datetime_str, "%Y/%m/%d/%H:%M:%S")
-                )
-        return max(all_datetimes) if all_datetimes else datetime.min
-
-    return existing_files
+def write_schedule(schedule, bucket_name=None, client=None):
+    """Persists the polling schedule"""
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+    client.put_object(
+        Bucket=bucket_name,
+        Key=SCHEDULE_KEY,
+        Body=json.dumps(schedule).encode("utf-8"),
+        ContentType="application/json",
+    )
 
 
-def process_and_upload_tables(db, existing_files, client=boto3.client("s3")):
-    """Creates a list of the tables from a database query and
-    then selects everything from each table in individual queries
-    it then writes each table to CSV files and compares with the item
-    in the existing_files dictionary with the same name. If it finds any changes
-    to files, or new tables/files it uploads them to the s3 bucket
+def is_due(table_name, schedule, now):
+    """Returns whether a table's poll interval has passed since it was last
+    polled. Tables that have never been polled are always due
+    """
+    entry = schedule.get(table_name)
+    if entry is None:
+        return True
+    elapsed = (now - datetime.fromisoformat(entry["last_polled"])).total_seconds()
+    return elapsed + POLL_GRACE_SECONDS >= entry["interval"]
+
+
+def update_schedule(schedule, table_name, changed, now, policies=None):
+    """Records that a table was polled at now, and whether it had changed.
+    The times of its last CHANGE_HISTORY changes give the table's expected
+    gap between changes, the mean gap between them, or the time it has been
+    quiet for if that is longer. The table is polled twice per expected gap,
+    within its policy's min_interval and max_interval, so a table's poll
+    frequency follows how often it has actually been changing
     """
-    load_status = {"updated": [], "no change": []}
-    latest_timestamp = get_latest_timestamp(existing_files)
-
-    tables = db.run(
-        """
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema='public' AND table_name != '_prisma_migrations'
-        AND table_type='BASE TABLE';
-        """
+    policy = table_policy(table_name, policies)
+    entry = schedule.get(table_name, {})
+    first_polled = entry.get("first_polled", entry.get("last_polled", now.isoformat()))
+    changes = [datetime.fromisoformat(change) for change in entry.get("changes", [])]
+    if changed:
+        changes = (changes + [now])[-CHANGE_HISTORY:]
+
+    quiet_since = changes[-1] if changes else datetime.fromisoformat(first_polled)
+    expected_gap = (now - quiet_since).total_seconds()
+    if len(changes) > 1:
+        mean_gap = (changes[-1] - changes[0]).total_seconds() / (len(changes) - 1)
+        expected_gap = max(expected_gap, mean_gap)
+    interval = int(expected_gap / 2)
+    interval = min(max(interval, policy["min_interval"]), policy["max_interval"])
+    schedule[table_name] = {
+        "last_polled": now.isoformat(),
+        "interval": interval,
+        "first_polled": first_polled,
+        "changes": [change.isoformat() for change in changes],
+    }
+
+
+def extract_table(
+    db,
+    table_name,
+    primary_key,
+    watermark,
+    bucket_name,
+    client,
+    stream=STREAM_EXTRACT,
+    file_format=EXTRACT_FORMAT,
+    column_types=None,
+    chunk_size=EXTRACT_CHUNK_SIZE,
+    out_of_time=None,
+    suppress_unchanged=SUPPRESS_UNCHANGED,
+    compression=EXTRACT_COMPRESSION,
+):
+    """Extracts the rows of a single table after its (last_updated, primary key)
+    watermark. The rows are paged through in keyset order, chunk_size rows at a
+    time, and each chunk is uploaded to the s3 bucket as its own part file,
+    after which the table's watermark is moved on to the last row of the chunk.
+    The watermark is therefore a checkpoint, and a run that fails or times out
+    part way through resumes from the last completed chunk. Tables without a
+    primary key cannot be paged exactly, so are extracted in a single query.
+    Their watermark holds the row_digest of each row at its last_updated in
+    place of a key, and the rows on that boundary that were extracted before
+    are dropped, so each row is extracted once.
+    With stream set, a CSV table with a primary key is instead streamed
+    straight to S3 with stream_table_to_s3. With file_format "parquet" or
+    "arrow", the rows are written as a typed Arrow table, using the catalog
+    data types in column_types. If out_of_time returns True after a chunk, the extract
+    stops there. With suppress_unchanged, rows of a table with an integer
+    primary key are checked against its RowHashIndex, and rows whose content
+    has not changed are not uploaded; this does not apply to streamed
+    extracts. CSV output is compressed with compression, "gzip" or "zstd".
+    Returns "updated", "no change", "partial" if it stopped early, or None if
+    an upload failed
+    """
+    logger.info(f"Processing table: {table_name}")
+    logger.info(f"Watermark: {watermark}")
+    extension = extract_extension(file_format, compression)
+    if file_format != "csv" and pa is None:
+        raise ValueError(f"pyarrow is required for the {file_format} extract format")
+    key_prefix = datetime.strftime(
+        datetime.today(), f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S"
     )
 
-    for table in tables:
-        table_name = table[0]
-        base_query = f"""
-            SELECT * FROM {identifier(table_name)}
-            WHERE last_updated >= :latest;
-            """
-        latest = (
-            {
-                datetime.strftime(
-                    latest_timestamp if latest_timestamp else datetime(1990, 1, 1),
-                    "%Y-%m-%d %H:%M:%S",
-                )
-            },
+    if stream and file_format == "csv" and primary_key is not None:
+        s3_key = f"{key_prefix}.{extension}"
+        try:
+            new_watermark = stream_table_to_s3(
+                db, table_name, primary_key, watermark, s3_key, bucket_name, client
+            )
+        except ClientError as e:
+            logger.error(f"Error streaming {table_name} to S3: {e}")
+            return None
+        if new_watermark is None:
+            logger.info(f"No new data")
+            return "no change"
+        write_watermark(table_name, new_watermark, bucket_name, client)
+        logger.info(f"Uploaded {s3_key} to S3.")
+        return "updated"
+
+    boundary = set()
+    if primary_key is None:
+        chunk_size = None
+        boundary = set(watermark[1] or ())
+    hash_index = None
+    if suppress_unchanged and (column_types or {}).get(primary_key) in INTEGER_TYPES:
+        hash_index = RowHashIndex(table_name, primary_key, bucket_name, client)
+    parts = 0
+    chunks = 0
+    while True:
+        base_query, params = build_incremental_query(
+            table_name, primary_key, watermark, limit=chunk_size
         )
-        logger.info(f"Processing table: {table_name}")
-        logger.info(f"Latest timestamp: {latest[0]}")
-        rows = db.run(base_query, latest=latest)
+        rows = db.run(base_query, **params)
         logger.debug(f"Rows: {rows}")
-        # Creating a temporary file path and writing the column name to it followed by each row of data
-        if rows:
-            csv_file_path = f"/tmp/{table_name}.csv"
-            with open(csv_file_path, "w", newline="") as file:
-                writer = csv.writer(file)
-                # column_names = [desc["name"] for desc in db.columns(f"SELECT * FROM {table_name};")]
-                column_names = [
-                    col_name[0]
-                    for col_name in db.run(
-                        """SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS 
-                                       WHERE table_name = :table ;""",
-                        table=table_name,
-                    )
-                ]
-                writer.writerow(column_names)
-                writer.writerows(rows)
-            s3_key = datetime.strftime(
-                datetime.today(), f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S.csv"
+        if not rows:
+            break
+        # taken from the cursor description, so always in the same order as the rows
+        column_names = [column["name"] for column in db.columns]
+        chunks += 1
+
+        changed_rows = rows
+        if primary_key is None:
+            updated = column_names.index("last_updated")
+            changed_rows = [
+                row
+                for row in rows
+                if row[updated] != watermark[0] or row_digest(row) not in boundary
+            ]
+        if hash_index is not None:
+            changed_rows = hash_index.changed_rows(rows, column_names)
+            if len(changed_rows) < len(rows):
+                logger.info(
+                    f"Dropped {len(rows) - len(changed_rows)} unchanged rows from {table_name}"
+                )
+        if changed_rows:
+            parts += 1
+            s3_key = (
+                f"{key_prefix}_part{parts:04d}.{extension}"
+                if chunk_size
+                else f"{key_prefix}.{extension}"
+            )
+            # Writing the new file to S3 extract bucket, then moving the watermark on:
+            if not upload_rows(
+                changed_rows,
+                column_names,
+                s3_key,
+                bucket_name,
+                client,
+                file_format,
+                column_types,
+            ):
+                return None
+        if hash_index is not None:
+            hash_index.save()
+        last_row = dict(zip(column_names, rows[-1]))
+        watermark = (last_row["last_updated"], last_row.get(primary_key))
+        if primary_key is None:
+            watermark = (
+                watermark[0],
+                sorted(row_digest(row) for row in rows if row[updated] == watermark[0]),
             )
+        write_watermark(table_name, watermark, bucket_name, client)
 
-            # Writing the new file to S3 extract bucket:
-            try:
-                client.upload_file(csv_file_path, extract_bucket(), s3_key)
-                load_status["updated"].append(table_name)
-                logger.info(f"Uploaded {s3_key} to S3.")
-            except ClientError as e:
-                logger.error(f"Error uploading to S3: {e}")
-        else:
-            load_status["no change"].append(table_name)
-            logger.info(f"No new data")
+        if not chunk_size or len(rows) < chunk_size:
+            break
+        if out_of_time is not None and out_of_time():
+            logger.warning(f"Out of time, stopping {table_name} after chunk {chunks}")
+            return "partial"
+
+    if not parts:
+        logger.info(f"No new data")
+        return "no change"
+    return "updated"
+
+
+def row_digest(row):
+    """Returns a sha256 hex digest of a row's values, which identifies a row
+    of a table without a primary key
+    """
+    return hashlib.sha256(json.dumps(row, default=str).encode("utf-8")).hexdigest()
+
+
+def process_and_upload_tables(
+    db,
+    watermarks,
+    client=None,
+    bucket_name=None,
+    stream=STREAM_EXTRACT,
+    workers=EXTRACT_WORKERS,
+    file_format=EXTRACT_FORMAT,
+    chunk_size=EXTRACT_CHUNK_SIZE,
+    out_of_time=None,
+    priority=(),
+    detect_deletes=DETECT_DELETES,
+    suppress_unchanged=SUPPRESS_UNCHANGED,
+    compression=EXTRACT_COMPRESSION,
+    schedule=None,
+    policies=None,
+):
+    """Describes the tables from the database catalog, probes them all for
+    new rows in one query and extracts the new rows of each changed table
+    with extract_table, as file_format objects in the extract bucket. Returns
+    the tables "updated" and with "no change". With a single worker the
+    tables are extracted one after another on db. With more, they are fanned
+    out over a thread pool, each worker borrowing a connection from a
+    ConnectionPool of the same size, so database reads for one table overlap
+    with S3 uploads for another. The time taken by each table is
+    recorded in seconds under "timings".
+    Every table is read inside a REPEATABLE READ transaction, and parallel
+    workers attach to the snapshot exported by db, so all tables in a run
+    reflect the same instant.
+    Tables in priority are extracted first. Once out_of_time returns True,
+    no further tables or chunks are started, and the tables left unfinished
+    are listed under "remaining".
+    With detect_deletes set, the same snapshot is then checked for deleted
+    rows with detect_deleted_rows, and the tables with deletes are listed
+    under "deleted". suppress_unchanged and compression are passed on to
+    extract_table.
+    Each table's policy from table_policy sets its priority, chunk size and
+    mode. With a schedule from read_schedule, only the tables that are due
+    are probed at all, and the schedule is updated in place for the tables
+    polled
+    """
+    load_status = {
+        "updated": [],
+        "no change": [],
+        "deleted": [],
+        "timings": {},
+        "remaining": [],
+    }
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+
+    with repeatable_read(db, export=workers > 1) as snapshot_id:
+        options = {
+            "stream": stream,
+            "file_format": file_format,
+            "chunk_size": chunk_size,
+            "out_of_time": out_of_time,
+            "suppress_unchanged": suppress_unchanged,
+            "compression": compression,
+        }
+        results = _extract_tables(
+            db,
+            watermarks,
+            client,
+            bucket_name,
+            workers,
+            snapshot_id,
+            options,
+            priority,
+            schedule,
+            policies,
+        )
+        if detect_deletes and not (out_of_time is not None and out_of_time()):
+            load_status["deleted"] = detect_deleted_rows(
+                db, describe_tables(db), bucket_name, client, file_format
+            )
+
+    for table_name, (result, seconds) in results.items():
+        if result == "partial":
+            load_status["updated"].append(table_name)
+            load_status["remaining"].append(table_name)
+        elif result == "deferred":
+            load_status["remaining"].append(table_name)
+            continue
+        elif result is not None:
+            load_status[result].append(table_name)
+        load_status["timings"][table_name] = seconds
+    logger.info(f"Extract timings (s): {load_status['timings']}")
     return load_status
 
 
+def _extract_tables(
+    db,
+    watermarks,
+    client,
+    bucket_name,
+    workers,
+    snapshot_id,
+    options,
+    priority,
+    schedule=None,
+    policies=None,
+):
+    """Extracts every table with new rows for process_and_upload_tables, passing
+    options on to extract_table, and returns a dictionary of table name to the
+    extract_table result and seconds taken. Tables the probe finds unchanged,
+    or that the schedule says are not due, are reported as "no change"
+    without being queried, and tables not started before
+    options["out_of_time"] returns True as "deferred"
+    """
+    out_of_time = options.get("out_of_time")
+    catalog = describe_tables(db)
+    now = datetime.today()
+    due = {
+        table_name: table
+        for table_name, table in catalog.items()
+        if schedule is None
+        or table_name in priority
+        or is_due(table_name, schedule, now)
+    }
+    changed = probe_changed_tables(db, due, watermarks)
+    logger.info(f"Tables with new rows: {', '.join(changed) or 'none'}")
+
+    def timed_extract(table_db, table_name):
+        if out_of_time is not None and out_of_time():
+            return "deferred", 0.0
+        policy = table_policy(table_name, policies)
+        table_options = dict(options)
+        watermark = watermarks.get(table_name, (DEFAULT_WATERMARK, None))
+        if policy["chunk_size"] is not None:
+            table_options["chunk_size"] = policy["chunk_size"]
+        if policy["mode"] == "snapshot":
+            watermark = (DEFAULT_WATERMARK, None)
+            table_options["suppress_unchanged"] = False
+        start = time.perf_counter()
+        result = extract_table(
+            table_db,
+            table_name,
+            catalog[table_name]["primary_key"],
+            watermark,
+            bucket_name,
+            client,
+            column_types=dict(catalog[table_name]["columns"]),
+            **table_options,
+        )
+        return result, round(time.perf_counter() - start, 3)
+
+    results = {}
+    for table_name in catalog:
+        if table_name not in due:
+            logger.info(f"Skipping {table_name}, not due to be polled")
+            results[table_name] = ("no change", 0.0)
+        elif table_name not in changed:
+            logger.info(f"No new data in {table_name}")
+            results[table_name] = ("no change", 0.0)
+    # stable sort, so the continuation comes first, then by policy priority
+    table_names = sorted(
+        changed,
+        key=lambda table_name: (
+            table_name not in priority,
+            table_policy(table_name, policies)["priority"],
+        ),
+    )
+    if table_names and workers <= 1:
+        results.update(
+            {table_name: timed_extract(db, table_name) for table_name in table_names}
+        )
+    elif table_names:
+        pool = ConnectionPool(min(workers, len(table_names)) or 1)
+
+        def pooled_extract(table_name):
+            with pool.connection() as table_db:
+                with repeatable_read(table_db, snapshot_id=snapshot_id):
+                    return timed_extract(table_db, table_name)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    table_name: executor.submit(pooled_extract, table_name)
+                    for table_name in table_names
+                }
+                results.update(
+                    {
+                        table_name: future.result()
+                        for table_name, future in futures.items()
+                    }
+                )
+        finally:
+            pool.close()
+
+    if schedule is not None:
+        for table_name in due:
+            result = results[table_name][0]
+            if result in ("updated", "no change", "partial"):
+                update_schedule(
+                    schedule, table_name, result != "no change", now, policies
+                )
+    return results
+
+
 if __name__ == "__main__":
     lambda_handler(None, None)
@@ -0,0 +1,445 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from botocore.exceptions import ClientError
+
+try:
+    from src.runtime_context import context as runtime
+    from src.extract_database import (
+        build_incremental_query,
+        build_upper_bound_query,
+        inline_parameters,
+    )
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+    from extract_database import (
+        build_incremental_query,
+        build_upper_bound_query,
+        inline_parameters,
+    )
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the parquet and arrow extract formats
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_PREFIX = "_watermarks"
+EXTRACT_FORMAT = os.environ.get("EXTRACT_FORMAT", "csv").lower()
+EXTRACT_FORMAT_EXTENSIONS = {"csv": "csv", "parquet": "parquet", "arrow": "arrow"}
+# CSV extracts are compressed whole, Parquet and Arrow compress their own buffers
+EXTRACT_COMPRESSION = os.environ.get("EXTRACT_COMPRESSION", "none").lower()
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+# S3 rejects multipart upload parts smaller than 5 MiB, other than the last
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+
+def extract_bucket(client=None):
+    """Returns the name of the extract bucket. Without a client, the name
+    is taken from the EXTRACT_BUCKET environment variable if set, or
+    discovered once and cached for the warm container
+    """
+    if client is None:
+        bucket_name = runtime.bucket("extract", "EXTRACT_BUCKET")
+        if bucket_name is None:
+            raise ValueError("No extract_bucket found")
+        return bucket_name
+    response = client.list_buckets()
+    extract_bucket_filter = [
+        bucket["Name"] for bucket in response["Buckets"] if "extract" in bucket["Name"]
+    ]
+
+    if not extract_bucket_filter:
+        raise ValueError("No extract_bucket found")
+
+    return extract_bucket_filter[0]
+
+
+def list_existing_s3_files(bucket_name=None, client=None):
+    """Creates a dictionary and populates it with the
+    key and last modified time of every object in the s3 bucket,
+    then returns the populated dictionary. Only object metadata is
+    listed, the file contents are never downloaded
+    """
+
+    logging.info("Listing existing S3 files")
+    existing_files = {}
+
+    try:
+        if bucket_name is None:
+            bucket_name = extract_bucket(client)
+        if client is None:
+            client = runtime.client("s3")
+
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name):
+            for obj in page.get("Contents", []):
+                existing_files[obj["Key"]] = obj["LastModified"]
+
+        if not existing_files:
+            logger.error("The bucket is empty")
+            return None
+
+    except ValueError as ve:
+        logger.error(f"Error listing S3 objects: {ve}")
+        raise
+    except ClientError as ce:
+        logger.error(f"Error listing S3 objects: {ce}")
+
+    return existing_files
+
+
+def get_latest_timestamp(existing_files):
+    if existing_files:
+        all_datetimes = []
+        for file_name in existing_files:
+            match = re.search(
+                r"\/(\d{4}/\d{2}/\d{2}/).+_(\d{2}:\d{2}:\d{2})", file_name
+            )
+            if match:
+                datetime_str = "".join(match.group(1, 2))
+                all_datetimes.append(
+                    datetime.strptime(datetime_str, "%Y/%m/%d/%H:%M:%S")
+                )
+        return max(all_datetimes) if all_datetimes else datetime.min
+
+    return existing_files
+
+
+def read_watermarks(bucket_name=None, client=None):
+    """Reads the watermark manifest from the extract bucket and returns a
+    dictionary of table name to a (last_updated, primary key) tuple for the
+    last row already extracted. The manifest holds one small object per table, so this costs one request
+    per table regardless of how many CSV files have been extracted. If no
+    manifest exists yet, the watermarks are bootstrapped from the timestamps
+    in the existing object keys, with no primary key
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+
+    watermarks = {}
+    try:
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=bucket_name, Prefix=f"{WATERMARK_PREFIX}/"
+        ):
+            for obj in page.get("Contents", []):
+                file_obj = client.get_object(Bucket=bucket_name, Key=obj["Key"])
+                record = json.loads(file_obj["Body"].read())
+                watermarks[record["table"]] = (
+                    datetime.fromisoformat(record["last_updated"]),
+                    record.get("pk"),
+                )
+    except ClientError as e:
+        logger.error(f"Error reading watermark manifest: {e}")
+        raise
+
+    if not watermarks:
+        logger.info("No watermark manifest found, bootstrapping from object keys")
+        existing_files = list_existing_s3_files(bucket_name, client) or {}
+        keys_by_table = {}
+        for s3_key in existing_files:
+            if s3_key.startswith("_"):
+                continue
+            keys_by_table.setdefault(s3_key.split("/")[0], []).append(s3_key)
+        for table_name, keys in keys_by_table.items():
+            latest = get_latest_timestamp(keys)
+            if latest != datetime.min:
+                watermarks[table_name] = (latest, None)
+
+    return watermarks
+
+
+def write_watermark(table_name, watermark, bucket_name=None, client=None):
+    """Persists the (last_updated, primary key) watermark for a single table.
+    Each table has its own manifest object, so a single put_object replaces
+    it atomically
+    """
+    if bucket_name is None:
+        bucket_name = extract_bucket(client)
+    if client is None:
+        client = runtime.client("s3")
+
+    last_updated, pk = watermark
+    record = {"table": table_name, "last_updated": last_updated.isoformat(), "pk": pk}
+    client.put_object(
+        Bucket=bucket_name,
+        Key=f"{WATERMARK_PREFIX}/{table_name}.json",
+        Body=json.dumps(record).encode("utf-8"),
+        ContentType="application/json",
+    )
+    logger.info(f"Watermark for {table_name} set to ({record['last_updated']}, {pk})")
+
+
+def extract_extension(file_format, compression=EXTRACT_COMPRESSION):
+    """Returns the object key extension for an extract, e.g. "csv.gz" for a
+    gzip compressed CSV. Only CSV extracts take the compression suffix
+    """
+    if file_format not in EXTRACT_FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown extract format: {file_format}")
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown extract compression: {compression}")
+    if compression == "zstd" and pa is None:
+        raise ValueError("pyarrow is required for zstd compression")
+    extension = EXTRACT_FORMAT_EXTENSIONS[file_format]
+    if file_format == "csv":
+        extension += COMPRESSION_SUFFIXES[compression]
+    return extension
+
+
+def key_compression(s3_key):
+    """Returns the compression of an extract object from its key suffix"""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and s3_key.endswith(suffix):
+            return compression
+    return "none"
+
+
+def _upload_args(s3_key):
+    compression = key_compression(s3_key)
+    args = {"ContentType": "text/csv"} if ".csv" in s3_key else {}
+    if compression != "none":
+        args["ContentEncoding"] = compression
+    return args
+
+
+def compress_bytes(data, compression):
+    """Compresses data as a single gzip member or zstd frame"""
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        return pa.compress(data, codec="zstd", asbytes=True)
+    return data
+
+
+def compressed_stream(raw, compression):
+    """Wraps the binary file-like object raw so everything written to it is
+    compressed on the way through. Closing a zstd stream also closes raw
+    """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb")
+    if compression == "zstd":
+        return pa.CompressedOutputStream(raw, "zstd")
+    return raw
+
+
+class S3MultipartWriter:
+    """Binary file-like object that uploads everything written to it to S3
+    as the parts of a multipart upload, holding at most one part in memory.
+    Content smaller than a single part is sent with one put_object instead.
+    extra_args, such as ContentEncoding, are set on the uploaded object
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket_name,
+        s3_key,
+        part_size=MULTIPART_PART_SIZE,
+        extra_args=None,
+    ):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.part_size = part_size
+        self.extra_args = extra_args or {}
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.s3_key, **self.extra_args
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.s3_key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.s3_key,
+                Body=bytes(self._buffer),
+                **self.extra_args,
+            )
+            self._buffer.clear()
+            return
+        if self._buffer:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.s3_key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        self.closed = True
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.s3_key, UploadId=self._upload_id
+            )
+        self._buffer.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def stream_table_to_s3(
+    db, table_name, primary_key, watermark, s3_key, bucket_name, client
+):
+    """Streams the rows of a table after its watermark straight from a
+    COPY ... TO STDOUT into an S3 multipart upload, so neither the result
+    set nor a temporary file is ever held in full. The COPY is bounded by
+    the last row found when the extract starts, which is returned as the
+    new watermark, or None if there are no new rows. The output is
+    compressed on the way through according to the suffix of s3_key
+    """
+    query, params = build_upper_bound_query(table_name, primary_key, watermark)
+    latest_row = db.run(query, **params)
+    if not latest_row:
+        return None
+    upper = (latest_row[0][0], latest_row[0][1] if primary_key else None)
+
+    query, params = build_incremental_query(table_name, primary_key, watermark, upper)
+    copy_query = f"""
+        COPY ({inline_parameters(query, params).strip().rstrip(';')})
+        TO STDOUT WITH (FORMAT csv, HEADER true);
+        """
+    with S3MultipartWriter(
+        client, bucket_name, s3_key, extra_args=_upload_args(s3_key)
+    ) as writer:
+        stream = compressed_stream(writer, key_compression(s3_key))
+        db.run(copy_query, stream=stream)
+        stream.close()
+    logger.info(f"Streamed {writer.bytes_written} bytes of {table_name} to S3.")
+    return upper
+
+
+def arrow_type(data_type):
+    """Maps an information_schema data type to the Arrow type it is written as.
+    numeric becomes float64 so it reads back as a plain float column, and
+    anything not listed is written as a string
+    """
+    if data_type in ("smallint",):
+        return pa.int16()
+    if data_type in ("integer",):
+        return pa.int32()
+    if data_type in ("bigint",):
+        return pa.int64()
+    if data_type in ("real",):
+        return pa.float32()
+    if data_type in ("numeric", "double precision", "money"):
+        return pa.float64()
+    if data_type == "boolean":
+        return pa.bool_()
+    if data_type == "date":
+        return pa.date32()
+    if data_type.startswith("time without"):
+        return pa.time64("us")
+    if data_type == "timestamp without time zone":
+        return pa.timestamp("us")
+    if data_type == "timestamp with time zone":
+        return pa.timestamp("us", tz="UTC")
+    if data_type == "bytea":
+        return pa.binary()
+    return pa.string()
+
+
+def rows_to_arrow_table(rows, column_names, column_types):
+    """Builds an Arrow table from the rows returned by pg8000, typing each column
+    from its catalog data type in column_types rather than inferring it
+    """
+    fields, arrays = [], []
+    for position, column_name in enumerate(column_names):
+        field_type = arrow_type(column_types.get(column_name, "text"))
+        values = [row[position] for row in rows]
+        if pa.types.is_floating(field_type):
+            values = [float(v) if isinstance(v, Decimal) else v for v in values]
+        elif pa.types.is_string(field_type):
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        fields.append(pa.field(column_name, field_type))
+        arrays.append(pa.array(values, type=field_type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def serialise_table(table, file_format):
+    """Serialises an Arrow table to zstd compressed Parquet or Arrow IPC bytes"""
+    sink = BytesIO()
+    if file_format == "parquet":
+        pq.write_table(table, sink, compression="zstd")
+    else:
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    return sink.getvalue()
+
+
+def upload_rows(
+    rows, column_names, s3_key, bucket_name, client, file_format, column_types=None
+):
+    """Writes rows to the extract bucket under s3_key, as a CSV file or, with
+    file_format "parquet" or "arrow", as a typed Arrow table using the catalog
+    data types in column_types. The object is built in memory, and a CSV is
+    compressed according to the suffix of s3_key and uploaded with the
+    matching Content-Encoding. Returns False if the upload failed
+    """
+    try:
+        if file_format != "csv":
+            table = rows_to_arrow_table(rows, column_names, column_types or {})
+            body = serialise_table(table, file_format)
+        else:
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(column_names)
+            writer.writerows(rows)
+            body = compress_bytes(
+                buffer.getvalue().encode("utf-8"), key_compression(s3_key)
+            )
+        client.put_object(
+            Bucket=bucket_name, Key=s3_key, Body=body, **_upload_args(s3_key)
+        )
+    except ClientError as e:
+        logger.error(f"Error uploading to S3: {e}")
+        return False
+    logger.info(f"Uploaded {s3_key} to S3.")
+    return True
@@ -1,4 +1,3 @@
-import boto3
 from botocore.exceptions import ClientError
 import pandas as pd
 import pyarrow.parquet as pq
@@ -6,9 +5,12 @@ from io import BytesIO
 import logging
 import json
 import traceback
-from sqlalchemy import create_engine
-from datetime import datetime as dt
-import re
+from sqlalchemy import bindparam, create_engine, text
+
+try:
+    from src.runtime_context import context as runtime
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +20,34 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M",
     level=logging.INFO,
 )
+# the slowly changing dimensions and their business keys. The transform
+# uploads only their new and changed versions, and a key's previous current
+# version is closed before the new one is appended
+SCD_KEYS = {
+    "dim_staff": "staff_id",
+    "dim_counterparty": "counterparty_id",
+    "dim_location": "location_id",
+    "dim_design": "design_id",
+    "dim_currency": "currency_id",
+}
+
+# the fingerprint of every file loaded, by S3 key. The transform stores a
+# fingerprint of each output's content in the object metadata, and a file
+# whose fingerprint matches the one recorded for its key is not loaded again.
+# Kept as JSON, which the transform bucket's notification does not fire on
+LOADED_KEY = "_state/loaded_fingerprints.json"
+FINGERPRINT_METADATA = "fingerprint"
+# tables the transform uploads a timestamped file of new rows for on each run,
+# each of which is appended once
+MUTABLE_TABLES = [
+    *SCD_KEYS,
+    "fact_sales_order",
+    "fact_purchase_order",
+    "fact_payment",
+    "dim_transaction",
+    "dim_date",
+]
+
 # logging.getLogger("botocore").setLevel(logging.INFO)
 # logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
 
@@ -38,6 +68,11 @@ def lambda_handler(event, context):
                     {uploaded_tables["uploaded"]} ."""
                 ),
             }
+        elif uploaded_tables.get("unchanged"):
+            return {
+                "statusCode": 200,
+                "body": json.dumps("No tables have changed since the last load."),
+            }
         else:
             logger.error(f"error", exc_info=True)
             return {"error"}
@@ -47,13 +82,11 @@ def lambda_handler(event, context):
 
 
 def retrieve_secrets(client=None, secret_name=None):
-    session = boto3.session.Session()
-    region_name = "eu-west-2"
-
     if secret_name == None:
         secret_name = "bentley-RDS-credentials"
     if client == None:
-        client = session.client(service_name="secretsmanager", region_name=region_name)
+        # cached across warm invocations and refreshed after SECRET_TTL_SECONDS
+        return runtime.secret(secret_name)
 
     try:
         get_secret_value_response = client.get_secret_value(SecretId=secret_name)
@@ -87,7 +120,7 @@ def connect_to_db_and_return_engine(sm_secret=None):
         database = secrets["database"]
         conn_str = f"postgresql+pg8000://{user}:{password}@{host}:{port}/{database}"
         # interface between python (pandas) and SQL
-        engine = create_engine(conn_str)
+        engine = create_engine(conn_str, pool_pre_ping=True)
         return engine
     except Exception as e:
         logger.error(f"Interface error: {e}", exc_info=True)
@@ -96,8 +129,20 @@ def connect_to_db_and_return_engine(sm_secret=None):
 
 # get transform bucket
 def get_transform_bucket(client=None):
+    """Returns the name of the transform bucket. Without a client, the name
+    is taken from the TRANSFORM_BUCKET environment variable if set, or
+    discovered once and cached for the warm container
+    """
     if client is None:
-        client = boto3.client("s3")
+        try:
+            bucket_name = runtime.bucket("transform", "TRANSFORM_BUCKET")
+        except ClientError as e:
+            logger.error(f"Error listing S3 buckets: {e}", exc_info=True)
+            raise RuntimeError("Error listing S3 buckets")
+        if bucket_name is None:
+            logger.error("No transform bucket found", exc_info=True)
+            raise ValueError("No transform bucket found")
+        return bucket_name
     try:
         response = client.list_buckets()
     except ClientError as e:
@@ -122,73 +167,113 @@ def get_transform_bucket(client=None):
 # return a dictionary of dataframes with name as key, and dataframe object as value
 
 
-def get_latest_timestamp(existing_files):
-    if existing_files:
-        all_datetimes = []
-        for file_name in existing_files:
-            match = re.search(r"\/(.+/).+_(.+)\.parquet", file_name)
-            if match:
-                datetime_str = "".join(match.group(1, 2))
-                all_datetimes.append(dt.strptime(datetime_str, "%Y/%m/%d/%H:%M:%S"))
-        return max(all_datetimes) if all_datetimes else dt.min
-    return existing_files
-
-
-def convert_parquet_files_to_dfs(bucket_name=None, client=None):
-    mutable_df_dict = [
-        "dim_currency",
-        "fact_sales_order",
-        "fact_purchase_order",
-        "fact_payment",
-    ]
+def read_loaded_fingerprints(bucket_name, client):
+    """Returns the record of the files already loaded, a dictionary of S3 key
+    to the fingerprint, or failing that the ETag, of the version loaded
+    """
+    try:
+        file_obj = client.get_object(Bucket=bucket_name, Key=LOADED_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}
+        raise
+    return json.loads(file_obj["Body"].read())
+
+
+def save_loaded_fingerprints(fingerprints, bucket_name=None, client=None):
+    """Saves the record of the files loaded, as filled in by
+    convert_parquet_files_to_dfs. Called once the load has been committed
+    """
+    if client is None:
+        client = runtime.client("s3")
+    if bucket_name is None:
+        bucket_name = get_transform_bucket()
+    client.put_object(
+        Bucket=bucket_name,
+        Key=LOADED_KEY,
+        Body=json.dumps(fingerprints),
+        ContentType="application/json",
+    )
+
 
+def convert_parquet_files_to_dfs(
+    bucket_name=None, client=None, fingerprints=None, unchanged=None
+):
+    """Reads the transform outputs not loaded yet into dataframes, keyed by
+    S3 key and in key order, so the timestamped files of a table come oldest
+    first. A file is picked by the first segment of its key: a root key
+    dim_x.parquet is an immutable output, reloaded only when its fingerprint
+    differs from the one last loaded, and a key under dim_x/ is one of the
+    timestamped outputs of a mutable table, each loaded exactly once.
+
+    The tables with nothing new are added to unchanged, if given.
+    fingerprints, if given, is filled with the record of loaded files as it
+    will stand once the dataframes are loaded, for save_loaded_fingerprints
+    """
     try:
         if client is None:
-            client = boto3.client("s3")
+            client = runtime.client("s3")
         if bucket_name is None:
             bucket_name = get_transform_bucket()
-        files = client.list_objects_v2(Bucket=bucket_name)
+        # keys starting with _ hold the lambdas' own state
+        files = {
+            file["Key"]: file["ETag"]
+            for page in client.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket_name
+            )
+            for file in page.get("Contents", [])
+            if not file["Key"].startswith("_")
+        }
 
         dfs = {}
-        if "Contents" in files:
-            s3_key_list = [file["Key"] for file in files["Contents"]]
-            immutables_l = []
-            mutables_d = {prefix: [] for prefix in mutable_df_dict}
-            for tab, s3_key in mutables_d.items():
-                for file in s3_key_list:
-                    if tab in file:
-                        s3_key.append(file)
-                    elif "2024" not in file:
-                        immutables_l.append(file)
-                    else:
-                        continue
-            immutables_l = list(set(immutables_l))
-            latest_s3_keys = []
-            for k, v in mutables_d.items():
-                latest_s3_keys.append(
-                    dt.strftime(
-                        get_latest_timestamp(v), f"{k}/%Y/%m/%d/{k}_%H:%M:%S.parquet"
-                    )
-                )
-            for file_key in immutables_l + latest_s3_keys:
-                try:
-                    file_obj = client.get_object(Bucket=bucket_name, Key=file_key)
-                    parquet_file = pq.ParquetFile(BytesIO(file_obj["Body"].read()))
-                    df = parquet_file.read().to_pandas()
-                    # >> can't do 'any' (default) because we lose rows in dim_location
-                    df_without_nulls = df.dropna(how="all")
-                    # print("df_without_nulls", df_without_nulls)
-                    # print("type", type(df_without_nulls))
-                    # print(df_without_nulls.columns)
-                    dfs[file_key] = df_without_nulls
-                except ClientError as e:
-                    logger.error(
-                        f"Unable to retrieve S3 object {file_key}: {e}", exc_info=True
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Unable to process file {file_key}: {e}", exc_info=True
-                    )
+        if files:
+            loaded = read_loaded_fingerprints(bucket_name, client)
+            record = {key: loaded[key] for key in files if key in loaded}
+            to_load = {}
+            for file_key in sorted(files):
+                table_name = file_key.split("/")[0]
+                if "/" not in file_key:
+                    to_load.setdefault(file_key.split(".")[0], []).append(file_key)
+                elif table_name in MUTABLE_TABLES and file_key not in loaded:
+                    to_load.setdefault(table_name, []).append(file_key)
+                elif table_name in MUTABLE_TABLES:
+                    to_load.setdefault(table_name, [])
+            for table_name, file_keys in to_load.items():
+                if not file_keys and unchanged is not None:
+                    unchanged.append(table_name)
+                for file_key in file_keys:
+                    try:
+                        file_obj = client.get_object(
+                            Bucket=bucket_name, Key=file_key
+                        )
+                        version = file_obj.get("Metadata", {}).get(
+                            FINGERPRINT_METADATA, files[file_key]
+                        )
+                        if loaded.get(file_key) == version:
+                            logger.info(f"{file_key} has already been loaded")
+                            file_obj["Body"].close()
+                            if unchanged is not None:
+                                unchanged.append(table_name)
+                            continue
+                        parquet_file = pq.ParquetFile(
+                            BytesIO(file_obj["Body"].read())
+                        )
+                        df = parquet_file.read().to_pandas()
+                        # >> can't do 'any' (default) because we lose rows in dim_location
+                        df_without_nulls = df.dropna(how="all")
+                        dfs[file_key] = df_without_nulls
+                        record[file_key] = version
+                    except ClientError as e:
+                        logger.error(
+                            f"Unable to retrieve S3 object {file_key}: {e}",
+                            exc_info=True,
+                        )
+                    except Exception as e:
+                        logger.error(
+                            f"Unable to process file {file_key}: {e}", exc_info=True
+                        )
+            if fingerprints is not None:
+                fingerprints.update(record)
         else:
             logger.error(f"No files found in {bucket_name}.", exc_info=True)
             return {}
@@ -198,28 +283,30 @@ def convert_parquet_files_to_dfs(bucket_name=None, client=None):
     except ClientError as client_error:
         logger.error(f"Unable to list objects: {client_error}", exc_info=True)
         raise
-    return dfs
+    return dict(sorted(dfs.items()))
 
 
-def upload_dfs_to_database():
-    upload_status = {"uploaded": [], "not_uploaded": []}
-    dict_of_dfs = convert_parquet_files_to_dfs()
-    db_engine = connect_to_db_and_return_engine()
+def upload_dfs_to_database(bucket_name=None, client=None):
+    """Appends the transform outputs not loaded yet to the warehouse, in the
+    key order of convert_parquet_files_to_dfs, so versions of a slowly
+    changing dimension are applied oldest first
+    """
+    upload_status = {"uploaded": [], "not_uploaded": [], "unchanged": []}
+    fingerprints = {}
+    dict_of_dfs = convert_parquet_files_to_dfs(
+        bucket_name,
+        client,
+        fingerprints=fingerprints,
+        unchanged=upload_status["unchanged"],
+    )
+    # the engine's pool pings connections before use, so it is safe to keep
+    # between warm invocations rather than disposing of it every time
+    db_engine = runtime.connection(
+        "warehouse", connect_to_db_and_return_engine, is_healthy=lambda engine: True
+    )
     immutable_df_dict = [
-        "dim_counterparty.parquet",
-        "dim_date.parquet",  # this needs to be mutable
-        "dim_location.parquet",
-        "dim_staff.parquet",
-        "dim_design.parquet",
-        "dim_transaction.parquet",  # This one was missing,
         "dim_payment_type.parquet",
     ]
-    mutable_df_dict = [
-        "dim_currency",
-        "fact_sales_order",
-        "fact_purchase_order",
-        "fact_payment",
-    ]
     with db_engine.begin() as connection:
         for file_name, df in dict_of_dfs.items():
             print(df.dtypes, "dtypes")
@@ -245,10 +332,12 @@ def upload_dfs_to_database():
                         exc_info=True,
                     )
                     raise
-            elif file_name.split("/")[0] in mutable_df_dict:
+            elif file_name.split("/")[0] in MUTABLE_TABLES:
                 table_name = file_name.split("/")[0]
                 print(table_name, "<<<<<<<TABLE NAME")
                 try:
+                    if table_name in SCD_KEYS:
+                        df = close_current_versions(connection, table_name, df)
                     df.to_sql(
                         table_name,
                         con=connection,
@@ -270,9 +359,34 @@ def upload_dfs_to_database():
                     exc_info=True,
                 )
             print(upload_status)
-    db_engine.dispose()
+    # only saved when something new was loaded, so an invocation with
+    # nothing to load writes nothing
+    if dict_of_dfs and fingerprints:
+        save_loaded_fingerprints(fingerprints, bucket_name, client)
     return upload_status
 
 
+def close_current_versions(connection, table_name, df):
+    """Closes the current version of every key with a row in df, a batch of
+    versions of a slowly changing dimension, and returns the rows of df to
+    append, its new current versions. The rows that only close a key are
+    not appended
+    """
+    key = SCD_KEYS[table_name]
+    keys = [int(value) for value in df[key].dropna().unique()]
+    if keys:
+        # every row of a batch carries the time of the run that wrote it
+        closed_at = pd.concat([df["valid_from"], df["valid_to"]]).max()
+        connection.execute(
+            text(
+                f"UPDATE project_team_2.{table_name} "
+                "SET valid_to = :closed_at, is_current = false "
+                f"WHERE is_current AND {key} IN :keys"
+            ).bindparams(bindparam("keys", expanding=True)),
+            {"closed_at": closed_at.to_pydatetime(), "keys": keys},
+        )
+    return df[df["is_current"].astype(bool)]
+
+
 if __name__ == "__main__":
     lambda_handler(None, None)
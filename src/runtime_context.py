@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+REGION_NAME = "eu-west-2"
+SECRET_TTL_SECONDS = int(os.environ.get("SECRET_TTL_SECONDS", "300"))
+
+
+def ping(db):
+    """Default health check for a cached pg8000 connection"""
+    db.run("SELECT 1;")
+    return True
+
+
+class RuntimeContext:
+    """Holds the resources every lambda invocation needs - boto3 clients,
+    secrets, bucket names and database connections - at module level, so
+    a warm Lambda container resolves each of them once instead of on every
+    invocation. Secrets are refreshed after secret_ttl seconds, connections
+    are health checked before they are handed out again, and a bucket can
+    be named outright with an environment variable to skip discovery
+    """
+
+    def __init__(self, secret_ttl=SECRET_TTL_SECONDS, clock=time.monotonic):
+        self.secret_ttl = secret_ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._secrets = {}
+        self._buckets = {}
+        self._connections = {}
+
+    def client(self, service_name):
+        """Returns a boto3 client for service_name, created once per container"""
+        with self._lock:
+            if service_name not in self._clients:
+                self._clients[service_name] = boto3.client(
+                    service_name, region_name=REGION_NAME
+                )
+            return self._clients[service_name]
+
+    def secret(self, secret_name):
+        """Returns the SecretString of secret_name from Secrets Manager, only
+        fetching it again once the cached value is older than secret_ttl
+        """
+        with self._lock:
+            cached = self._secrets.get(secret_name)
+            if cached is not None and self._clock() - cached[1] < self.secret_ttl:
+                return cached[0]
+
+        try:
+            response = self.client("secretsmanager").get_secret_value(
+                SecretId=secret_name
+            )
+            secret_string = response["SecretString"]
+        except ClientError as e:
+            logger.error(f"Failed to retrieve secret {secret_name}: {str(e)}")
+            raise e
+        except KeyError:
+            logger.error(f"Secret {secret_name} does not contain a SecretString")
+            raise ValueError(f"Secret {secret_name} does not contain a SecretString")
+
+        with self._lock:
+            self._secrets[secret_name] = (secret_string, self._clock())
+        return secret_string
+
+    def bucket(self, keyword, override_env=None):
+        """Returns the name of the first bucket containing keyword, or None if
+        there is no such bucket. If override_env names a set environment
+        variable, its value is returned without listing any buckets
+        """
+        if override_env and os.environ.get(override_env):
+            return os.environ[override_env]
+
+        with self._lock:
+            if keyword in self._buckets:
+                return self._buckets[keyword]
+
+        response = self.client("s3").list_buckets()
+        bucket_filter = [
+            bucket["Name"] for bucket in response["Buckets"] if keyword in bucket["Name"]
+        ]
+        if not bucket_filter:
+            return None
+
+        with self._lock:
+            self._buckets[keyword] = bucket_filter[0]
+        return bucket_filter[0]
+
+    def connection(self, name, connect, is_healthy=ping):
+        """Returns the cached connection called name if it passes is_healthy,
+        otherwise closes it and caches a new one opened with connect
+        """
+        with self._lock:
+            db = self._connections.get(name)
+            if db is not None:
+                try:
+                    healthy = is_healthy(db)
+                except Exception as e:
+                    logger.warning(f"Cached connection {name} failed health check: {e}")
+                    healthy = False
+                if healthy:
+                    return db
+                self._close(name)
+
+            db = connect()
+            self._connections[name] = db
+            return db
+
+    def discard_connection(self, name):
+        """Closes and forgets the connection called name, e.g. after an error
+        has left it in an unknown state
+        """
+        with self._lock:
+            self._close(name)
+
+    def _close(self, name):
+        db = self._connections.pop(name, None)
+        if db is None:
+            return
+        try:
+            if hasattr(db, "close"):
+                db.close()
+            else:
+                db.dispose()
+        except Exception as e:
+            logger.warning(f"Error closing connection {name}: {e}")
+
+    def reset(self):
+        """Closes every connection and forgets everything cached"""
+        with self._lock:
+            for name in list(self._connections):
+                self._close(name)
+            self._clients.clear()
+            self._secrets.clear()
+            self._buckets.clear()
+
+
+context = RuntimeContext()
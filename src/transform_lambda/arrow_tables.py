@@ -0,0 +1,279 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from src.transform_lambda.dataframes import currency_names
+except ImportError:  # packaged alongside this module in the lambda zip
+    from dataframes import currency_names
+
+# The star schema built with pyarrow.compute and Table.join straight from the
+# Arrow tables read from the lake. Each create_* function mirrors the pandas
+# builder of the same name in dataframes.py, producing the same columns in
+# the same order, and check_equivalent compares the two engines' outputs
+
+AUDIT_COLUMNS = ["created_at", "last_updated"]
+ROW_COLUMN = "__row"
+
+
+def split_timestamp(timestamps):
+    """Returns the date32 and second-truncated time64 parts of a timestamp
+    column
+    """
+    dates = pc.cast(timestamps, pa.date32())
+    times = pc.cast(pc.floor_temporal(timestamps, unit="second"), pa.time64("us"))
+    return dates, times
+
+
+def _record_ids(table):
+    return pa.array(range(1, table.num_rows + 1), pa.int64())
+
+
+def _build_fact(table, record_id, columns, renames=None):
+    """Selects columns from table, with the audit timestamps split into
+    their date and time parts, numbers the rows from 1 as record_id and
+    drops any row with a null, like the pandas facts
+    """
+    table = table.rename_columns(
+        [(renames or {}).get(name, name) for name in table.column_names]
+    )
+    created_date, created_time = split_timestamp(table.column("created_at"))
+    updated_date, updated_time = split_timestamp(table.column("last_updated"))
+    derived = {
+        "created_date": created_date,
+        "created_time": created_time,
+        "last_updated_date": updated_date,
+        "last_updated_time": updated_time,
+    }
+    arrays = [_record_ids(table)] + [
+        derived[name] if name in derived else table.column(name) for name in columns
+    ]
+    return pa.table(arrays, names=[record_id] + columns).drop_null()
+
+
+def _decode(table):
+    """Replaces dictionary columns with their values, for use as join keys"""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(
+                i, field.name, pc.cast(table.column(i), field.type.value_type)
+            )
+    return table
+
+
+def _join(left, right, left_key, right_key, join_type):
+    """Joins right onto left, keeping the rows in left's order as pandas
+    merges do, and dropping right's key column
+    """
+    left = _decode(left).append_column(
+        ROW_COLUMN, pa.array(range(left.num_rows), pa.int64())
+    )
+    right = _decode(right)
+    key_type = left.schema.field(left_key).type
+    if right.schema.field(right_key).type != key_type:
+        index = right.schema.get_field_index(right_key)
+        right = right.set_column(
+            index, right_key, pc.cast(right.column(index), key_type)
+        )
+    joined = left.join(
+        right, keys=left_key, right_keys=right_key, join_type=join_type
+    )
+    joined = joined.sort_by(ROW_COLUMN).drop_columns([ROW_COLUMN])
+    if right_key != left_key and right_key in joined.column_names:
+        joined = joined.drop_columns([right_key])
+    return joined
+
+
+def create_fact_sales_order(tables):
+    return _build_fact(
+        tables["sales_order"],
+        "sales_record_id",
+        [
+            "sales_order_id",
+            "created_date",
+            "created_time",
+            "last_updated_date",
+            "last_updated_time",
+            "sales_staff_id",
+            "counterparty_id",
+            "units_sold",
+            "unit_price",
+            "currency_id",
+            "design_id",
+            "agreed_payment_date",
+            "agreed_delivery_date",
+            "agreed_delivery_location_id",
+        ],
+        renames={"staff_id": "sales_staff_id"},
+    )
+
+
+def create_fact_purchase_orders(tables):
+    return _build_fact(
+        tables["purchase_order"],
+        "purchase_record_id",
+        [
+            "purchase_order_id",
+            "created_date",
+            "created_time",
+            "last_updated_date",
+            "last_updated_time",
+            "staff_id",
+            "counterparty_id",
+            "item_code",
+            "item_quantity",
+            "item_unit_price",
+            "currency_id",
+            "agreed_delivery_date",
+            "agreed_payment_date",
+            "agreed_delivery_location_id",
+        ],
+    )
+
+
+def create_fact_payment(tables):
+    return _build_fact(
+        tables["payment"],
+        "payment_record_id",
+        [
+            "payment_id",
+            "created_date",
+            "created_time",
+            "last_updated_date",
+            "last_updated_time",
+            "transaction_id",
+            "counterparty_id",
+            "payment_amount",
+            "currency_id",
+            "payment_type_id",
+            "paid",
+            "payment_date",
+        ],
+    )
+
+
+def create_dim_transaction(tables):
+    return tables["transaction"].select(
+        ["transaction_id", "transaction_type", "sales_order_id", "purchase_order_id"]
+    )
+
+
+def create_dim_location(tables):
+    address = tables["address"].drop_columns(AUDIT_COLUMNS)
+    return address.rename_columns(
+        [
+            "location_id" if name == "address_id" else name
+            for name in address.column_names
+        ]
+    )
+
+
+def create_dim_counterparty(tables):
+    address = tables["address"].drop_columns(AUDIT_COLUMNS)
+    address = address.rename_columns(
+        [
+            "counterparty_legal_" + ("phone_number" if name == "phone" else name)
+            for name in address.column_names
+        ]
+    )
+    joined = _join(
+        tables["counterparty"],
+        address,
+        "legal_address_id",
+        "counterparty_legal_address_id",
+        "inner",
+    )
+    return joined.drop_columns(
+        [
+            "legal_address_id",
+            "created_at",
+            "last_updated",
+            "commercial_contact",
+            "delivery_contact",
+        ]
+    )
+
+
+def create_dim_date(tables):
+    # built from the fact tables themselves, of which an incremental run only
+    # has the ones with new rows
+    date_columns = [
+        chunk
+        for table_name in ("fact_payment", "fact_purchase_order", "fact_sales_order")
+        if table_name in tables
+        for name in tables[table_name].column_names
+        if "_date" in name
+        for chunk in pc.cast(
+            tables[table_name].column(name), pa.timestamp("ns")
+        ).chunks
+    ]
+    date_id = pc.unique(pa.chunked_array(date_columns, pa.timestamp("ns")))
+    return pa.table(
+        {
+            "date_id": date_id,
+            "year": pc.year(date_id),
+            "month": pc.month(date_id),
+            "day": pc.day(date_id),
+            "day_of_week": pc.day_of_week(date_id),
+            "day_name": pc.strftime(date_id, "%A"),
+            "month_name": pc.strftime(date_id, "%B"),
+            "quarter": pc.quarter(date_id),
+        }
+    )
+
+
+def create_dim_currency(tables):
+    currency = tables["currency"].drop_columns(AUDIT_COLUMNS)
+    names = tables.get("currency_names")
+    if names is None:
+        names = currency_names()
+    if not isinstance(names, pa.Table):
+        names = pa.Table.from_pandas(names, preserve_index=False)
+    return _join(currency, names, "currency_code", "currency_code", "left outer")
+
+
+def create_dim_payment_type(tables):
+    return tables["payment_type"].select(["payment_type_id", "payment_type_name"])
+
+
+def create_dim_design(tables):
+    return tables["design"].select(
+        ["design_id", "design_name", "file_name", "file_location"]
+    )
+
+
+def create_dim_staff(tables):
+    joined = _join(
+        tables["staff"],
+        tables["department"],
+        "department_id",
+        "department_id",
+        "left outer",
+    )
+    return joined.select(
+        [
+            "staff_id",
+            "first_name",
+            "last_name",
+            "department_name",
+            "location",
+            "email_address",
+        ]
+    )
+
+
+def check_equivalent(pandas_result, arrow_result):
+    """Returns a list of the differences between a pandas builder's output
+    and the Arrow builder's output for the same table, comparing column
+    names and then each column's values row by row. An empty list means the
+    two engines agree
+    """
+    expected = pa.Table.from_pandas(pandas_result, preserve_index=False)
+    if expected.column_names != arrow_result.column_names:
+        return [f"columns {expected.column_names} != {arrow_result.column_names}"]
+    if expected.num_rows != arrow_result.num_rows:
+        return [f"{expected.num_rows} rows != {arrow_result.num_rows} rows"]
+    return [
+        f"column {name} differs"
+        for name in expected.column_names
+        if expected.column(name).to_pylist() != arrow_result.column(name).to_pylist()
+    ]
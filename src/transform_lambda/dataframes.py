@@ -1,6 +1,15 @@
+from functools import lru_cache
+from pathlib import Path
+
 import pandas as pd
-from bs4 import BeautifulSoup
-import requests
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# ISO 4217 currency names shipped with the package, see currency_names()
+CURRENCY_NAMES_FILE = Path(__file__).with_name("currency_names.csv")
+
+DATE_TYPE = pd.ArrowDtype(pa.date32())
+TIME_TYPE = pd.ArrowDtype(pa.time64("us"))
 
 # Table names:
 # fact_sales_order
@@ -16,25 +25,29 @@ import requests
 # dim_counterparty
 
 
+def split_timestamp(timestamps):
+    """Splits a timestamp column into a date32 column and a time64 column
+    truncated to the second, computed with Arrow kernels over the whole
+    column instead of one Python date and time object per row
+    """
+    arrow = pa.array(timestamps)
+    dates = pc.cast(arrow, pa.date32())
+    times = pc.cast(pc.floor_temporal(arrow, unit="second"), pa.time64("us"))
+    return (
+        pd.Series(dates, index=timestamps.index, dtype=DATE_TYPE),
+        pd.Series(times, index=timestamps.index, dtype=TIME_TYPE),
+    )
+
+
 # no test, same as fact_payment
 def create_fact_sales_order(dict_of_df):
     df_sales = dict_of_df["sales_order"].rename(columns={"staff_id": "sales_staff_id"})
 
-    df_sales["created_date"] = df_sales["created_at"].astype("datetime64[ns]").dt.date
-    df_sales["created_time"] = (
-        df_sales["created_at"].astype("datetime64[ns]").dt.floor("s").dt.time
-    )
-    df_sales["last_updated_date"] = (
-        df_sales["last_updated"].astype("datetime64[ns]").dt.date
-    )
-    df_sales["last_updated_time"] = (
-        df_sales["last_updated"].astype("datetime64[ns]").dt.floor("s").dt.time
+    df_sales["created_date"], df_sales["created_time"] = split_timestamp(
+        df_sales["created_at"]
     )
-    df_sales["agreed_delivery_date"] = pd.to_datetime(
-        df_sales["agreed_delivery_date"], format="%Y-%m-%d"
-    )
-    df_sales["agreed_payment_date"] = pd.to_datetime(
-        df_sales["agreed_payment_date"], format="%Y-%m-%d"
+    df_sales["last_updated_date"], df_sales["last_updated_time"] = split_timestamp(
+        df_sales["last_updated"]
     )
     fact_sales = df_sales.loc[
         :,
@@ -55,7 +68,6 @@ def create_fact_sales_order(dict_of_df):
             "agreed_delivery_location_id",
         ],
     ]
-    fact_sales.convert_dtypes()
     fact_sales.index = pd.RangeIndex(1, len(fact_sales.index) + 1)
     fact_sales.index.name = "sales_record_id"
     fact_sales.reset_index(inplace=True)
@@ -67,20 +79,13 @@ def create_fact_sales_order(dict_of_df):
 
 
 def create_fact_purchase_orders(dict_of_df):
-    df_po = dict_of_df["purchase_order"]
-    df_po["created_date"] = df_po["created_at"].astype("datetime64[ns]").dt.date
-    df_po["created_time"] = (
-        df_po["created_at"].astype("datetime64[ns]").dt.floor("s").dt.time
-    )
-    df_po["last_updated_date"] = df_po["last_updated"].astype("datetime64[ns]").dt.date
-    df_po["last_updated_time"] = (
-        df_po["last_updated"].astype("datetime64[ns]").dt.floor("s").dt.time
+    # a shallow copy, so the new columns are not added to the shared input
+    df_po = dict_of_df["purchase_order"].copy(deep=False)
+    df_po["created_date"], df_po["created_time"] = split_timestamp(
+        df_po["created_at"]
     )
-    df_po["agreed_delivery_date"] = pd.to_datetime(
-        df_po["agreed_delivery_date"], format="%Y-%m-%d"
-    )
-    df_po["agreed_payment_date"] = pd.to_datetime(
-        df_po["agreed_payment_date"], format="%Y-%m-%d"
+    df_po["last_updated_date"], df_po["last_updated_time"] = split_timestamp(
+        df_po["last_updated"]
     )
     fact_purchase_order = df_po.loc[
         :,
@@ -101,7 +106,6 @@ def create_fact_purchase_orders(dict_of_df):
             "agreed_delivery_location_id",
         ],
     ]
-    fact_purchase_order.convert_dtypes()
     fact_purchase_order.index = pd.RangeIndex(1, len(fact_purchase_order.index) + 1)
     fact_purchase_order.index.name = "purchase_record_id"
     fact_purchase_order.reset_index(inplace=True)
@@ -113,21 +117,12 @@ def create_fact_purchase_orders(dict_of_df):
 
 
 def create_fact_payment(dict_of_df):
-    df_payment = dict_of_df["payment"]
-    df_payment["created_date"] = (
-        df_payment["created_at"].astype("datetime64[ns]").dt.date
-    )
-    df_payment["created_time"] = (
-        df_payment["created_at"].astype("datetime64[ns]").dt.floor("s").dt.time
+    df_payment = dict_of_df["payment"].copy(deep=False)
+    df_payment["created_date"], df_payment["created_time"] = split_timestamp(
+        df_payment["created_at"]
     )
-    df_payment["last_updated_date"] = (
-        df_payment["last_updated"].astype("datetime64[ns]").dt.date
-    )
-    df_payment["last_updated_time"] = (
-        df_payment["last_updated"].astype("datetime64[ns]").dt.floor("s").dt.time
-    )
-    df_payment["payment_date"] = pd.to_datetime(
-        df_payment["payment_date"], format="%Y-%m-%d"
+    df_payment["last_updated_date"], df_payment["last_updated_time"] = split_timestamp(
+        df_payment["last_updated"]
     )
     fact_payment = df_payment.loc[
         :,
@@ -146,12 +141,10 @@ def create_fact_payment(dict_of_df):
             "payment_date",
         ],
     ]
-    fact_payment.convert_dtypes()
     fact_payment.index = pd.RangeIndex(1, len(fact_payment.index) + 1)
     fact_payment.index.name = "payment_record_id"
     fact_payment.reset_index(inplace=True)
     fact_payment.dropna(inplace=True)
-    fact_payment = fact_payment.astype({"currency_id": "int", "payment_id": "int"})
     return fact_payment
 
 
@@ -162,7 +155,6 @@ def create_dim_transaction(dict_of_df):
     dim_transaction = dict_of_df["transaction"].loc[
         :, ["transaction_id", "transaction_type", "sales_order_id", "purchase_order_id"]
     ]
-    # dim_transaction = dim_transaction.astype({"sales_order_id":"Int64","purchase_order_id":"Int64"})
     return dim_transaction
 
 
@@ -210,10 +202,12 @@ def create_dim_counterparty(dict_of_df):
 
 
 def create_dim_date(dict_of_df):
+    # built from the fact tables themselves, of which an incremental run only
+    # has the ones with new rows
     fact_dfs = [
-        create_fact_payment(dict_of_df),
-        create_fact_purchase_orders(dict_of_df),
-        create_fact_sales_order(dict_of_df),
+        dict_of_df[table]
+        for table in ("fact_payment", "fact_purchase_order", "fact_sales_order")
+        if table in dict_of_df
     ]
     list_of_date_columns = []
     for df in fact_dfs:
@@ -239,23 +233,23 @@ def create_dim_date(dict_of_df):
 # tests passed
 
 
-def scrape_currency_names():
-    response = requests.get("https://www.xe.com/currency/").content
-    soup = BeautifulSoup(response, "html.parser")
-    currency = [
-        item.text for item in soup.findAll("a", attrs={"class": "sc-299dec64-6 fZPTSw"})
-    ]
-    sr = pd.Series(currency)
-    df_cur = sr.str.split(pat=" - ", expand=True).rename(
-        {0: "currency_code", 1: "currency_name"}, axis=1
-    )
-    return df_cur
+@lru_cache(maxsize=None)
+def currency_names(path=CURRENCY_NAMES_FILE):
+    """Returns the bundled ISO 4217 currency codes and names, read on first
+    use. keep_default_na stops NAD, the Namibia Dollar, reading as missing
+    """
+    return pd.read_csv(path, keep_default_na=False)
 
 
 # tests passed
 
 
-def create_dim_currency(dict_of_df, names=scrape_currency_names()):
+def create_dim_currency(dict_of_df, names=None):
+    if names is None:
+        # a refreshed copy from S3 when the transform lambda has one
+        names = dict_of_df.get("currency_names")
+    if names is None:
+        names = currency_names()
     df_cur = dict_of_df["currency"].drop(labels=["created_at", "last_updated"], axis=1)
     dim_currency = pd.merge(
         df_cur, names, left_on="currency_code", right_on="currency_code", how="left"
@@ -0,0 +1,107 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+
+class TransformGraph:
+    """Declares the transform's create_* builders as nodes of a dependency
+    graph. Each node is a (build, inputs) pair, where inputs name other nodes
+    or source tables, and build is called with a read-only mapping of the
+    inputs that are available. A run builds every node its targets need
+    exactly once and shares the result with each node depending on it, so
+    e.g. dim_date reuses the fact tables instead of building them again.
+    Nodes whose inputs are ready run concurrently
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+
+        def visit(name, path):
+            if name in visited or name not in self.nodes:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle in transform graph: {' -> '.join(path)}")
+            visiting.add(name)
+            for input_name in self.nodes[name][1]:
+                visit(input_name, path + [input_name])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.nodes:
+            visit(name, [name])
+
+    def sources_of(self, name):
+        """Returns the source tables name is built from, directly or through
+        other nodes
+        """
+        sources = set()
+        for input_name in self.nodes[name][1]:
+            if input_name in self.nodes:
+                sources |= self.sources_of(input_name)
+            else:
+                sources.add(input_name)
+        return sources
+
+    def _required(self, targets):
+        required = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name in required:
+                continue
+            required.add(name)
+            stack.extend(i for i in self.nodes[name][1] if i in self.nodes)
+        return required
+
+    def run(self, sources, targets, workers=4):
+        """Builds targets from the source dataframes in sources. A node with
+        none of its inputs available is skipped, and so left out of the
+        results. Returns the built targets and the seconds each node took
+        """
+        pending = self._required(targets)
+        results, timings, finished = {}, {}, set()
+
+        def build(name, available):
+            start = time.monotonic()
+            result = self.nodes[name][0](MappingProxyType(available))
+            return result, time.monotonic() - start
+
+        def ready(name):
+            return all(
+                input_name in finished
+                for input_name in self.nodes[name][1]
+                if input_name in self.nodes
+            )
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for name in sorted(filter(ready, pending)):
+                    pending.discard(name)
+                    inputs = self.nodes[name][1]
+                    available = {
+                        i: results[i] if i in self.nodes else sources[i]
+                        for i in inputs
+                        if i in results or (i not in self.nodes and i in sources)
+                    }
+                    if not available:
+                        logger.info(f"Skipping {name}, none of {inputs} available")
+                        finished.add(name)
+                        continue
+                    running[executor.submit(build, name, available)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], timings[name] = future.result()
+                    finished.add(name)
+                    logger.info(f"Built {name} in {timings[name]:.3f}s")
+        return {name: results[name] for name in targets if name in results}, timings
@@ -0,0 +1,112 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Dimensions kept as slowly changing (type 2) history in the warehouse. Each
+# run hashes every row of a freshly built dimension, compares the hashes with
+# a snapshot of the current version of each business key, and emits only the
+# versions that are new or changed, plus a closing row for each key that has
+# gone, instead of the whole dimension
+
+SCD_KEYS = {
+    "dim_staff": "staff_id",
+    "dim_counterparty": "counterparty_id",
+    "dim_location": "location_id",
+    "dim_design": "design_id",
+    "dim_currency": "currency_id",
+}
+TIMESTAMP = pa.timestamp("us")
+ROW_COLUMN = "__row"
+
+
+def row_hashes(table, key=None):
+    """Returns a uint64 hash of each row of table over every column but key.
+    Columns are cast to strings first, so a row hashes the same whichever
+    engine built it
+    """
+    columns = {}
+    for name in table.column_names:
+        if name == key:
+            continue
+        column = table.column(name)
+        if pa.types.is_dictionary(column.type):
+            column = pc.cast(column, column.type.value_type)
+        columns[name] = pc.cast(column, pa.string())
+    canonical = pa.table(columns).to_pandas()
+    hashes = pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+    return pa.array(hashes, pa.uint64())
+
+
+def empty_snapshot(key_type):
+    return pa.table(
+        {
+            "key": pa.array([], key_type),
+            "row_hash": pa.array([], pa.uint64()),
+            "valid_from": pa.array([], TIMESTAMP),
+        }
+    )
+
+
+def scd_versions(table, key, snapshot, now):
+    """Compares a dimension built this run with the snapshot of its current
+    versions, an Arrow table of key, row_hash and valid_from. Returns the
+    versions to append to the dimension, with valid_from, valid_to and
+    is_current columns, or None if nothing changed, and the new snapshot.
+
+    A new or changed row becomes a current version valid from now. A key
+    missing from table gets a closing row holding only the key, valid_to now
+    and is_current false
+    """
+    key_type = table.schema.field(key).type
+    current = pa.table(
+        {
+            "key": table.column(key),
+            "row_hash": row_hashes(table, key),
+            ROW_COLUMN: pa.array(range(table.num_rows), pa.int64()),
+        }
+    )
+    if snapshot is None:
+        snapshot = empty_snapshot(key_type)
+    snapshot = snapshot.set_column(0, "key", pc.cast(snapshot.column("key"), key_type))
+    previous = snapshot.rename_columns(["key", "previous_hash", "previous_from"])
+
+    joined = current.join(previous, keys="key", join_type="left outer")
+    joined = joined.sort_by(ROW_COLUMN)
+    changed = pc.fill_null(
+        pc.not_equal(joined.column("row_hash"), joined.column("previous_hash")),
+        True,
+    )
+    deleted = snapshot.join(current, keys="key", join_type="left anti")
+
+    now = pa.scalar(now, TIMESTAMP)
+    new_snapshot = pa.table(
+        {
+            "key": joined.column("key"),
+            "row_hash": joined.column("row_hash"),
+            "valid_from": pc.if_else(changed, now, joined.column("previous_from")),
+        }
+    )
+    rows = pc.filter(joined.column(ROW_COLUMN), changed)
+    if len(rows) == 0 and deleted.num_rows == 0:
+        return None, snapshot
+
+    stamps = pa.array([now.as_py()] * len(rows), TIMESTAMP)
+    versions = table.take(rows)
+    versions = versions.append_column("valid_from", stamps)
+    versions = versions.append_column("valid_to", pa.nulls(len(rows), TIMESTAMP))
+    versions = versions.append_column(
+        "is_current", pa.array([True] * len(rows), pa.bool_())
+    )
+    closing = {
+        key: deleted.column("key"),
+        "valid_to": pa.array([now.as_py()] * deleted.num_rows, TIMESTAMP),
+        "is_current": pa.array([False] * deleted.num_rows, pa.bool_()),
+    }
+    closed = pa.table(
+        [
+            closing.get(field.name, pa.nulls(deleted.num_rows, field.type))
+            for field in versions.schema
+        ],
+        schema=versions.schema,
+    )
+    return pa.concat_tables([versions, closed]), new_snapshot
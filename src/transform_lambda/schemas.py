@@ -0,0 +1,149 @@
+import pyarrow as pa
+
+# Arrow types of the totesys source tables, applied when the extracts are read
+# so nothing is left to inference. Ids are nullable ints, the audit columns are
+# timestamps, the agreed and payment dates (varchar in totesys) are dates, and
+# short repeated labels are dictionary encoded so they read as categoricals
+
+TIMESTAMP = pa.timestamp("us")
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+AUDIT_COLUMNS = {"created_at": TIMESTAMP, "last_updated": TIMESTAMP}
+
+TABLE_SCHEMAS = {
+    "address": {
+        "address_id": pa.int32(),
+        "address_line_1": pa.string(),
+        "address_line_2": pa.string(),
+        "district": pa.string(),
+        "city": pa.string(),
+        "postal_code": pa.string(),
+        "country": CATEGORY,
+        "phone": pa.string(),
+        **AUDIT_COLUMNS,
+    },
+    "counterparty": {
+        "counterparty_id": pa.int32(),
+        "counterparty_legal_name": pa.string(),
+        "legal_address_id": pa.int32(),
+        "commercial_contact": pa.string(),
+        "delivery_contact": pa.string(),
+        **AUDIT_COLUMNS,
+    },
+    "currency": {
+        "currency_id": pa.int32(),
+        "currency_code": CATEGORY,
+        **AUDIT_COLUMNS,
+    },
+    "department": {
+        "department_id": pa.int32(),
+        "department_name": CATEGORY,
+        "location": CATEGORY,
+        "manager": pa.string(),
+        **AUDIT_COLUMNS,
+    },
+    "design": {
+        "design_id": pa.int32(),
+        "design_name": pa.string(),
+        "file_location": pa.string(),
+        "file_name": pa.string(),
+        **AUDIT_COLUMNS,
+    },
+    "payment": {
+        "payment_id": pa.int32(),
+        "transaction_id": pa.int32(),
+        "counterparty_id": pa.int32(),
+        "payment_amount": pa.float64(),
+        "currency_id": pa.int32(),
+        "payment_type_id": pa.int32(),
+        "paid": pa.bool_(),
+        "payment_date": pa.date32(),
+        "company_ac_number": pa.int32(),
+        "counterparty_ac_number": pa.int32(),
+        **AUDIT_COLUMNS,
+    },
+    "payment_type": {
+        "payment_type_id": pa.int32(),
+        "payment_type_name": CATEGORY,
+        **AUDIT_COLUMNS,
+    },
+    "purchase_order": {
+        "purchase_order_id": pa.int32(),
+        "staff_id": pa.int32(),
+        "counterparty_id": pa.int32(),
+        "item_code": pa.string(),
+        "item_quantity": pa.int32(),
+        "item_unit_price": pa.float64(),
+        "currency_id": pa.int32(),
+        "agreed_delivery_date": pa.date32(),
+        "agreed_payment_date": pa.date32(),
+        "agreed_delivery_location_id": pa.int32(),
+        **AUDIT_COLUMNS,
+    },
+    "sales_order": {
+        "sales_order_id": pa.int32(),
+        "design_id": pa.int32(),
+        "staff_id": pa.int32(),
+        "counterparty_id": pa.int32(),
+        "units_sold": pa.int32(),
+        "unit_price": pa.float64(),
+        "currency_id": pa.int32(),
+        "agreed_delivery_date": pa.date32(),
+        "agreed_payment_date": pa.date32(),
+        "agreed_delivery_location_id": pa.int32(),
+        **AUDIT_COLUMNS,
+    },
+    "staff": {
+        "staff_id": pa.int32(),
+        "first_name": pa.string(),
+        "last_name": pa.string(),
+        "department_id": pa.int32(),
+        "email_address": pa.string(),
+        **AUDIT_COLUMNS,
+    },
+    "transaction": {
+        "transaction_id": pa.int32(),
+        "transaction_type": CATEGORY,
+        "sales_order_id": pa.int32(),
+        "purchase_order_id": pa.int32(),
+        **AUDIT_COLUMNS,
+    },
+}
+
+PRIMARY_KEYS = {
+    "address": "address_id",
+    "counterparty": "counterparty_id",
+    "currency": "currency_id",
+    "department": "department_id",
+    "design": "design_id",
+    "payment": "payment_id",
+    "payment_type": "payment_type_id",
+    "purchase_order": "purchase_order_id",
+    "sales_order": "sales_order_id",
+    "staff": "staff_id",
+    "transaction": "transaction_id",
+}
+
+
+def column_types(table_name):
+    """Returns the column types of table_name for pyarrow's CSV reader, or
+    None for a table that is not registered, which leaves it to inference.
+    Columns missing from a file are ignored by the reader
+    """
+    schema = TABLE_SCHEMAS.get(table_name.split("/")[-1])
+    return dict(schema) if schema is not None else None
+
+
+def apply_schema(table_name, table):
+    """Casts the columns of an Arrow table to the registered types of
+    table_name. Typed extracts are written from the catalog types, which can
+    differ in width or, for the varchar dates, in kind. Unregistered tables
+    and columns are returned unchanged
+    """
+    schema = TABLE_SCHEMAS.get(table_name.split("/")[-1])
+    if schema is None:
+        return table
+    for i, name in enumerate(table.column_names):
+        target = schema.get(name)
+        if target is not None and table.schema.field(i).type != target:
+            table = table.set_column(i, name, table.column(i).cast(target))
+    return table
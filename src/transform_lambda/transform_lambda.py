@@ -1,14 +1,37 @@
+import hashlib
 import json
-import boto3
+import os
 import re
 import logging
+import threading
+import time
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
-from src.transform_lambda.dataframes import *
+import requests
+import xml.etree.ElementTree as ET
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from pg8000.native import Connection, InterfaceError
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+try:
+    from src.runtime_context import context as runtime
+    from src.transform_lambda.dataframes import *
+    from src.transform_lambda import arrow_tables
+    from src.transform_lambda.graph import TransformGraph
+    from src.transform_lambda.schemas import PRIMARY_KEYS, apply_schema, column_types
+    from src.transform_lambda.scd import SCD_KEYS, row_hashes, scd_versions
+except ImportError:  # packaged alongside this module in the lambda zip
+    from runtime_context import context as runtime
+    from dataframes import *
+    import arrow_tables
+    from graph import TransformGraph
+    from schemas import PRIMARY_KEYS, apply_schema, column_types
+    from scd import SCD_KEYS, row_hashes, scd_versions
 
 class DBConnectionException(Exception):
     """Wraps pg8000.native Error or DatabaseError."""
@@ -44,42 +67,193 @@ TABLES = [
     "payment_type",
 ]
 
+STATE_PREFIX = "_state"
+LEDGER_KEY = f"{STATE_PREFIX}/ledger.json"
+# state is kept as Arrow IPC rather than parquet, as the load lambda is started
+# by every .parquet object created in the transform bucket
+STATE_SUFFIX = ".arrow"
+LEGACY_STATE_SUFFIX = ".parquet"
+READ_WORKERS = int(os.environ.get("TRANSFORM_READ_WORKERS", "8"))
+LEDGER_RETENTION_DAYS = int(os.environ.get("LEDGER_RETENTION_DAYS", "7"))
+# tombstones for deleted source rows, written by the extract lambda
+DELETES_PREFIX = "_deletes"
+
+# source tables the dimensions are built from, with their primary keys. Their
+# latest rows are cached in the transform bucket, so each run only has to
+# read the extract objects written since the last one
+DIMENSION_SOURCES = {
+    table: PRIMARY_KEYS[table]
+    for table in (
+        "address",
+        "counterparty",
+        "staff",
+        "department",
+        "currency",
+        "design",
+        "payment_type",
+    )
+}
+
+# output table: (pandas builder, Arrow builder, source tables or other
+# outputs it reads)
+TRANSFORM_NODES = {
+    "fact_sales_order": (
+        create_fact_sales_order,
+        arrow_tables.create_fact_sales_order,
+        ["sales_order"],
+    ),
+    "fact_purchase_order": (
+        create_fact_purchase_orders,
+        arrow_tables.create_fact_purchase_orders,
+        ["purchase_order"],
+    ),
+    "fact_payment": (
+        create_fact_payment,
+        arrow_tables.create_fact_payment,
+        ["payment"],
+    ),
+    "dim_date": (
+        create_dim_date,
+        arrow_tables.create_dim_date,
+        ["fact_sales_order", "fact_purchase_order", "fact_payment"],
+    ),
+    "dim_counterparty": (
+        create_dim_counterparty,
+        arrow_tables.create_dim_counterparty,
+        ["counterparty", "address"],
+    ),
+    "dim_location": (
+        create_dim_location,
+        arrow_tables.create_dim_location,
+        ["address"],
+    ),
+    "dim_staff": (
+        create_dim_staff,
+        arrow_tables.create_dim_staff,
+        ["staff", "department"],
+    ),
+    "dim_design": (
+        create_dim_design,
+        arrow_tables.create_dim_design,
+        ["design"],
+    ),
+    "dim_transaction": (
+        create_dim_transaction,
+        arrow_tables.create_dim_transaction,
+        ["transaction"],
+    ),
+    "dim_payment_type": (
+        create_dim_payment_type,
+        arrow_tables.create_dim_payment_type,
+        ["payment_type"],
+    ),
+    "dim_currency": (
+        create_dim_currency,
+        arrow_tables.create_dim_currency,
+        ["currency", "currency_names"],
+    ),
+}
+# output tables built by the Arrow engine instead of pandas, e.g.
+# TRANSFORM_ARROW_TABLES="fact_sales_order,dim_date". With
+# TRANSFORM_VERIFY_ARROW set, the pandas builder runs as well and any
+# difference between the two is logged
+ARROW_ENGINE_TABLES = {
+    table.strip()
+    for table in os.environ.get("TRANSFORM_ARROW_TABLES", "").split(",")
+    if table.strip()
+}
+VERIFY_ARROW = os.environ.get("TRANSFORM_VERIFY_ARROW", "false").lower() == "true"
+# uploaded under a timestamped key each run, for the load to append
+MUTABLE_OUTPUTS = (
+    "fact_sales_order",
+    "fact_purchase_order",
+    "fact_payment",
+    "dim_transaction",
+    "dim_date",
+    *SCD_KEYS,
+)
+GRAPH_WORKERS = int(os.environ.get("TRANSFORM_GRAPH_WORKERS", "4"))
+# S3 metadata key of an output's content fingerprint, read back by the load
+FINGERPRINT_METADATA = "fingerprint"
+
+# a refreshed copy of the ISO 4217 currency names, written by
+# refresh_currency_names and preferred over the names bundled with dataframes
+CURRENCY_NAMES_KEY = "_reference/currency_names.csv"
+ISO_4217_URL = (
+    "https://www.six-group.com/dam/download/financial-information/"
+    "data-center/iso-currrency/lists/list-one.xml"
+)
 
-def lambda_handler(event, context):
-    db = None
+NULLABLE_INT_TYPES = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+}
+# dates and times stay Arrow-backed, so they reach parquet as date32 and
+# time64 rather than as columns of Python objects
+PANDAS_TYPES = {
+    **NULLABLE_INT_TYPES,
+    pa.date32(): DATE_TYPE,
+    pa.time64("us"): TIME_TYPE,
+}
 
+
+def lambda_handler(event, context):
+    """Transforms the extract objects written since the last run. Fact tables
+    are built from the new rows alone, while dimensions are built from the
+    cached state of their source tables with the new rows merged in, so the
+    work done per run follows the size of the change rather than the history.
+    The slowly changing dimensions are reduced to their new and changed
+    versions. The processed-input ledger, the table state and the dimension
+    snapshots are only saved once the outputs have been uploaded.
+
+    An event with refresh_currency_names set refreshes the cached currency
+    names instead
+    """
     try:
-        db = connect_to_database()
+        client = runtime.client("s3")
         bucket = bucket_name("transform")
 
-        existing_s3_files = list_existing_s3_files(bucket)
-        # print(existing_s3_files)
+        if event and event.get("refresh_currency_names"):
+            count = refresh_currency_names(bucket, client)
+            return {
+                "statusCode": 200,
+                "body": json.dumps(f"Refreshed {count} currency names."),
+            }
+
+        existing_s3_files = list_existing_s3_files(bucket, client)
 
-        dict_of_df = read_from_s3_subfolder_to_df(
-            TABLES, bucket_name("extract"), client=boto3.client("s3")
+        ledger = ProcessedInputLedger.load(bucket, client)
+        inputs = read_from_s3_subfolder_to_df(
+            TABLES + [f"{DELETES_PREFIX}/{table}" for table in DIMENSION_SOURCES],
+            bucket=bucket_name("extract"),
+            client=client,
+            ledger=ledger,
+            as_arrow=True,
         )
+        dict_of_df, changed, states = merge_dimension_state(inputs, bucket, client)
+        logger.info(f"Tables with new extracts: {', '.join(sorted(changed)) or 'none'}")
 
+        outputs = build_outputs(transform_graph(), dict_of_df, changed, bucket, client)
+        snapshots = version_dimensions(outputs, bucket, client)
+        emitted_dates = drop_emitted_dates(outputs, bucket, client)
         immutable_df_dict = {
-            "dim_counterparty": create_dim_counterparty(dict_of_df),
-            "dim_date": create_dim_date(dict_of_df),
-            "dim_location": create_dim_location(dict_of_df),
-            "dim_staff": create_dim_staff(dict_of_df),
-            "dim_design": create_dim_design(dict_of_df),
-            "dim_transaction": create_dim_transaction(dict_of_df),
-            "dim_payment_type": create_dim_payment_type(dict_of_df),
+            name: df for name, df in outputs.items() if name not in MUTABLE_OUTPUTS
         }
-
         mutable_df_dict = {
-            "fact_sales_order": create_fact_sales_order(dict_of_df),
-            "fact_purchase_order": create_fact_purchase_orders(dict_of_df),
-            "fact_payment": create_fact_payment(dict_of_df),
-            "dim_currency": create_dim_currency(dict_of_df),
+            name: df for name, df in outputs.items() if name in MUTABLE_OUTPUTS
         }
-        print(immutable_df_dict.values())
-        print(mutable_df_dict.values())
         status = process_to_parquet_and_upload_to_s3(
-            existing_s3_files, immutable_df_dict, mutable_df_dict, bucket
+            existing_s3_files, immutable_df_dict, mutable_df_dict, bucket, client
         )
+        for table, state in states.items():
+            write_table_state(table, state, bucket, client)
+        for table, snapshot in snapshots.items():
+            write_table_state(table, snapshot, bucket, client, folder="scd")
+        if emitted_dates is not None:
+            write_table_state("dim_date", emitted_dates, bucket, client, "emitted")
+        ledger.save(bucket, client)
 
         if not status["uploaded"]:
             logger.info("No dataframes written to the bucket.")
@@ -92,16 +266,13 @@ def lambda_handler(event, context):
             "statusCode": 200,
             "body": json.dumps(
                 f"""Parquet files processed for {', '.join(status['uploaded'])} and uploaded successfully.{
-                'The following tables were not uploaded: '+', '.join([status['not_uploaded']]) if status['not_uploaded'] else ''}"""
+                'The following tables were not uploaded: '+', '.join(status['not_uploaded']) if status['not_uploaded'] else ''}"""
             ),
         }
 
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
         return {"statusCode": 500, "body": json.dumps("Internal server error.")}
-    finally:
-        if db:
-            db.close()
 
 
 def process_to_parquet_and_upload_to_s3(
@@ -109,54 +280,90 @@ def process_to_parquet_and_upload_to_s3(
     immutable_df_dict,
     mutable_df_dict,
     bucket,
-    client=boto3.client("s3"),
+    client=None,
 ):
+    """Uploads each output with its content fingerprint as object metadata,
+    immutable outputs to a fixed key and mutable ones to a timestamped key.
+    An output whose fingerprint matches that of its previous upload, the
+    fixed key or the latest timestamped key in existing_s3_files, is
+    skipped
+    """
+    if client is None:
+        client = runtime.client("s3")
     status = {"uploaded": [], "not_uploaded": []}
+    outputs = [(name, df, False) for name, df in immutable_df_dict.items()]
+    outputs += [(name, df, True) for name, df in mutable_df_dict.items()]
+
+    for table_name, df, mutable in outputs:
+        if mutable:
+            previous_keys = [
+                key for key in existing_s3_files if key.startswith(f"{table_name}/")
+            ]
+            previous_key = max(previous_keys, default=None)
+            s3_key = datetime.strftime(
+                datetime.today(),
+                f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S.parquet",
+            )
+        else:
+            s3_key = f"{table_name}.parquet"
+            previous_key = s3_key if s3_key in existing_s3_files else None
 
-    for table_name, df in immutable_df_dict.items():
-        if table_name in existing_s3_files:
+        fingerprint = content_fingerprint(df)
+        previous = previous_key and previous_fingerprint(previous_key, bucket, client)
+        if previous == fingerprint:
+            logger.info(f"{table_name} is unchanged, not uploading")
             status["not_uploaded"].append(table_name)
-        else:
-            parquet_file = df.to_parquet(
-                f"{table_name}.parquet", engine="pyarrow"
-            )  # or fastparquet
-            # changed parquet_file variable to the file name
-            client.upload_file(f"{table_name}.parquet", bucket, f"{table_name}.parquet")
-            status["uploaded"].append(table_name)
-            print(status)
-
-    for table_name, df in mutable_df_dict.items():
-        s3_key = datetime.strftime(
-            datetime.today(), f"{table_name}/%Y/%m/%d/{table_name}_%H:%M:%S.parquet"
+            continue
+        buffer = BytesIO()
+        write_parquet(df, buffer)
+        client.put_object(
+            Bucket=bucket,
+            Key=s3_key,
+            Body=buffer.getvalue(),
+            Metadata={FINGERPRINT_METADATA: fingerprint},
         )
-        print(s3_key, '<<<< this is S3_Key')
-        parquet_file = df.to_parquet(
-            f"{table_name}.parquet", engine="pyarrow"
-        )  # or fastparquet
-        client.upload_file(f"{table_name}.parquet", bucket, s3_key)
         status["uploaded"].append(table_name)
 
     return status
 
 
-def retrieve_secrets():
-    secret_name = "bentley-secrets"
-    region_name = "eu-west-2"
+def content_fingerprint(table):
+    """Returns a sha256 hex digest of the column names and values of a pandas
+    or Arrow output, in row order. Values are hashed as strings, so the same
+    content gives the same fingerprint from either engine
+    """
+    if not isinstance(table, pa.Table):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    digest = hashlib.sha256(json.dumps(table.column_names).encode())
+    digest.update(row_hashes(table).to_numpy().tobytes())
+    return digest.hexdigest()
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
 
+def previous_fingerprint(key, bucket, client):
+    """Returns the fingerprint stored with an uploaded output, or None"""
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        response = client.head_object(Bucket=bucket, Key=key)
     except ClientError as e:
-        logger.error(f"Failed to retrieve secret {secret_name}: {str(e)}")
-        raise e
-    except KeyError:
-        logger.error(f"Secret {secret_name} does not contain a SecretString")
-        raise ValueError(f"Secret {secret_name} does not contain a SecretString")
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return response.get("Metadata", {}).get(FINGERPRINT_METADATA)
 
-    return get_secret_value_response["SecretString"]
+
+def write_parquet(table, sink):
+    """Writes a pandas or Arrow engine output as parquet to sink, a path or a
+    binary file-like object such as a BytesIO
+    """
+    if isinstance(table, pa.Table):
+        pq.write_table(table, sink)
+    else:
+        table.to_parquet(sink, engine="pyarrow")
+
+
+def retrieve_secrets():
+    secret_name = "bentley-secrets"
+    # cached across warm invocations and refreshed after SECRET_TTL_SECONDS
+    return runtime.secret(secret_name)
 
 
 def connect_to_database() -> Connection:
@@ -176,19 +383,498 @@ def connect_to_database() -> Connection:
         raise DBConnectionException("Failed to connect to database")
 
 
-def read_from_s3_subfolder_to_df(tables, bucket, client=boto3.client("s3")):
-    table_dfs = {}
+def parse_extract_object(key, data, table_name=None):
+    """Parses the bytes of one extract object into an Arrow table. Parquet
+    and Arrow IPC extracts are already typed, while CSV extracts are parsed
+    with pyarrow's multithreaded reader, decompressing .csv.gz and .csv.zst
+    extracts on the fly. CSV columns of a registered table are parsed
+    straight to their types in the schema registry
+    """
+    if key.endswith(".parquet"):
+        return pq.read_table(pa.BufferReader(data))
+    if key.endswith(".arrow"):
+        return pa.ipc.open_file(pa.BufferReader(data)).read_all()
+    stream = pa.BufferReader(data)
+    if key.endswith(".gz"):
+        stream = pa.CompressedInputStream(stream, "gzip")
+    elif key.endswith(".zst"):
+        stream = pa.CompressedInputStream(stream, "zstd")
+    # streamed extracts are written by Postgres COPY, which writes booleans as t/f
+    return pacsv.read_csv(
+        stream,
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types(table_name) if table_name else None,
+            true_values=["t", "true", "True", "TRUE"],
+            false_values=["f", "false", "False", "FALSE"],
+        ),
+    )
+
+
+def list_table_keys(prefix, bucket, client):
+    """Returns every key under prefix, following the listing's pagination"""
+    paginator = client.get_paginator("list_objects_v2")
+    return [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    ]
+
+
+def read_from_s3_subfolder_to_df(
+    tables, bucket, client=None, ledger=None, stats=None, as_arrow=False
+):
+    """Reads every extract object under each table's prefix into one
+    dataframe per table. With a ProcessedInputLedger, only the objects it
+    has not seen are read and tables without any are left out.
+
+    Objects are fetched concurrently over READ_WORKERS threads and each
+    table's Arrow tables are concatenated once before converting to pandas.
+    Each table is typed by the schema registry in schemas.py rather than by
+    inference. With as_arrow, the Arrow tables are returned without
+    converting them to pandas. If stats is a dict, it is filled with the
+    objects, bytes and seconds spent reading each table
+    """
+    if client is None:
+        client = runtime.client("s3")
+    table_keys = {}
     for table in tables:
-        response = client.list_objects_v2(Bucket=bucket, Prefix=table)
-        list_of_keys = [
-            "s3://" + bucket + "/" + object["Key"] for object in response["Contents"]
-        ]
-        list_of_df = [pd.read_csv(key) for key in list_of_keys]
-        table_dfs[table] = pd.concat(list_of_df)
+        if ledger is not None:
+            keys = ledger.new_objects(f"{table}/", bucket, client)
+        else:
+            keys = list_table_keys(f"{table}/", bucket, client)
+        if keys:
+            table_keys[table] = keys
+
+    def fetch(table, key):
+        start = time.monotonic()
+        data = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        arrow_table = parse_extract_object(key, data, table)
+        return arrow_table, len(data), time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        futures = {
+            table: [executor.submit(fetch, table, key) for key in keys]
+            for table, keys in table_keys.items()
+        }
+        table_dfs = {}
+        for table, table_futures in futures.items():
+            results = [future.result() for future in table_futures]
+            arrow_table = pa.concat_tables(
+                [apply_schema(table, result[0]) for result in results],
+                promote_options="permissive",
+            )
+            table_dfs[table] = (
+                arrow_table
+                if as_arrow
+                else arrow_table.to_pandas(types_mapper=PANDAS_TYPES.get)
+            )
+            table_stats = {
+                "objects": len(results),
+                "bytes": sum(result[1] for result in results),
+                "seconds": round(sum(result[2] for result in results), 3),
+            }
+            logger.info(
+                f"Read {table_stats['objects']} objects "
+                f"({table_stats['bytes']} bytes) for {table} "
+                f"in {table_stats['seconds']}s"
+            )
+            if stats is not None:
+                stats[table] = table_stats
     return table_dfs
 
 
-def bucket_name(bucket_prefix, client=boto3.client("s3")):
+class ProcessedInputLedger:
+    """Records the key and ETag of every extract object the transform has
+    read, so the next run only reads new ones. Extract keys sort by the time
+    they were written, so entries older than retention_days are dropped and
+    replaced with a per-prefix start_after key to list from, which keeps the
+    ledger and the listing both proportional to the recent extracts.
+
+    The ledger is read at the start of a run and saved at the end without a
+    lock, so the transform lambda is limited to one concurrent execution;
+    two runs side by side would both read the same new objects
+    """
+
+    def __init__(self, prefixes=None, retention_days=LEDGER_RETENTION_DAYS):
+        self.prefixes = prefixes or {}
+        self.retention_days = retention_days
+
+    @classmethod
+    def load(cls, bucket, client):
+        try:
+            file_obj = client.get_object(Bucket=bucket, Key=LEDGER_KEY)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return cls()
+            raise
+        return cls(json.loads(file_obj["Body"].read())["prefixes"])
+
+    def new_objects(self, prefix, bucket, client):
+        """Lists the objects under prefix that are not in the ledger, or whose
+        ETag has changed, and records them. Returns their keys in key order
+        """
+        entry = self.prefixes.setdefault(prefix, {"start_after": "", "objects": {}})
+        paginator = client.get_paginator("list_objects_v2")
+        new_keys = []
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=prefix, StartAfter=entry["start_after"]
+        ):
+            for obj in page.get("Contents", []):
+                seen = entry["objects"].get(obj["Key"])
+                if seen is not None and seen[0] == obj["ETag"]:
+                    continue
+                entry["objects"][obj["Key"]] = [
+                    obj["ETag"],
+                    obj["LastModified"].isoformat(),
+                ]
+                new_keys.append(obj["Key"])
+        return new_keys
+
+    def save(self, bucket, client):
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        for entry in self.prefixes.values():
+            for key in sorted(entry["objects"]):
+                if datetime.fromisoformat(entry["objects"][key][1]) >= cutoff:
+                    break
+                entry["objects"].pop(key)
+                entry["start_after"] = key
+        client.put_object(
+            Bucket=bucket,
+            Key=LEDGER_KEY,
+            Body=json.dumps({"prefixes": self.prefixes}).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+def read_table_state(table, bucket, client, folder="tables"):
+    """Returns the cached rows of a dimension source table as an Arrow
+    table, or None. folder="scd" reads a dimension's snapshot instead.
+    State saved as parquet before STATE_SUFFIX was used is still read
+    """
+    for suffix in (STATE_SUFFIX, LEGACY_STATE_SUFFIX):
+        try:
+            file_obj = client.get_object(
+                Bucket=bucket, Key=f"{STATE_PREFIX}/{folder}/{table}{suffix}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                continue
+            raise
+        data = file_obj["Body"].read()
+        if suffix == LEGACY_STATE_SUFFIX:
+            return pq.read_table(BytesIO(data))
+        return pa.ipc.open_file(pa.BufferReader(data)).read_all()
+    return None
+
+
+def write_table_state(table, arrow_table, bucket, client, folder="tables"):
+    """Caches the rows of a dimension source table in the transform bucket,
+    as an Arrow IPC file so that saving it does not start a load
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{STATE_PREFIX}/{folder}/{table}{STATE_SUFFIX}",
+        Body=sink.getvalue().to_pybytes(),
+    )
+
+
+def compact_latest(table, primary_key, order_column="last_updated"):
+    """Keeps only the latest version of each primary key in an Arrow table,
+    the row with the greatest order_column, or the later row on a tie. The
+    versions are ranked with one sort over the whole table and the last of
+    each key picked with a group by, and the kept rows stay in their order
+    in table
+    """
+    if table.num_rows == 0 or primary_key not in table.column_names:
+        return table
+    rows = pa.array(range(table.num_rows), pa.int64())
+    versions = {"row": rows}
+    if order_column in table.column_names:
+        # a version missing order_column sorts first, so any dated one beats it
+        column = table.column(order_column)
+        versions = {
+            "order": pc.fill_null(column, pa.scalar(0).cast(column.type)),
+            "row": rows,
+        }
+    order = pc.sort_indices(
+        pa.table(versions), sort_keys=[(name, "ascending") for name in versions]
+    )
+    ranked = pa.table(
+        {
+            "key": table.column(primary_key).take(order),
+            "row": order,
+            "rank": rows,
+        }
+    )
+    latest = ranked.group_by("key").aggregate([("rank", "max")])
+    keep = pc.take(ranked.column("row"), latest.column("rank_max"))
+    return table.take(pc.take(keep, pc.sort_indices(keep)))
+
+
+def merge_table_state(state, delta, deletes, primary_key):
+    """Returns state with the rows in delta merged in, keeping the latest
+    version of each primary key, and the primary keys in deletes removed
+    """
+    tables = [table for table in (state, delta) if table is not None]
+    if not tables:
+        return None
+    merged = compact_latest(
+        pa.concat_tables(tables, promote_options="permissive"), primary_key
+    )
+    if deletes is not None:
+        key_type = merged.schema.field(primary_key).type
+        deleted = pc.cast(deletes.column(primary_key), key_type)
+        merged = merged.filter(
+            pc.invert(pc.is_in(merged.column(primary_key), value_set=deleted))
+        )
+    return merged
+
+
+def merge_dimension_state(inputs, bucket, client):
+    """Combines the new extract rows in inputs with the cached state of the
+    dimension source tables, all as Arrow tables. Returns the tables to build
+    the outputs from, the names of the source tables that changed, and the
+    updated state of the changed dimension sources, to be written once the
+    run succeeds
+    """
+    # an extract can hold several versions of a row, of which only the
+    # latest is transformed
+    dict_of_df = {
+        table: compact_latest(df, PRIMARY_KEYS[table])
+        for table, df in inputs.items()
+        if table in TABLES
+    }
+    changed = set(dict_of_df)
+    states = {}
+    for table, primary_key in DIMENSION_SOURCES.items():
+        deletes = inputs.get(f"{DELETES_PREFIX}/{table}")
+        state = read_table_state(table, bucket, client)
+        if table in dict_of_df or deletes is not None:
+            changed.add(table)
+            state = merge_table_state(
+                state, dict_of_df.get(table), deletes, primary_key
+            )
+            states[table] = state
+        if state is not None:
+            dict_of_df[table] = state
+    return dict_of_df, changed, states
+
+
+class TableConverter:
+    """Converts tables between the pandas and Arrow engines at the edges of
+    the transform graph, converting each table at most once per run however
+    many nodes read it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._converted = {}
+
+    def to_pandas(self, table):
+        if not isinstance(table, pa.Table):
+            return table
+        return self._convert(
+            table, lambda t: t.to_pandas(types_mapper=PANDAS_TYPES.get)
+        )
+
+    def to_arrow(self, df):
+        if not isinstance(df, pd.DataFrame):
+            return df
+        return self._convert(
+            df, lambda d: pa.Table.from_pandas(d, preserve_index=False)
+        )
+
+    def _convert(self, value, convert):
+        with self._lock:
+            cached = self._converted.get(id(value))
+        if cached is None:
+            # the value is kept with its conversion so its id is not reused
+            cached = (value, convert(value))
+            with self._lock:
+                cached = self._converted.setdefault(id(value), cached)
+        return cached[1]
+
+
+def transform_graph(arrow_engine=ARROW_ENGINE_TABLES, verify=VERIFY_ARROW):
+    """Returns the transform graph for one run, building the tables named in
+    arrow_engine with the Arrow builders and the rest with pandas. With
+    verify, each Arrow output is checked against the pandas builder's
+    """
+    converter = TableConverter()
+
+    def node(table_name, build_pandas, build_arrow):
+        def build(inputs):
+            if table_name not in arrow_engine:
+                return build_pandas(
+                    {name: converter.to_pandas(value) for name, value in inputs.items()}
+                )
+            result = build_arrow(
+                {name: converter.to_arrow(value) for name, value in inputs.items()}
+            )
+            if verify:
+                expected = build_pandas(
+                    {name: converter.to_pandas(value) for name, value in inputs.items()}
+                )
+                differences = arrow_tables.check_equivalent(expected, result)
+                if differences:
+                    logger.warning(
+                        f"Arrow engine output for {table_name} differs from "
+                        f"pandas: {'; '.join(differences)}"
+                    )
+            return result
+
+        return build
+
+    return TransformGraph(
+        {
+            table_name: (node(table_name, build_pandas, build_arrow), inputs)
+            for table_name, (
+                build_pandas,
+                build_arrow,
+                inputs,
+            ) in TRANSFORM_NODES.items()
+        }
+    )
+
+
+def build_outputs(graph, dict_of_df, changed, bucket=None, client=None):
+    """Builds each output with a changed source table by running the
+    transform graph. Dimension sources come from the cached state so must
+    all be present, while fact sources only hold new rows and may be
+    missing. The cached currency names are only read if dim_currency is
+    built
+    """
+    targets = []
+    for table_name in graph.nodes:
+        sources = graph.sources_of(table_name)
+        if not changed.intersection(sources):
+            continue
+        missing = [
+            source
+            for source in sources
+            if source in DIMENSION_SOURCES and source not in dict_of_df
+        ]
+        if missing:
+            logger.warning(f"Skipping {table_name}, no rows yet for {missing}")
+            continue
+        targets.append(table_name)
+
+    sources = dict(dict_of_df)
+    if "dim_currency" in targets and client is not None:
+        names = read_currency_names(bucket, client)
+        if names is not None:
+            sources["currency_names"] = names
+
+    built, timings = graph.run(sources, targets, workers=GRAPH_WORKERS)
+    logger.info(
+        "Transform timings: "
+        + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items())
+    )
+    return built
+
+
+def version_dimensions(outputs, bucket, client, now=None):
+    """Replaces each slowly changing dimension in outputs with its new and
+    changed versions, dropping it if nothing changed. Returns the updated
+    snapshots, to be written once the versions are uploaded
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    snapshots = {}
+    for table, key in SCD_KEYS.items():
+        if table not in outputs:
+            continue
+        built = outputs.pop(table)
+        if not isinstance(built, pa.Table):
+            built = pa.Table.from_pandas(built, preserve_index=False)
+        snapshot = read_table_state(table, bucket, client, folder="scd")
+        versions, snapshots[table] = scd_versions(built, key, snapshot, now)
+        if versions is None:
+            logger.info(f"No new versions of {table}")
+            continue
+        logger.info(f"{versions.num_rows} new versions of {table}")
+        outputs[table] = versions
+    return snapshots
+
+
+def drop_emitted_dates(outputs, bucket, client):
+    """dim_date is built from the new fact rows of a run only, so it may
+    repeat dates emitted by earlier runs. Removes those from dim_date in
+    outputs, dropping it if no date is new, and returns the updated record
+    of emitted dates, to be written once the outputs are uploaded, or None
+    """
+    if "dim_date" not in outputs:
+        return None
+    built = outputs.pop("dim_date")
+    if not isinstance(built, pa.Table):
+        built = pa.Table.from_pandas(built, preserve_index=False)
+    date_id = pc.cast(built.column("date_id"), pa.timestamp("ns"))
+    emitted = read_table_state("dim_date", bucket, client, folder="emitted")
+    if emitted is not None:
+        new = pc.invert(pc.is_in(date_id, value_set=emitted.column("date_id")))
+        built = built.filter(new)
+        date_id = date_id.filter(new)
+    if built.num_rows == 0:
+        logger.info("No new dates for dim_date")
+        return None
+    outputs["dim_date"] = built
+    previous = [] if emitted is None else emitted.column("date_id").chunks
+    return pa.table(
+        {"date_id": pa.chunked_array(previous + date_id.chunks, pa.timestamp("ns"))}
+    )
+
+
+def read_currency_names(bucket, client):
+    """Returns the currency names cached by refresh_currency_names, or None
+    if there is no cached copy and the bundled names should be used
+    """
+    try:
+        file_obj = client.get_object(Bucket=bucket, Key=CURRENCY_NAMES_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return pd.read_csv(file_obj["Body"], keep_default_na=False)
+
+
+def refresh_currency_names(bucket, client, url=ISO_4217_URL):
+    """Downloads the current ISO 4217 list and caches its currency codes
+    and names in the transform bucket. Returns the number of currencies
+    """
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    names = {}
+    for entry in ET.fromstring(response.content).iter("CcyNtry"):
+        code, name = entry.findtext("Ccy"), entry.findtext("CcyNm")
+        if code and name:
+            names.setdefault(code.strip(), name.strip())
+    if not names:
+        raise ValueError(f"No currencies found in {url}")
+    df = pd.DataFrame(
+        sorted(names.items()), columns=["currency_code", "currency_name"]
+    )
+    client.put_object(
+        Bucket=bucket,
+        Key=CURRENCY_NAMES_KEY,
+        Body=df.to_csv(index=False).encode("utf-8"),
+        ContentType="text/csv",
+    )
+    logger.info(f"Cached {len(df)} currency names at {CURRENCY_NAMES_KEY}")
+    return len(df)
+
+
+def bucket_name(bucket_prefix, client=None):
+    """Returns the name of the first bucket containing bucket_prefix. Without
+    a client, the name is taken from the {BUCKET_PREFIX}_BUCKET environment
+    variable if set, or discovered once and cached for the warm container
+    """
+    if client is None:
+        name = runtime.bucket(bucket_prefix, f"{bucket_prefix.upper()}_BUCKET")
+        if name is None:
+            raise ValueError(f"No bucket found with prefix: {bucket_prefix}")
+        return name
     response = client.list_buckets()
     bucket_filter = [
         bucket["Name"]
@@ -202,15 +888,21 @@ def bucket_name(bucket_prefix, client=boto3.client("s3")):
     return bucket_filter[0]
 
 
-def list_existing_s3_files(bucket_name, client=boto3.client("s3")):
+def list_existing_s3_files(bucket_name, client=None):
     logging.info("Listing existing S3 files")
+    if client is None:
+        client = runtime.client("s3")
 
     try:
-        response = client.list_objects_v2(Bucket=bucket_name)
-
-        if "Contents" in response:
-            existing_files = [obj["Key"] for obj in response["Contents"]]
-        else:
+        # paginated, as the timestamped outputs soon pass a single page
+        existing_files = [
+            obj["Key"]
+            for page in client.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket_name
+            )
+            for obj in page.get("Contents", [])
+        ]
+        if not existing_files:
             logger.error("The bucket is empty")
             return []  # changed from None to [] so it is an iterable
 
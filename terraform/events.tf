@@ -50,6 +50,33 @@ resource "aws_lambda_permission" "allow_eventbridge" {
   }
 }
 
+resource "aws_cloudwatch_event_rule" "currency_names_refresh" {
+  name                = "currency-names-refresh"
+  description         = "Refreshes the ISO 4217 currency names cached by the transform Lambda"
+  schedule_expression = "rate(30 days)"
+}
+
+resource "aws_cloudwatch_event_target" "transform_lambda_currency_refresh" {
+  rule       = aws_cloudwatch_event_rule.currency_names_refresh.name
+  target_id  = "RefreshCurrencyNames"
+  arn        = aws_lambda_function.transform_lambda.arn
+  input      = jsonencode({ refresh_currency_names = true })
+  depends_on = [aws_lambda_permission.allow_currency_refresh]
+}
+
+resource "aws_lambda_permission" "allow_currency_refresh" {
+  statement_id  = "AllowCurrencyRefreshFromEventBridge${random_string.eventbridge_suffix.result}"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.transform_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.currency_names_refresh.arn
+
+  lifecycle {
+    create_before_destroy = true
+    replace_triggered_by  = [random_string.eventbridge_suffix]
+  }
+}
+
 ########################################
 # S3 Extract Bucket Notification Setup #
 ########################################
@@ -68,12 +95,24 @@ resource "aws_lambda_permission" "allow_s3_ingestion" {
 }
 
 
+# only extract data starts a transform: csv, csv.gz, csv.zst, parquet and
+# arrow objects, including delete tombstones. The extract's control state,
+# the watermarks, schedule, continuation, fingerprints and hash index, is
+# JSON or binary and is left out
+locals {
+  extract_data_suffixes = [".csv", ".gz", ".zst", ".parquet", ".arrow"]
+}
+
 resource "aws_s3_bucket_notification" "extract_bucket_notification" {
   bucket = aws_s3_bucket.extract_bucket.id
 
-  lambda_function {
-    events              = ["s3:ObjectCreated:*"]
-    lambda_function_arn = aws_lambda_function.transform_lambda.arn
+  dynamic "lambda_function" {
+    for_each = local.extract_data_suffixes
+    content {
+      events              = ["s3:ObjectCreated:*"]
+      lambda_function_arn = aws_lambda_function.transform_lambda.arn
+      filter_suffix       = lambda_function.value
+    }
   }
 
   depends_on = [aws_lambda_permission.allow_s3_ingestion]
@@ -97,12 +136,15 @@ resource "aws_lambda_permission" "allow_s3_transform_bucket" {
 }
 
 
+# only parquet outputs start a load. The load lambda's JSON record of the files
+# it has loaded and the transform's Arrow IPC state under _state/ do not
 resource "aws_s3_bucket_notification" "transform_bucket_notification" {
   bucket = aws_s3_bucket.transform_bucket.id
 
   lambda_function {
     events              = ["s3:ObjectCreated:*"]
     lambda_function_arn = aws_lambda_function.load_lambda.arn
+    filter_suffix       = ".parquet"
   }
 
   depends_on = [aws_lambda_permission.allow_s3_transform_bucket]
@@ -40,6 +40,7 @@ data "aws_iam_policy_document" "s3_data_policy_doc" {
       "s3:PutObjectRetention",
       "s3:PutObjectTagging",
       "s3:PutObjectAcl",
+      "s3:AbortMultipartUpload",
       "s3:ListObjects",
       "s3:ListObjectsV2",
       "s3:GetObject"
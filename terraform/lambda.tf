@@ -70,8 +70,47 @@ resource "aws_lambda_layer_version" "lambda_layer_02" {
 
 data "archive_file" "extract_lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/../src/extract_lambda.py"
   output_path = "${path.module}/../extract_function.zip"
+
+  source {
+    content  = file("${path.module}/../src/extract_lambda.py")
+    filename = "extract_lambda.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_database.py")
+    filename = "extract_database.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_storage.py")
+    filename = "extract_storage.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_hash_index.py")
+    filename = "extract_hash_index.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_backfill.py")
+    filename = "extract_backfill.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_cdc.py")
+    filename = "extract_cdc.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/extract_deletes.py")
+    filename = "extract_deletes.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/runtime_context.py")
+    filename = "runtime_context.py"
+  }
 }
 resource "aws_s3_object" "extract_lambda_code" {
   bucket = aws_s3_bucket.lambda_code_bucket.bucket
@@ -91,6 +130,16 @@ resource "aws_lambda_function" "extract_lambda" {
   source_code_hash = data.archive_file.extract_lambda_zip.output_base64sha256
   timeout          = 180
 
+  environment {
+    variables = {
+      EXTRACT_WORKERS            = var.extract_workers
+      EXTRACT_MODE               = var.extract_mode
+      EXTRACT_DETECT_DELETES     = "true"
+      EXTRACT_SUPPRESS_UNCHANGED = "true"
+      EXTRACT_COMPRESSION        = "gzip"
+    }
+  }
+
   lifecycle {
     create_before_destroy = true
   }
@@ -105,8 +154,47 @@ resource "aws_lambda_function" "extract_lambda" {
 
 data "archive_file" "transform_lambda_zip" {
   type        = "zip"
-  source_dir  = "${path.module}/../src/transform_lambda"
   output_path = "${path.module}/../transform_lambda.zip"
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/transform_lambda.py")
+    filename = "transform_lambda.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/dataframes.py")
+    filename = "dataframes.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/schemas.py")
+    filename = "schemas.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/graph.py")
+    filename = "graph.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/arrow_tables.py")
+    filename = "arrow_tables.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/scd.py")
+    filename = "scd.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/transform_lambda/currency_names.csv")
+    filename = "currency_names.csv"
+  }
+
+  source {
+    content  = file("${path.module}/../src/runtime_context.py")
+    filename = "runtime_context.py"
+  }
 }
 
 resource "aws_s3_object" "transform_lambda_code" {
@@ -127,6 +215,11 @@ resource "aws_lambda_function" "transform_lambda" {
   source_code_hash = data.archive_file.transform_lambda_zip.output_base64sha256
   timeout          = 180
 
+  # one extract writes several data objects, each starting a transform, and
+  # the processed-input ledger is only safe with one run at a time. Throttled
+  # S3 invocations are retried, and find their objects already processed
+  reserved_concurrent_executions = 1
+
   lifecycle {
     create_before_destroy = true
   }
@@ -140,8 +233,17 @@ resource "aws_lambda_function" "transform_lambda" {
 
 data "archive_file" "load_lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/../src/load_lambda.py"
   output_path = "${path.module}/../load_function.zip"
+
+  source {
+    content  = file("${path.module}/../src/load_lambda.py")
+    filename = "load_lambda.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/runtime_context.py")
+    filename = "runtime_context.py"
+  }
 }
 resource "aws_s3_object" "load_lambda_code" {
   bucket = aws_s3_bucket.lambda_code_bucket.bucket
@@ -161,6 +263,10 @@ resource "aws_lambda_function" "load_lambda" {
   source_code_hash = data.archive_file.load_lambda_zip.output_base64sha256
   timeout          = 180
 
+  # every output uploaded by a transform starts a load, and loads running side
+  # by side would both append the files neither has recorded yet
+  reserved_concurrent_executions = 1
+
   lifecycle {
     create_before_destroy = true
   }
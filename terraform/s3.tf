@@ -17,6 +17,23 @@ resource "aws_s3_bucket_versioning" "extract_bucket_versioning" {
   }
 }
 
+# streamed extracts abort their multipart upload on failure, this clears up any
+# upload left behind by an invocation that timed out before it could
+resource "aws_s3_bucket_lifecycle_configuration" "extract_bucket_lifecycle" {
+  bucket = aws_s3_bucket.extract_bucket.id
+
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {}
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+}
+
 ##########################
 # TRANSFORM BUCKET SETUP #
 ##########################
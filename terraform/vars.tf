@@ -28,6 +28,17 @@ variable "load_lambda_name" {
   default = "load-lambda"
 }
 
+variable "extract_workers" {
+  type    = number
+  default = 4
+}
+
+# "cdc" needs wal_level = logical and the wal2json plugin on totesys
+variable "extract_mode" {
+  type    = string
+  default = "poll"
+}
+
 variable "project_name" {
   type    = string
   default = "tt"
@@ -0,0 +1,132 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+from src.transform_lambda import arrow_tables
+from src.transform_lambda.schemas import apply_schema
+from src.transform_lambda.transform_lambda import (
+    TRANSFORM_NODES,
+    parse_extract_object,
+    transform_graph,
+)
+
+AUDIT = "2022-11-03 14:20:49.962,2022-11-04 09:01:02.5"
+
+SOURCES = {
+    "address": f"""address_id,address_line_1,address_line_2,district,city,postal_code,country,phone,created_at,last_updated
+1,6826 Herzog Via,,Avon,New Patienceburgh,28441,Turkey,1803 637401,{AUDIT}
+2,179 Alexie Cliffs,,,Aliso Viejo,99305-7380,San Marino,9621 880720,{AUDIT}
+3,148 Sincere Fort,,,Lake Charles,89360,Samoa,0730 783349,{AUDIT}
+""",
+    "counterparty": f"""counterparty_id,counterparty_legal_name,legal_address_id,commercial_contact,delivery_contact,created_at,last_updated
+1,Fahey and Sons,3,Micheal Toy,Mrs. Lucy Runolfsdottir,{AUDIT}
+2,"Leannon, Predovic and Morar",1,Melba Sanford,Jean Hane III,{AUDIT}
+3,Armstrong Inc,9,Jane Wiza,Myra Kovacek,{AUDIT}
+""",
+    "currency": f"""currency_id,currency_code,created_at,last_updated
+1,GBP,{AUDIT}
+2,USD,{AUDIT}
+3,XXX,{AUDIT}
+""",
+    "department": f"""department_id,department_name,location,manager,created_at,last_updated
+1,Sales,Manchester,Richard Roma,{AUDIT}
+2,Purchasing,Manchester,Naomi Lapaglia,{AUDIT}
+""",
+    "design": f"""design_id,created_at,design_name,file_location,file_name,last_updated
+8,2022-11-03 14:20:49.962,Wooden,/usr,wooden-20220717-npgz.json,2022-11-03 14:20:49.962
+51,2023-01-12 18:50:09.935,Bronze,/private,bronze-20221024-4dds.json,2023-01-12 18:50:09.935
+""",
+    "payment_type": f"""payment_type_id,payment_type_name,created_at,last_updated
+1,SALES_RECEIPT,{AUDIT}
+2,SALES_REFUND,{AUDIT}
+""",
+    "staff": f"""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
+1,Jeremie,Franey,2,jeremie.franey@terrifictotes.com,{AUDIT}
+2,Deron,Beier,1,deron.beier@terrifictotes.com,{AUDIT}
+3,Jeanette,Erdman,7,jeanette.erdman@terrifictotes.com,{AUDIT}
+""",
+    "transaction": f"""transaction_id,transaction_type,sales_order_id,purchase_order_id,created_at,last_updated
+1,PURCHASE,,2,{AUDIT}
+2,SALE,1,,{AUDIT}
+""",
+    "sales_order": f"""sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold,unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+2,{AUDIT},3,19,8,42972,3.94,2,2022-11-07,2022-11-08,8
+3,2022-11-05 10:00:00.000001,2022-11-05 10:00:00.000001,4,10,4,65839,2.91,3,,2022-11-06,19
+""",
+    "purchase_order": f"""purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+1,{AUDIT},12,11,ZDOI5EA,371,361.39,2,2022-11-09,2022-11-07,6
+""",
+    "payment": f"""payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number
+2,{AUDIT},2,15,552548.62,2,3,f,2022-11-04,67305075,31622269
+3,{AUDIT},3,18,205952.22,3,1,t,2022-11-03,81718079,47839086
+""",
+}
+
+
+@pytest.fixture(scope="module")
+def source_tables():
+    return {
+        table: apply_schema(
+            table, parse_extract_object("x.csv", body.encode(), table)
+        )
+        for table, body in SOURCES.items()
+    }
+
+
+class TestArrowEngineEquivalence:
+    @pytest.mark.parametrize("table_name", list(TRANSFORM_NODES))
+    def test_arrow_output_matches_pandas(self, source_tables, table_name):
+        pandas_results, _ = transform_graph(arrow_engine=set()).run(
+            source_tables, [table_name]
+        )
+        arrow_results, _ = transform_graph(arrow_engine=set(TRANSFORM_NODES)).run(
+            source_tables, [table_name]
+        )
+
+        assert isinstance(pandas_results[table_name], pd.DataFrame)
+        assert isinstance(arrow_results[table_name], pa.Table)
+        assert arrow_results[table_name].num_rows > 0
+        assert (
+            arrow_tables.check_equivalent(
+                pandas_results[table_name], arrow_results[table_name]
+            )
+            == []
+        )
+
+    def test_engines_can_be_mixed_per_table(self, source_tables):
+        results, _ = transform_graph(arrow_engine={"fact_payment"}).run(
+            source_tables, ["fact_payment", "dim_date"]
+        )
+
+        assert isinstance(results["fact_payment"], pa.Table)
+        assert isinstance(results["dim_date"], pd.DataFrame)
+
+    def test_verify_logs_differences(self, source_tables, caplog):
+        broken = dict(TRANSFORM_NODES)
+        build_pandas, _, inputs = broken["dim_design"]
+
+        def build_arrow(tables):
+            return tables["design"].select(["design_id", "design_name"])
+
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setitem(
+                TRANSFORM_NODES, "dim_design", (build_pandas, build_arrow, inputs)
+            )
+            transform_graph(arrow_engine={"dim_design"}, verify=True).run(
+                source_tables, ["dim_design"]
+            )
+
+        assert "Arrow engine output for dim_design differs" in caplog.text
+
+
+class TestCheckEquivalent:
+    def test_reports_differing_columns(self):
+        df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+        table = pa.table({"a": [1, 2], "b": ["x", "z"]})
+
+        assert arrow_tables.check_equivalent(df, table) == ["column b differs"]
+
+    def test_reports_differing_column_names(self):
+        df = pd.DataFrame({"a": [1]})
+        table = pa.table({"b": [1]})
+
+        assert arrow_tables.check_equivalent(df, table) == ["columns ['a'] != ['b']"]
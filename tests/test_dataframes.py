@@ -1,7 +1,9 @@
 from src.transform_lambda.dataframes import *
 import pandas as pd
 from unittest.mock import patch
-from datetime import datetime as dt
+from datetime import datetime as dt, date, time
+import io
+import pyarrow.parquet as pq
 
 
 class TestCreateDimDesign:
@@ -169,10 +171,45 @@ class TestCreateDimCurrency:
         assert isinstance(result, pd.DataFrame)
         assert result.equals(expected_df)
 
-    def test_scrape_currency_names_returns_dataframe_with_correct_collumns(self):
-        result = scrape_currency_names()
+    def test_currency_names_returns_bundled_iso_4217_names(self):
+        result = currency_names()
         assert isinstance(result, pd.DataFrame)
         assert list(result.columns) == ["currency_code", "currency_name"]
+        names = dict(zip(result["currency_code"], result["currency_name"]))
+        assert names["GBP"] == "Pound Sterling"
+        assert names["NAD"] == "Namibia Dollar"
+        assert result["currency_code"].is_unique
+
+    def test_dim_currency_defaults_to_bundled_names(self):
+        test_df = {
+            "currency": pd.DataFrame(
+                data={
+                    "currency_id": [1],
+                    "currency_code": ["EUR"],
+                    "created_at": [None],
+                    "last_updated": [None],
+                }
+            )
+        }
+        result = create_dim_currency(test_df)
+        assert list(result["currency_name"]) == ["Euro"]
+
+    def test_dim_currency_prefers_names_passed_with_the_tables(self):
+        test_df = {
+            "currency": pd.DataFrame(
+                data={
+                    "currency_id": [1],
+                    "currency_code": ["EUR"],
+                    "created_at": [None],
+                    "last_updated": [None],
+                }
+            ),
+            "currency_names": pd.DataFrame(
+                {"currency_code": ["EUR"], "currency_name": ["Refreshed Euro"]}
+            ),
+        }
+        result = create_dim_currency(test_df)
+        assert list(result["currency_name"]) == ["Refreshed Euro"]
 
 
 class TestCreateDimDate:
@@ -215,16 +252,22 @@ class TestCreateDimDate:
                 "quarter",
             ],
         )
-        with patch("src.dataframes.create_fact_payment") as mock_fp:
-            with patch("src.dataframes.create_fact_purchase_orders") as mock_fpo:
-                with patch("src.dataframes.create_fact_sales_order") as mock_fso:
-                    mock_fp.return_value = df_one
-                    mock_fpo.return_value = df_two
-                    mock_fso.return_value = df_three
-                    result = create_dim_date({"dum": 0})
-                    result.reset_index(inplace=True, drop=True)
-                    assert result.eq(
-                        expected_df, axis="columns").all(axis=None)
+        result = create_dim_date(
+            {
+                "fact_payment": df_one,
+                "fact_purchase_order": df_two,
+                "fact_sales_order": df_three,
+            }
+        )
+        result.reset_index(inplace=True, drop=True)
+        assert result.eq(expected_df, axis="columns").all(axis=None)
+
+    def test_uses_only_the_fact_tables_present(self):
+        df_one = pd.DataFrame(
+            data={"created_date": dt(2021, 5, 13)}, index=[0]
+        )
+        result = create_dim_date({"fact_payment": df_one})
+        assert list(result["date_id"]) == [dt(2021, 5, 13)]
 
 
 class TestCreateDimLocation:
@@ -271,35 +314,89 @@ class TestCreateFactPayment:
                             "2022-12-14 16:20:49.962194", "%Y-%m-%d %H:%M:%S.%f"
                         ),
                         1,
+                        2,
+                        3,
+                        552548.62,
+                        1,
+                        3,
+                        False,
+                        dt(2020, 7, 16),
                         "SE18 9QO",
-                        "2020-07-16",
                     ]
                 ],
                 columns=[
                     "created_at",
                     "last_updated",
                     "payment_id",
-                    "some_other_id",
+                    "transaction_id",
+                    "counterparty_id",
+                    "payment_amount",
+                    "currency_id",
+                    "payment_type_id",
+                    "paid",
                     "payment_date",
+                    "some_other_id",
                 ],
             )
         }
         expected_cols = [
             "payment_record_id",
+            "payment_id",
             "created_date",
             "created_time",
             "last_updated_date",
             "last_updated_time",
+            "transaction_id",
+            "counterparty_id",
+            "payment_amount",
+            "currency_id",
+            "payment_type_id",
+            "paid",
             "payment_date",
-            "payment_id",
-            "some_other_id",
         ]
         result = create_fact_payment(dict_df)
         assert isinstance(result, pd.DataFrame)
-        for col in list(result.columns):
-            assert col in expected_cols
-        for col in expected_cols:
+        assert list(result.columns) == expected_cols
+        for col in ["created_date", "last_updated_date"]:
+            assert str(result[col].dtype) == "date32[day][pyarrow]"
+        for col in ["created_time", "last_updated_time"]:
+            assert str(result[col].dtype) == "time64[us][pyarrow]"
 
+    def test_does_not_modify_the_input_dataframe(self):
+        df_payment = pd.DataFrame(
+            data={
+                "created_at": [dt(2022, 11, 3, 14, 20)],
+                "last_updated": [dt(2022, 11, 3, 14, 20)],
+                "payment_id": [1],
+                "transaction_id": [2],
+                "counterparty_id": [3],
+                "payment_amount": [1.5],
+                "currency_id": [1],
+                "payment_type_id": [3],
+                "paid": [True],
+                "payment_date": [dt(2022, 11, 4)],
+            }
+        )
+        columns = list(df_payment.columns)
+        create_fact_payment({"payment": df_payment})
+        assert list(df_payment.columns) == columns
+
+
+class TestSplitTimestamp:
+    def test_splits_into_date_and_time_to_the_second(self):
+        timestamps = pd.Series(
+            [dt(2022, 11, 3, 14, 20, 49, 962846), None], index=[5, 6]
+        )
+        dates, times = split_timestamp(timestamps)
+        assert list(dates.index) == [5, 6]
+        assert dates[5] == date(2022, 11, 3)
+        assert times[5] == time(14, 20, 49)
+        assert dates.isna()[6] and times.isna()[6]
 
-if "_date" or "_time" in col:
-    assert result[col].dtype == "O"
+    def test_columns_are_written_to_parquet_as_date32_and_time64(self):
+        dates, times = split_timestamp(pd.Series([dt(2022, 11, 3, 14, 20, 49)]))
+        buffer = io.BytesIO()
+        pd.DataFrame({"date": dates, "time": times}).to_parquet(buffer)
+        schema = pq.read_schema(io.BytesIO(buffer.getvalue()))
+        assert str(schema.field("date").type) == "date32[day]"
+        assert str(schema.field("time").type) == "time64[us]"
@@ -0,0 +1,190 @@
+import pytest
+import boto3
+from moto import mock_aws
+from unittest.mock import MagicMock
+import os
+import json
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_catalog_cache():
+    extract_database._catalog.clear()
+    yield
+    extract_database._catalog.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def s3_mock_bucket(s3_client):
+    bucket = s3_client.create_bucket(
+        Bucket="extract_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return bucket
+
+
+import src.extract_database as extract_database  # noqa: E402
+from src.runtime_context import context  # noqa: E402
+from src.extract_backfill import (  # noqa: E402
+    build_shard_query,
+    dispatch_backfill,
+    plan_backfill,
+    start_backfill,
+)
+from src.extract_storage import (  # noqa: E402
+    read_watermarks,
+)
+from datetime import datetime
+
+
+class FakeLambdaContext:
+    invoked_function_arn = "arn:aws:lambda:eu-west-2:123456789012:function:extract"
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = list(remaining_ms)
+
+    def get_remaining_time_in_millis(self):
+        if len(self.remaining_ms) > 1:
+            return self.remaining_ms.pop(0)
+        return self.remaining_ms[0]
+
+
+class TestBackfill:
+    catalog = {
+        "Fruits": {
+            "columns": [
+                ("fruit_id", "integer"),
+                ("last_updated", "timestamp without time zone"),
+            ],
+            "primary_key": "fruit_id",
+        },
+        "Baskets": {
+            "columns": [
+                ("name", "text"),
+                ("last_updated", "timestamp without time zone"),
+            ],
+            "primary_key": None,
+        },
+        "Labels": {"columns": [("label_id", "integer")], "primary_key": "label_id"},
+    }
+
+    def plan(self, shard_rows=100):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [["Fruits", 250], ["Baskets", 10]],
+            [[datetime(2024, 1, 5), 300]],
+            [[1, 300]],
+            [[datetime(2024, 1, 3)]],
+        ]
+        return plan_backfill(mock_db, self.catalog, shard_rows=shard_rows), mock_db
+
+    def test_splits_tables_by_row_estimate(self):
+        plan, mock_db = self.plan()
+
+        assert "pg_class" in mock_db.run.call_args_list[0].args[0]
+        assert plan["tables"] == {
+            "Fruits": {"upper": ["2024-01-05T00:00:00", 300], "shards": 3},
+            "Baskets": {"upper": ["2024-01-03T00:00:00", None], "shards": 1},
+        }
+        assert [
+            (shard["table"], shard["lower"], shard["upper_key"])
+            for shard in plan["shards"]
+        ] == [
+            ("Fruits", 1, 101),
+            ("Fruits", 101, 201),
+            ("Fruits", 201, 301),
+            ("Baskets", None, None),
+        ]
+        json.dumps(plan)
+
+    def test_shard_query_is_bounded_by_plan(self):
+        plan, _ = self.plan()
+        query, params = build_shard_query(plan["shards"][1])
+
+        assert "(last_updated, fruit_id) <= (:upper_latest, :upper_pk)" in query
+        assert "fruit_id >= :lower AND fruit_id < :upper_key" in query
+        assert params["upper_latest"] == datetime(2024, 1, 5)
+        assert (params["lower"], params["upper_key"]) == (101, 201)
+
+    def test_runs_shards_locally_and_moves_watermark(self, s3_client, s3_mock_bucket):
+        plan, _ = self.plan(shard_rows=200)
+        start_backfill(plan, "extract_bucket", s3_client)
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [[1, datetime(2024, 1, 1)]],
+            [[201, datetime(2024, 1, 5)]],
+            [],
+        ]
+        mock_db.columns = [{"name": "fruit_id"}, {"name": "last_updated"}]
+        extract_database._catalog.update(self.catalog)
+
+        started = dispatch_backfill(
+            mock_db, plan, bucket_name="extract_bucket", client=s3_client, workers=1
+        )
+
+        assert started == 3
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+        ]
+        assert len([key for key in keys if "_backfill" in key]) == 2
+        assert len([key for key in keys if key.endswith(".done")]) == 3
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 5), 300),
+            "Baskets": (datetime(2024, 1, 3), None),
+        }
+
+        # a resumed backfill has nothing left to run
+        assert (
+            dispatch_backfill(
+                mock_db, plan, bucket_name="extract_bucket", client=s3_client
+            )
+            == 0
+        )
+
+    def test_invokes_a_lambda_per_shard_in_aws(self, s3_client, s3_mock_bucket, mocker):
+        plan, _ = self.plan()
+        mock_lambda = MagicMock()
+        mocker.patch.object(context, "client", return_value=mock_lambda)
+
+        started = dispatch_backfill(
+            MagicMock(),
+            plan,
+            FakeLambdaContext([600000]),
+            bucket_name="extract_bucket",
+            client=s3_client,
+        )
+
+        assert started == 4
+        payloads = [
+            json.loads(call.kwargs["Payload"])
+            for call in mock_lambda.invoke.call_args_list
+        ]
+        assert payloads[0]["backfill_shard"] == plan["shards"][0]
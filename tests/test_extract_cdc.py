@@ -0,0 +1,234 @@
+import pytest
+import boto3
+from moto import mock_aws
+from unittest.mock import patch, MagicMock
+import os
+import json
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_catalog_cache():
+    extract_database._catalog.clear()
+    yield
+    extract_database._catalog.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def s3_mock_bucket(s3_client):
+    bucket = s3_client.create_bucket(
+        Bucket="extract_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return bucket
+
+
+import src.extract_database as extract_database  # noqa: E402
+from src.runtime_context import context  # noqa: E402
+from src.extract_cdc import (  # noqa: E402
+    decode_changes,
+    process_replication_changes,
+)
+from src.extract_storage import (  # noqa: E402
+    read_watermarks,
+)
+from datetime import datetime
+
+
+def wal2json(action, table, values, lsn):
+    columns = "identity" if action == "D" else "columns"
+    record = {
+        "action": action,
+        "schema": "public",
+        "table": table,
+        columns: [{"name": name, "value": value} for name, value in values.items()],
+    }
+    return [lsn, json.dumps(record)]
+
+
+REPLICATED_FRUITS = {
+    "Fruits": {
+        "columns": [
+            ("fruit_id", "integer"),
+            ("Food_type", "text"),
+            ("last_updated", "timestamp without time zone"),
+        ],
+        "primary_key": "fruit_id",
+    }
+}
+
+
+class TestReplicationChanges:
+    def test_collapses_changes_per_primary_key(self):
+        rows = [
+            ["0/10", '{"action": "B"}'],
+            wal2json(
+                "I",
+                "Fruits",
+                {"fruit_id": 1, "Food_type": "Berry", "last_updated": "2024-01-01 10:00:00.5"},
+                "0/11",
+            ),
+            wal2json(
+                "U",
+                "Fruits",
+                {"fruit_id": 1, "Food_type": "Citrus", "last_updated": "2024-01-02 10:00:00"},
+                "0/12",
+            ),
+            wal2json("I", "Fruits", {"fruit_id": 2, "Food_type": "Pome"}, "0/13"),
+            wal2json("D", "Fruits", {"fruit_id": 2}, "0/14"),
+            wal2json("I", "audit_log", {"id": 1}, "0/15"),
+            ["0/16", '{"action": "C"}'],
+        ]
+        changes, last_commit = decode_changes(rows, REPLICATED_FRUITS)
+
+        assert last_commit == "0/16"
+        assert changes == {
+            "Fruits": {
+                "upserts": [
+                    {
+                        "fruit_id": 1,
+                        "Food_type": "Citrus",
+                        "last_updated": datetime(2024, 1, 2, 10, 0, 0),
+                    }
+                ],
+                "deletes": [{"fruit_id": 2}],
+            }
+        }
+
+    def test_no_commit_without_complete_transaction(self):
+        changes, last_commit = decode_changes([], REPLICATED_FRUITS)
+        assert changes == {}
+        assert last_commit is None
+
+    def test_uploads_changes_then_advances_slot(self, s3_client, s3_mock_bucket):
+        extract_database._catalog.update(REPLICATED_FRUITS)
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [[1]],
+            [
+                ["0/10", '{"action": "B"}'],
+                wal2json(
+                    "U",
+                    "Fruits",
+                    {"fruit_id": 3, "Food_type": "Berry", "last_updated": "2024-01-02 10:00:00"},
+                    "0/11",
+                ),
+                wal2json("D", "Fruits", {"fruit_id": 4}, "0/12"),
+                ["0/13", '{"action": "C"}'],
+            ],
+            [],
+        ]
+        result = process_replication_changes(
+            mock_db, {}, client=s3_client, batch_size=100, file_format="csv"
+        )
+
+        assert result["updated"] == ["Fruits"]
+        assert result["deleted"] == ["Fruits"]
+        advance = mock_db.run.call_args_list[2]
+        assert "pg_replication_slot_advance" in advance.args[0]
+        assert advance.kwargs["lsn"] == "0/13"
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+        ]
+        change_key = next(key for key in keys if key.startswith("Fruits/"))
+        delete_key = next(key for key in keys if key.startswith("_deletes/Fruits/"))
+        body = s3_client.get_object(Bucket="extract_bucket", Key=change_key)["Body"]
+        assert body.read().decode().splitlines() == [
+            "fruit_id,Food_type,last_updated",
+            "3,Berry,2024-01-02 10:00:00",
+        ]
+        body = s3_client.get_object(Bucket="extract_bucket", Key=delete_key)["Body"]
+        assert body.read().decode().splitlines()[0] == "fruit_id,deleted_at"
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 2, 10, 0, 0), 3)
+        }
+
+    def test_batches_in_the_same_second_get_their_own_keys(
+        self, s3_client, s3_mock_bucket
+    ):
+        extract_database._catalog.update(REPLICATED_FRUITS)
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [[1]],
+            [
+                ["0/10", '{"action": "B"}'],
+                wal2json("I", "Fruits", {"fruit_id": 3, "Food_type": "Berry"}, "0/11"),
+                ["0/12", '{"action": "C"}'],
+            ],
+            [],
+            [
+                ["0/20", '{"action": "B"}'],
+                wal2json("I", "Fruits", {"fruit_id": 4, "Food_type": "Drupe"}, "0/21"),
+                ["1/A2", '{"action": "C"}'],
+            ],
+            [],
+            [],
+        ]
+        process_replication_changes(
+            mock_db, {}, client=s3_client, batch_size=3, file_format="csv"
+        )
+
+        keys = sorted(
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+            if obj["Key"].startswith("Fruits/")
+        )
+        assert len(keys) == 2
+        assert keys[0].endswith("_changes_0000000000000012.csv")
+        assert keys[1].endswith("_changes_00000001000000A2.csv")
+
+    def test_slot_not_advanced_when_upload_fails(self, s3_client, s3_mock_bucket):
+        extract_database._catalog.update(REPLICATED_FRUITS)
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [[1]],
+            [
+                wal2json("I", "Fruits", {"fruit_id": 3, "Food_type": "Berry"}, "0/11"),
+                ["0/13", '{"action": "C"}'],
+            ],
+        ]
+        with patch(
+            "src.extract_cdc.upload_rows", return_value=False
+        ), pytest.raises(RuntimeError):
+            process_replication_changes(mock_db, {}, client=s3_client)
+
+        queries = [call.args[0] for call in mock_db.run.call_args_list]
+        assert not any("pg_replication_slot_advance" in query for query in queries)
+
+    def test_creates_missing_slot(self, s3_client, s3_mock_bucket):
+        extract_database._catalog.update(REPLICATED_FRUITS)
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [[], [], []]
+        result = process_replication_changes(mock_db, {}, client=s3_client)
+
+        assert "pg_create_logical_replication_slot" in mock_db.run.call_args_list[1].args[0]
+        assert result["updated"] == []
+        assert result["no change"] == ["Fruits"]
@@ -0,0 +1,306 @@
+import pytest
+from moto import mock_aws
+from unittest.mock import patch, MagicMock
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pg8000.native import InterfaceError
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_catalog_cache():
+    extract_database._catalog.clear()
+    yield
+    extract_database._catalog.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture
+def mock_conn():
+    with patch("src.extract_database.Connection") as mock:
+        yield mock
+
+
+@pytest.fixture(scope="function")
+def mock_config():
+    env_vars = json.dumps(
+        {
+            "host": "abc",
+            "port": "5432",
+            "user": "def",
+            "password": "password",
+            "database": "db",
+        }
+    )
+    with patch(
+        "src.extract_database.retrieve_secrets", return_value=env_vars
+    ) as mock_config:
+        yield mock_config
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+import src.extract_database as extract_database  # noqa: E402
+from src.runtime_context import context  # noqa: E402
+from src.extract_database import (  # noqa: E402
+    ConnectionPool,
+    DBConnectionException,
+    build_incremental_query,
+    connect_to_database,
+    describe_tables,
+    inline_parameters,
+    probe_changed_tables,
+    repeatable_read,
+)
+from datetime import datetime
+
+
+FRUITS_CATALOG = [
+    ["Fruits", "fruit_id", "integer", True],
+    ["Fruits", "Food_type", "text", False],
+    ["Fruits", "last_updated", "timestamp without time zone", False],
+]
+
+
+class TestConnectToDatabase:
+    def test_connect_to_database(mock_conn, mock_config):
+        with patch("src.extract_database.Connection", autospec=True) as mock_conn:
+            connect_to_database()
+            mock_conn.assert_called_with(
+                host="abc", user="def", port="5432", password="password", database="db"
+            )
+
+    def test_database_error(self, mock_config):  # had mock_config in param
+        with pytest.raises(DBConnectionException):
+            connect_to_database()
+
+    def test_logs_interface_error(self, caplog, mock_config):
+        # Use mock_config fixture which already mocks the retrieve_secrets
+        # function to return JSON string with DB connection details
+        logger = logging.getLogger()
+        logger.info("Testing now.")
+        caplog.set_level(logging.ERROR)
+
+        with patch(
+            "src.extract_database.Connection", side_effect=InterfaceError("Test error")
+        ), pytest.raises(DBConnectionException):
+            connect_to_database()
+
+        assert "Interface error" in caplog.text
+
+
+class TestBuildIncrementalQuery:
+    def test_uses_keyset_comparison_with_primary_key(self):
+        query, params = build_incremental_query(
+            "sales_order", "sales_order_id", (datetime(2024, 1, 1), 10)
+        )
+        assert "(last_updated, sales_order_id) > (:latest, :pk)" in query
+        assert "ORDER BY last_updated, sales_order_id" in query
+        assert params == {"latest": datetime(2024, 1, 1), "pk": 10}
+
+    def test_inclusive_timestamp_before_first_primary_key(self):
+        query, params = build_incremental_query(
+            "sales_order", "sales_order_id", (datetime(2024, 1, 1), None)
+        )
+        assert "last_updated >= :latest" in query
+        assert params == {"latest": datetime(2024, 1, 1)}
+
+    def test_limits_rows_for_chunking(self):
+        query, _ = build_incremental_query(
+            "sales_order", "sales_order_id", (datetime(2024, 1, 1), 10), limit=500
+        )
+        assert query.strip().endswith("LIMIT 500;")
+
+    def test_timestamp_only_without_primary_key(self):
+        query, params = build_incremental_query(
+            "sales_order", None, (datetime(2024, 1, 1), None)
+        )
+        assert "last_updated >= :latest" in query
+        assert "ORDER BY last_updated;" in query
+
+
+class TestInlineParameters:
+    def test_replaces_placeholders_with_literals(self):
+        query = inline_parameters(
+            "SELECT * FROM t WHERE (last_updated, t_id) > (:latest, :pk);",
+            {"latest": datetime(2024, 1, 1, 10, 30), "pk": 4},
+        )
+        assert query == (
+            "SELECT * FROM t WHERE (last_updated, t_id) > "
+            "('2024-01-01T10:30:00', 4);"
+        )
+
+
+class TestConnectionPool:
+    def test_reuses_idle_connections(self):
+        connect = MagicMock(side_effect=lambda: MagicMock())
+        pool = ConnectionPool(2, connect=connect)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        assert first is second
+        assert connect.call_count == 1
+
+    def test_never_exceeds_max_size(self):
+        connect = MagicMock(side_effect=lambda: MagicMock())
+        pool = ConnectionPool(2, connect=connect)
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(_):
+            with pool.connection() as db:
+                with lock:
+                    in_use.append(db)
+                    peak.append(len(in_use))
+                time.sleep(0.02)
+                with lock:
+                    in_use.remove(db)
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(work, range(12)))
+        assert max(peak) <= 2
+        assert connect.call_count <= 2
+
+    def test_discards_connection_that_raised(self):
+        connect = MagicMock(side_effect=lambda: MagicMock())
+        pool = ConnectionPool(1, connect=connect)
+        with pytest.raises(RuntimeError):
+            with pool.connection() as broken:
+                raise RuntimeError("query failed")
+        broken.close.assert_called_once()
+        with pool.connection() as db:
+            assert db is not broken
+
+    def test_close_closes_all_connections(self):
+        connect = MagicMock(side_effect=lambda: MagicMock())
+        pool = ConnectionPool(1, connect=connect)
+        with pool.connection() as db:
+            pass
+        pool.close()
+        db.close.assert_called_once()
+
+
+class TestRepeatableRead:
+    def test_exports_snapshot(self):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [[], [["00000003-1"]], []]
+        with repeatable_read(mock_db, export=True) as snapshot_id:
+            assert snapshot_id == "00000003-1"
+        queries = [call.args[0] for call in mock_db.run.call_args_list]
+        assert queries == [
+            "START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;",
+            "SELECT pg_export_snapshot();",
+            "COMMIT;",
+        ]
+
+    def test_attaches_to_snapshot(self):
+        mock_db = MagicMock()
+        with repeatable_read(mock_db, snapshot_id="00000003-1"):
+            pass
+        queries = [call.args[0] for call in mock_db.run.call_args_list]
+        assert queries[1] == "SET TRANSACTION SNAPSHOT '00000003-1';"
+
+    def test_rolls_back_on_error(self):
+        mock_db = MagicMock()
+        with pytest.raises(RuntimeError):
+            with repeatable_read(mock_db):
+                raise RuntimeError("query failed")
+        queries = [call.args[0] for call in mock_db.run.call_args_list]
+        assert queries[-1] == "ROLLBACK;"
+
+
+class TestDescribeTables:
+    def test_builds_catalog_and_caches_it(self):
+        mock_db = MagicMock()
+        mock_db.run.return_value = FRUITS_CATALOG + [
+            ["Links", "left_id", "integer", True],
+            ["Links", "right_id", "integer", True],
+        ]
+        result = describe_tables(mock_db)
+        assert result == {
+            "Fruits": {
+                "columns": [
+                    ("fruit_id", "integer"),
+                    ("Food_type", "text"),
+                    ("last_updated", "timestamp without time zone"),
+                ],
+                "primary_key": "fruit_id",
+            },
+            "Links": {
+                "columns": [("left_id", "integer"), ("right_id", "integer")],
+                "primary_key": None,
+            },
+        }
+        describe_tables(mock_db)
+        assert mock_db.run.call_count == 1
+        describe_tables(mock_db, refresh=True)
+        assert mock_db.run.call_count == 2
+
+
+class TestProbeChangedTables:
+    def test_probes_all_tables_in_one_query(self):
+        mock_db = MagicMock()
+        mock_db.run.return_value = [
+            ["Fruits", datetime(2024, 1, 2)],
+            ["Cars", None],
+        ]
+        catalog = {
+            "Fruits": {
+                "columns": [("fruit_id", "integer"), ("last_updated", "timestamp")],
+                "primary_key": "fruit_id",
+            },
+            "Cars": {
+                "columns": [("car_id", "integer"), ("last_updated", "timestamp")],
+                "primary_key": "car_id",
+            },
+            "Notes": {"columns": [("note", "text")], "primary_key": None},
+        }
+        result = probe_changed_tables(
+            mock_db, catalog, {"Fruits": (datetime(2024, 1, 1), 3)}
+        )
+        assert result == {"Fruits": datetime(2024, 1, 2)}
+        mock_db.run.assert_called_once()
+        query = mock_db.run.call_args.args[0]
+        assert query.count("UNION ALL") == 1
+        assert "(last_updated, fruit_id) > ('2024-01-01T00:00:00', 3)" in query
+        assert "Notes" not in query
+
+    def test_boundary_rows_of_table_without_primary_key_are_not_changes(self):
+        mock_db = MagicMock()
+        mock_db.run.return_value = [["Notes", None]]
+        catalog = {
+            "Notes": {
+                "columns": [("note", "text"), ("last_updated", "timestamp")],
+                "primary_key": None,
+            },
+        }
+        result = probe_changed_tables(
+            mock_db, catalog, {"Notes": (datetime(2024, 1, 1), ["digest"])}
+        )
+        assert result == {}
+        query = mock_db.run.call_args.args[0]
+        assert "last_updated > '2024-01-01T00:00:00'" in query
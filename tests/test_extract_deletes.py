@@ -0,0 +1,147 @@
+import pytest
+import boto3
+from moto import mock_aws
+from unittest.mock import MagicMock
+import os
+import hashlib
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def s3_mock_bucket(s3_client):
+    bucket = s3_client.create_bucket(
+        Bucket="extract_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return bucket
+
+
+from src.runtime_context import context  # noqa: E402
+from src.extract_deletes import (  # noqa: E402
+    block_hash,
+    decode_block,
+    detect_deleted_rows,
+    encode_block,
+    read_fingerprint,
+)
+
+
+class TestDetectDeletedRows:
+    catalog = {
+        "Fruits": {
+            "columns": [("fruit_id", "integer"), ("Food_type", "text")],
+            "primary_key": "fruit_id",
+        },
+        "Baskets": {"columns": [("name", "text")], "primary_key": "name"},
+    }
+
+    def test_block_bitmap_round_trip(self):
+        encoded = encode_block([8, 9, 15], 1, 8)
+        assert decode_block(encoded, 1, 8) == [8, 9, 15]
+
+    def test_block_hash_matches_postgres_string_agg(self):
+        assert block_hash([10, 2, 3]) == hashlib.md5(b"2,3,10").hexdigest()
+
+    def test_first_run_only_builds_fingerprint(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [["Fruits", 0, block_hash([1, 2])], ["Fruits", 1, block_hash([5])]],
+            [[1], [2], [5]],
+        ]
+        deleted = detect_deleted_rows(
+            mock_db, self.catalog, "extract_bucket", s3_client, "csv", block_size=4
+        )
+
+        assert deleted == []
+        # only the integer primary key is fingerprinted
+        assert "Baskets" not in mock_db.run.call_args_list[0].args[0]
+        fingerprint = read_fingerprint("Fruits", "extract_bucket", s3_client)
+        assert {
+            block: decode_block(bitmap, block, 4)
+            for block, bitmap in fingerprint["blocks"].items()
+        } == {0: [1, 2], 1: [5]}
+
+    def test_tombstones_keys_missing_from_changed_blocks(
+        self, s3_client, s3_mock_bucket
+    ):
+        first_run = MagicMock()
+        first_run.run.side_effect = [
+            [
+                ["Fruits", 0, block_hash([1, 2])],
+                ["Fruits", 1, block_hash([5, 6])],
+                ["Fruits", 2, block_hash([9])],
+            ],
+            [[1], [2], [5], [6], [9]],
+        ]
+        detect_deleted_rows(
+            first_run, self.catalog, "extract_bucket", s3_client, "csv", block_size=4
+        )
+
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [["Fruits", 0, block_hash([1, 2])], ["Fruits", 1, block_hash([5, 7])]],
+            [[5], [7]],
+        ]
+        deleted = detect_deleted_rows(
+            mock_db, self.catalog, "extract_bucket", s3_client, "csv", block_size=4
+        )
+
+        assert deleted == ["Fruits"]
+        block_query = mock_db.run.call_args_list[1].args[0]
+        assert "fruit_id >= 4 AND fruit_id < 8" in block_query
+        assert "fruit_id >= 0" not in block_query
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+            if obj["Key"].startswith("_deletes/Fruits/")
+        ]
+        body = s3_client.get_object(Bucket="extract_bucket", Key=keys[0])["Body"]
+        lines = body.read().decode().splitlines()
+        assert lines[0] == "fruit_id,deleted_at"
+        assert [line.split(",")[0] for line in lines[1:]] == ["6", "9"]
+        fingerprint = read_fingerprint("Fruits", "extract_bucket", s3_client)
+        assert sorted(fingerprint["blocks"]) == [0, 1]
+
+    def test_unchanged_table_runs_only_summary_query(self, s3_client, s3_mock_bucket):
+        first_run = MagicMock()
+        first_run.run.side_effect = [[["Fruits", 0, block_hash([1])]], [[1]]]
+        detect_deleted_rows(
+            first_run, self.catalog, "extract_bucket", s3_client, "csv", block_size=4
+        )
+
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [[["Fruits", 0, block_hash([1])]]]
+        assert (
+            detect_deleted_rows(
+                mock_db, self.catalog, "extract_bucket", s3_client, "csv", block_size=4
+            )
+            == []
+        )
+        assert mock_db.run.call_count == 1
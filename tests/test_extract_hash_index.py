@@ -0,0 +1,134 @@
+import pytest
+import boto3
+from moto import mock_aws
+from unittest.mock import MagicMock
+import os
+import time
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def s3_mock_bucket(s3_client):
+    bucket = s3_client.create_bucket(
+        Bucket="extract_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return bucket
+
+
+from src.runtime_context import context  # noqa: E402
+from src.extract_hash_index import (  # noqa: E402
+    RowHashIndex,
+)
+from src.extract_lambda import (  # noqa: E402
+    extract_table,
+)
+from src.extract_storage import (  # noqa: E402
+    read_watermarks,
+)
+from datetime import datetime
+
+
+class TestRowHashIndex:
+    columns = {
+        "fruit_id": "integer",
+        "Food_type": "text",
+        "last_updated": "timestamp without time zone",
+    }
+
+    def extract(self, s3_client, rows):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [rows]
+        mock_db.columns = [
+            {"name": "fruit_id"},
+            {"name": "Food_type"},
+            {"name": "last_updated"},
+        ]
+        return extract_table(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2023, 1, 1), 0),
+            "extract_bucket",
+            s3_client,
+            column_types=self.columns,
+            chunk_size=10,
+            suppress_unchanged=True,
+        )
+
+    def fruit_keys(self, s3_client):
+        return sorted(
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+            if obj["Key"].startswith("Fruits/")
+        )
+
+    def test_drops_rows_with_only_audit_changes(self, s3_client, s3_mock_bucket):
+        self.extract(
+            s3_client,
+            [[1, "Berry", datetime(2024, 1, 1)], [2, "Citrus", datetime(2024, 1, 1)]],
+        )
+        first_keys = self.fruit_keys(s3_client)
+        time.sleep(1)
+
+        result = self.extract(
+            s3_client,
+            [[1, "Berry", datetime(2024, 1, 2)], [2, "Pome", datetime(2024, 1, 2)]],
+        )
+
+        assert result == "updated"
+        new_keys = [key for key in self.fruit_keys(s3_client) if key not in first_keys]
+        body = s3_client.get_object(Bucket="extract_bucket", Key=new_keys[0])["Body"]
+        assert body.read().decode().splitlines()[1:] == ["2,Pome,2024-01-02 00:00:00"]
+
+    def test_moves_watermark_when_every_row_unchanged(self, s3_client, s3_mock_bucket):
+        self.extract(s3_client, [[1, "Berry", datetime(2024, 1, 1)]])
+        first_keys = self.fruit_keys(s3_client)
+
+        result = self.extract(s3_client, [[1, "Berry", datetime(2024, 1, 5)]])
+
+        assert result == "no change"
+        assert self.fruit_keys(s3_client) == first_keys
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 5), 1)
+        }
+
+    def test_index_is_sharded_by_primary_key(self, s3_client, s3_mock_bucket):
+        index = RowHashIndex("Fruits", "fruit_id", "extract_bucket", s3_client, 100)
+        index.changed_rows([[5, "Berry"], [250, "Citrus"]], ["fruit_id", "Food_type"])
+        index.save()
+
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+        ]
+        assert sorted(keys) == ["_hashes/Fruits/0.bin", "_hashes/Fruits/2.bin"]
+        reloaded = RowHashIndex("Fruits", "fruit_id", "extract_bucket", s3_client, 100)
+        assert reloaded.changed_rows([[5, "Berry"]], ["fruit_id", "Food_type"]) == []
@@ -3,12 +3,16 @@ import botocore.exceptions
 import pytest
 import boto3
 from moto import mock_aws
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 from unittest import TestCase
 import os
 import logging
 import json
-from pg8000.native import InterfaceError
+import gzip
+from decimal import Decimal
+from io import BytesIO
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -17,29 +21,26 @@ def aws_mocks():
         yield
 
 
+@pytest.fixture(scope="function", autouse=True)
+def clear_catalog_cache():
+    extract_database._catalog.clear()
+    yield
+    extract_database._catalog.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
 @pytest.fixture
 def mock_conn():
-    with patch("src.extract_lambda.Connection") as mock:
+    with patch("src.extract_database.Connection") as mock:
         yield mock
 
 
-@pytest.fixture(scope="function")
-def mock_config():
-    env_vars = json.dumps(
-        {
-            "host": "abc",
-            "port": "5432",
-            "user": "def",
-            "password": "password",
-            "database": "db",
-        }
-    )
-    with patch(
-        "src.extract_lambda.retrieve_secrets", return_value=env_vars
-    ) as mock_config:
-        yield mock_config
-
-
 @pytest.fixture(scope="function", autouse=True)
 def aws_credentials():
     os.environ["AWS_ACCESS_KEY_ID"] = "testing"
@@ -64,18 +65,41 @@ def s3_mock_bucket(s3_client):
     return bucket
 
 
+import src.extract_database as extract_database  # noqa: E402
+from src.runtime_context import context  # noqa: E402
 from src.extract_lambda import (  # noqa: E402
-    list_existing_s3_files,
-    connect_to_database,
-    DBConnectionException,
     lambda_handler,
     process_and_upload_tables,
-    retrieve_secrets,
-    extract_bucket,
+    extract_table,
+    time_budget,
+    read_continuation,
+    write_continuation,
+    is_due,
+    update_schedule,
+    CHANGE_HISTORY,
+)
+from src.extract_storage import (  # noqa: E402
+    read_watermarks,
+    rows_to_arrow_table,
 )
+from datetime import datetime, timedelta
+
+
+FRUITS_CATALOG = [
+    ["Fruits", "fruit_id", "integer", True],
+    ["Fruits", "Food_type", "text", False],
+    ["Fruits", "last_updated", "timestamp without time zone", False],
+]
 
 
 class TestLambdaHandler:
+    @pytest.fixture(autouse=True)
+    def no_continuation(self, mocker):
+        mocker.patch("src.extract_lambda.read_continuation", return_value=[])
+        mocker.patch("src.extract_lambda.write_continuation")
+        mocker.patch("src.extract_lambda.read_schedule", return_value={})
+        mocker.patch("src.extract_lambda.write_schedule")
+
     def test_files_processed_and_uploaded_successfully(self, mocker):
         mock_db = MagicMock()
         mock_db.run.side_effect = [
@@ -94,22 +118,26 @@ class TestLambdaHandler:
                 return_value={
                     "updated": ["Fruits"],
                     "no change": ["Vegetable", "Berry"],
+                    "remaining": [],
                 },
             )
-            mock_list_existing_s3_files = mocker.patch(
-                "src.extract_lambda.list_existing_s3_files", return_value={}
+            mock_read_watermarks = mocker.patch(
+                "src.extract_lambda.read_watermarks", return_value={}
             )
             event = {}
             context = {}
             response = lambda_handler(event, context)
             assert response["statusCode"] == 200
             assert json.loads(response["body"]) == (
-                "CSV files processed for Fruits and uploaded successfully."
-                "The following tables were not updated: Vegetable, Berry"
+                "Extracts of Fruits uploaded successfully."
+                " The following tables were not updated: Vegetable, Berry"
             )
-            mock_list_existing_s3_files.assert_called_once()
-            mock_process_and_upload_tables.assert_called_once_with(mock_db, {})
-            mock_db.close.assert_called_once()
+            mock_read_watermarks.assert_called_once()
+            mock_process_and_upload_tables.assert_called_once_with(
+                mock_db, {}, out_of_time=ANY, priority=[], schedule={}
+            )
+            # kept open for the next warm invocation
+            mock_db.close.assert_not_called()
 
     def test_no_changes_detected_no_files_uploaded(self, mocker):
         mock_db = MagicMock()
@@ -127,10 +155,10 @@ class TestLambdaHandler:
         with patch("src.extract_lambda.connect_to_database", return_value=mock_db):
             mock_process_and_upload_tables = mocker.patch(
                 "src.extract_lambda.process_and_upload_tables",
-                return_value={"updated": [], "no change": ["Fruits"]},
+                return_value={"updated": [], "no change": ["Fruits"], "remaining": []},
             )
-            mock_list_existing_s3_files = mocker.patch(
-                "src.extract_lambda.list_existing_s3_files", return_value={}
+            mock_read_watermarks = mocker.patch(
+                "src.extract_lambda.read_watermarks", return_value={}
             )
             event = {}
             context = {}
@@ -138,11 +166,14 @@ class TestLambdaHandler:
             assert response["statusCode"] == 200
             assert (
                 json.loads(response["body"])
-                == "No changes detected, no CSV files were uploaded."
+                == "No changes detected, no extracts were uploaded."
             )
-            mock_list_existing_s3_files.assert_called_once()
-            mock_process_and_upload_tables.assert_called_once_with(mock_db, {})
-            mock_db.close.assert_called_once()
+            mock_read_watermarks.assert_called_once()
+            mock_process_and_upload_tables.assert_called_once_with(
+                mock_db, {}, out_of_time=ANY, priority=[], schedule={}
+            )
+            # kept open for the next warm invocation
+            mock_db.close.assert_not_called()
 
     def test_exception_error(self, mocker):
         with patch(
@@ -152,94 +183,47 @@ class TestLambdaHandler:
             mock_process_and_upload_tables = mocker.patch(
                 "src.extract_lambda.process_and_upload_tables"
             )
-            mock_list_existing_s3_files = mocker.patch(
-                "src.extract_lambda.list_existing_s3_files"
+            mock_read_watermarks = mocker.patch(
+                "src.extract_lambda.read_watermarks"
             )
             event = {}
             context = {}
             response = lambda_handler(event, context)
             assert response["statusCode"] == 500
             assert json.loads(response["body"]) == "Internal server error."
-            mock_list_existing_s3_files.assert_not_called()
+            mock_read_watermarks.assert_not_called()
             mock_process_and_upload_tables.assert_not_called()
 
-
-class TestExtractBucket:
-    def test_extract_bucket_returns_bucket_name(self, s3_client, s3_mock_bucket):
-        result = extract_bucket(s3_client)
-        assert result == "extract_bucket"
-
-    def test_bucket_returns_first_bucket(self, s3_client):
-        # Redefine what the test does
-        # Create two buckets and check that only extract_bucket is returned
-
-        s3_client.create_bucket(
-            Bucket="extract_bucket",
-            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
-        )
-        s3_client.create_bucket(
-            Bucket="bucket1",
-            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    def test_reuses_connection_across_warm_invocations(self, mocker):
+        mock_db = MagicMock()
+        mocker.patch(
+            "src.extract_lambda.process_and_upload_tables",
+            return_value={"updated": [], "no change": [], "remaining": []},
         )
-        result = extract_bucket(s3_client)
-        assert result == "extract_bucket"
-
-    def test_raises_value_error_if_no_buckets(self, s3_client):
-        with pytest.raises(ValueError, match="No extract_bucket found"):
-            extract_bucket(s3_client)
-
-
-class TestListExistingS3Files:
-    def test_error_if_no_bucket(self, s3_client, caplog):
-        logger = logging.getLogger()
-        logger.info("Testing now.")
-        caplog.set_level(logging.ERROR)
-
-        # Mock the extract_bucket function to raise a ValueError!
+        mocker.patch("src.extract_lambda.read_watermarks", return_value={})
         with patch(
-            "src.extract_lambda.extract_bucket",
-            side_effect=ValueError("No extract_bucket found"),
-        ):
-            with pytest.raises(ValueError, match="No extract_bucket found"):
-                list_existing_s3_files(client=s3_client)
-
-        assert "Error listing S3 objects" in caplog.text
-
-    def test_error_if_bucket_is_empty(self, s3_client, caplog, s3_mock_bucket):
-        list_existing_s3_files("extract_bucket", client=s3_client)
-        assert "The bucket is empty" in caplog.text
-
-    def test_retrieves_file_content(self, s3_client, caplog, s3_mock_bucket):
-        s3_client.upload_file("tests/dummy.txt", "extract_bucket", "dummy.txt")
-        result = list_existing_s3_files("extract_bucket", client=s3_client)
-        assert list(result.values()) == ["This is a test file."]
-
-
-class TestConnectToDatabase:
-    def test_connect_to_database(mock_conn, mock_config):
-        with patch("src.extract_lambda.Connection", autospec=True) as mock_conn:
-            connect_to_database()
-            mock_conn.assert_called_with(
-                host="abc", user="def", port="5432", password="password", database="db"
-            )
-
-    def test_database_error(self, mock_config):  # had mock_config in param
-        with pytest.raises(DBConnectionException):
-            connect_to_database()
-
-    def test_logs_interface_error(self, caplog, mock_config):
-        # Use mock_config fixture which already mocks the retrieve_secrets
-        # function to return JSON string with DB connection details
-        logger = logging.getLogger()
-        logger.info("Testing now.")
-        caplog.set_level(logging.ERROR)
-
+            "src.extract_lambda.connect_to_database", return_value=mock_db
+        ) as mock_connect:
+            lambda_handler({}, {})
+            lambda_handler({}, {})
+        mock_connect.assert_called_once()
+        mock_db.run.assert_called_with("SELECT 1;")
+
+    def test_discards_connection_after_error(self, mocker):
+        mock_db = MagicMock()
+        mocker.patch(
+            "src.extract_lambda.process_and_upload_tables",
+            side_effect=Exception("Query failed"),
+        )
+        mocker.patch("src.extract_lambda.read_watermarks", return_value={})
         with patch(
-            "src.extract_lambda.Connection", side_effect=InterfaceError("Test error")
-        ), pytest.raises(DBConnectionException):
-            connect_to_database()
-
-        assert "Interface error" in caplog.text
+            "src.extract_lambda.connect_to_database", return_value=mock_db
+        ) as mock_connect:
+            response = lambda_handler({}, {})
+            mock_db.close.assert_called_once()
+            lambda_handler({}, {})
+        assert response["statusCode"] == 500
+        assert mock_connect.call_count == 2
 
 
 class TestProcessAndUploadTables:
@@ -254,14 +238,18 @@ class TestProcessAndUploadTables:
             "SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS where table_name = 'Fruits';",
         ]
         return_values = [
-            [["Fruits"]],
-            [],  # No new rows with a more recent last_updated timestamp
-            [["Food_type"], ["Flavour"], ["Colour"], ["last_updated"]],
+            [],  # START TRANSACTION
+            [
+                ["Fruits", "Food_type", "text", True],
+                ["Fruits", "last_updated", "timestamp without time zone", False],
+            ],
+            [["Fruits", None]],  # No new rows with a more recent last_updated timestamp
+            [],  # COMMIT
         ]
         vals = dict(zip(queries, return_values))
 
         # Patch the database connection and set return values for queries
-        with patch("src.extract_lambda.Connection") as mock_db:
+        with patch("src.extract_database.Connection") as mock_db:
             mock_db().run.side_effect = return_values
             s3_key = "Fruits/2024/08/15/Fruits_16:46:30.csv"
             existing_files = {
@@ -278,6 +266,558 @@ class TestProcessAndUploadTables:
             )
 
             # Run the process_and_upload_tables function
-            process_and_upload_tables(mock_db(), existing_files, client=s3_client)
+            process_and_upload_tables(
+                mock_db(), {}, client=s3_client, bucket_name="test_extract_bucket"
+            )
             # Assert that the log contains "No new data"
             assert "No new data" in caplog.text
+            queries = [call.args[0] for call in mock_db().run.call_args_list]
+            assert not any("SELECT * FROM" in query for query in queries)
+
+    def test_uploads_rows_and_moves_watermark(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [],
+            FRUITS_CATALOG,
+            [["Fruits", datetime(2022, 11, 4, 9, 0, 0)]],
+            [
+                [3, "Vegetable", datetime(2022, 11, 3, 14, 20, 49, 962000)],
+                [1, "Berry", datetime(2022, 11, 4, 9, 0, 0)],
+            ],
+            [],
+        ]
+        mock_db.columns = [
+            {"name": "fruit_id"},
+            {"name": "Food_type"},
+            {"name": "last_updated"},
+        ]
+        result = process_and_upload_tables(
+            mock_db, {"Fruits": (datetime(2022, 11, 1), 5)}, client=s3_client
+        )
+
+        assert result["updated"] == ["Fruits"]
+        assert result["no change"] == []
+        assert mock_db.run.call_args_list[3].kwargs == {
+            "latest": datetime(2022, 11, 1),
+            "pk": 5,
+        }
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+        ]
+        assert "_watermarks/Fruits.json" in keys
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2022, 11, 4, 9, 0, 0), 1)
+        }
+
+
+class TestParallelExtract:
+    def test_tables_extracted_on_pooled_connections(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [],
+            [["snapshot-1"]],
+            [
+                ["Cars", "last_updated", "timestamp without time zone", False],
+                ["Foods", "last_updated", "timestamp without time zone", False],
+                *FRUITS_CATALOG,
+            ],
+            [
+                ["Cars", datetime(2024, 1, 2)],
+                ["Foods", datetime(2024, 1, 2)],
+                ["Fruits", datetime(2024, 1, 2)],
+            ],
+            [],
+        ]
+        used_connections = {}
+
+        def fake_extract(table_db, table_name, *args, **kwargs):
+            used_connections[table_name] = table_db
+            return "no change" if table_name == "Cars" else "updated"
+
+        with patch(
+            "src.extract_database.connect_to_database",
+            side_effect=lambda: MagicMock(),
+        ) as mock_connect, patch(
+            "src.extract_lambda.extract_table", side_effect=fake_extract
+        ):
+            result = process_and_upload_tables(
+                mock_db, {}, client=s3_client, workers=2
+            )
+
+        assert sorted(result["updated"]) == ["Foods", "Fruits"]
+        assert result["no change"] == ["Cars"]
+        assert set(result["timings"]) == {"Fruits", "Cars", "Foods"}
+        assert mock_db not in used_connections.values()
+        assert mock_connect.call_count <= 2
+        for table_db in used_connections.values():
+            queries = [call.args[0] for call in table_db.run.call_args_list]
+            assert "SET TRANSACTION SNAPSHOT 'snapshot-1';" in queries
+            assert queries[-1] == "COMMIT;"
+        coordinator_queries = [call.args[0] for call in mock_db.run.call_args_list]
+        assert coordinator_queries[0].startswith(
+            "START TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+        )
+        assert coordinator_queries[-1] == "COMMIT;"
+
+
+class TestTypedExtract:
+    def test_rows_to_arrow_table_uses_catalog_types(self):
+        rows = [
+            [1, Decimal("2.50"), datetime(2024, 1, 1, 9, 30), None, True],
+            [2, None, datetime(2024, 1, 2), 4, False],
+        ]
+        table = rows_to_arrow_table(
+            rows,
+            ["fruit_id", "price", "last_updated", "box_id", "ripe"],
+            {
+                "fruit_id": "integer",
+                "price": "numeric",
+                "last_updated": "timestamp without time zone",
+                "box_id": "integer",
+                "ripe": "boolean",
+            },
+        )
+        assert table.schema.field("fruit_id").type == pa.int32()
+        assert table.schema.field("price").type == pa.float64()
+        assert table.schema.field("last_updated").type == pa.timestamp("us")
+        assert table.schema.field("box_id").type == pa.int32()
+        assert table.schema.field("ripe").type == pa.bool_()
+        assert table.column("price").to_pylist() == [2.5, None]
+
+    @pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+    def test_uploads_typed_file(self, s3_client, s3_mock_bucket, file_format):
+        mock_db = MagicMock()
+        mock_db.run.return_value = [[1, "Berry", datetime(2024, 1, 2)]]
+        mock_db.columns = [
+            {"name": "fruit_id"},
+            {"name": "Food_type"},
+            {"name": "last_updated"},
+        ]
+        result = extract_table(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2024, 1, 1), 0),
+            "extract_bucket",
+            s3_client,
+            file_format=file_format,
+            column_types={
+                "fruit_id": "integer",
+                "Food_type": "text",
+                "last_updated": "timestamp without time zone",
+            },
+        )
+
+        assert result == "updated"
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+        ]
+        [data_key] = [key for key in keys if key.startswith("Fruits/")]
+        assert data_key.endswith(f".{file_format}")
+        body = BytesIO(
+            s3_client.get_object(Bucket="extract_bucket", Key=data_key)["Body"].read()
+        )
+        if file_format == "parquet":
+            table = pq.read_table(body)
+        else:
+            table = pa.ipc.open_file(body).read_all()
+        assert table.schema.field("fruit_id").type == pa.int32()
+        assert table.schema.field("last_updated").type == pa.timestamp("us")
+        assert table.to_pylist() == [
+            {
+                "fruit_id": 1,
+                "Food_type": "Berry",
+                "last_updated": datetime(2024, 1, 2),
+            }
+        ]
+
+
+class TestChunkedExtract:
+    @staticmethod
+    def chunked_db(chunks):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = chunks
+        mock_db.columns = [{"name": "fruit_id"}, {"name": "last_updated"}]
+        return mock_db
+
+    def test_pages_table_into_part_files(self, s3_client, s3_mock_bucket):
+        mock_db = self.chunked_db(
+            [
+                [[1, datetime(2024, 1, 1)], [2, datetime(2024, 1, 2)]],
+                [[3, datetime(2024, 1, 3)], [4, datetime(2024, 1, 3)]],
+                [[5, datetime(2024, 1, 4)]],
+            ]
+        )
+        result = extract_table(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2023, 1, 1), 0),
+            "extract_bucket",
+            s3_client,
+            chunk_size=2,
+        )
+
+        assert result == "updated"
+        keys = sorted(
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+            if obj["Key"].startswith("Fruits/")
+        )
+        assert [key.rsplit("_", 1)[1] for key in keys] == [
+            "part0001.csv",
+            "part0002.csv",
+            "part0003.csv",
+        ]
+        queries = mock_db.run.call_args_list
+        assert queries[1].kwargs == {"latest": datetime(2024, 1, 2), "pk": 2}
+        assert queries[2].kwargs == {"latest": datetime(2024, 1, 3), "pk": 4}
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 4), 5)
+        }
+
+    def test_table_without_primary_key_extracts_each_row_once(
+        self, s3_client, s3_mock_bucket
+    ):
+        noon = datetime(2024, 1, 1, 12)
+        mock_db = MagicMock()
+        mock_db.columns = [{"name": "note"}, {"name": "last_updated"}]
+        mock_db.run.side_effect = [
+            [["Berry", noon]],
+            # the boundary is inclusive, so Berry is read again with a late row
+            [["Berry", noon], ["Citrus", noon]],
+            [["Berry", noon], ["Citrus", noon]],
+        ]
+        bodies = []
+        original_put_object = s3_client.put_object
+
+        def put_object(**kwargs):
+            if kwargs["Key"].startswith("Notes/"):
+                bodies.append(kwargs["Body"])
+            return original_put_object(**kwargs)
+
+        results = []
+        watermark = (datetime(2023, 1, 1), None)
+        with patch.object(s3_client, "put_object", side_effect=put_object):
+            for _ in range(3):
+                results.append(
+                    extract_table(
+                        mock_db, "Notes", None, watermark, "extract_bucket", s3_client
+                    )
+                )
+                watermark = read_watermarks("extract_bucket", client=s3_client)[
+                    "Notes"
+                ]
+
+        assert results == ["updated", "updated", "no change"]
+        rows = [
+            line
+            for body in bodies
+            for line in body.decode().splitlines()[1:]
+        ]
+        assert sorted(row.split(",")[0] for row in rows) == ["Berry", "Citrus"]
+        assert watermark[0] == noon and len(watermark[1]) == 2
+
+    def test_failed_chunk_leaves_checkpoint_at_last_completed_chunk(
+        self, s3_client, s3_mock_bucket
+    ):
+        mock_db = self.chunked_db(
+            [
+                [[1, datetime(2024, 1, 1)], [2, datetime(2024, 1, 2)]],
+                [[3, datetime(2024, 1, 3)], [4, datetime(2024, 1, 3)]],
+            ]
+        )
+        uploads = []
+        original_put_object = s3_client.put_object
+
+        def put_object(**kwargs):
+            if kwargs["Key"].startswith("Fruits/"):
+                uploads.append(kwargs["Key"])
+                if len(uploads) == 2:
+                    raise botocore.exceptions.ClientError(
+                        {"Error": {"Code": "500", "Message": "Internal"}}, "PutObject"
+                    )
+            return original_put_object(**kwargs)
+
+        with patch.object(s3_client, "put_object", side_effect=put_object):
+            result = extract_table(
+                mock_db,
+                "Fruits",
+                "fruit_id",
+                (datetime(2023, 1, 1), 0),
+                "extract_bucket",
+                s3_client,
+                chunk_size=2,
+            )
+
+        assert result is None
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 2), 2)
+        }
+
+    def test_compressed_chunks_are_built_in_memory(self, s3_client, s3_mock_bucket):
+        mock_db = self.chunked_db([[[1, datetime(2024, 1, 1)]]])
+        with patch("builtins.open") as mock_open:
+            extract_table(
+                mock_db,
+                "Fruits",
+                "fruit_id",
+                (datetime(2023, 1, 1), 0),
+                "extract_bucket",
+                s3_client,
+                chunk_size=2,
+                compression="gzip",
+            )
+        mock_open.assert_not_called()
+
+        [key] = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="extract_bucket")["Contents"]
+            if obj["Key"].startswith("Fruits/")
+        ]
+        assert key.endswith("_part0001.csv.gz")
+        body = s3_client.get_object(Bucket="extract_bucket", Key=key)
+        assert body["ContentEncoding"] == "gzip"
+        assert body["ContentType"] == "text/csv"
+        assert gzip.decompress(body["Body"].read()).decode().splitlines() == [
+            "fruit_id,last_updated",
+            "1,2024-01-01 00:00:00",
+        ]
+
+    def test_no_chunking_without_primary_key(self, s3_client, s3_mock_bucket):
+        mock_db = self.chunked_db([[[1, datetime(2024, 1, 1)], [2, datetime(2024, 1, 2)]]])
+        result = extract_table(
+            mock_db,
+            "Fruits",
+            None,
+            (datetime(2023, 1, 1), None),
+            "extract_bucket",
+            s3_client,
+            chunk_size=2,
+        )
+        assert result == "updated"
+        assert mock_db.run.call_count == 1
+        assert "LIMIT" not in mock_db.run.call_args.args[0]
+
+
+class FakeLambdaContext:
+    invoked_function_arn = "arn:aws:lambda:eu-west-2:123456789012:function:extract"
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = list(remaining_ms)
+
+    def get_remaining_time_in_millis(self):
+        if len(self.remaining_ms) > 1:
+            return self.remaining_ms.pop(0)
+        return self.remaining_ms[0]
+
+
+class TestTimeBudget:
+    def test_no_deadline_without_lambda_context(self):
+        assert time_budget({})() is False
+        assert time_budget(None)() is False
+
+    def test_out_of_time_within_margin(self):
+        out_of_time = time_budget(FakeLambdaContext([60000, 19000]), margin=20)
+        assert out_of_time() is False
+        assert out_of_time() is True
+
+    def test_stops_after_chunk_and_keeps_checkpoint(self, s3_client, s3_mock_bucket):
+        mock_db = TestChunkedExtract.chunked_db(
+            [
+                [[1, datetime(2024, 1, 1)], [2, datetime(2024, 1, 2)]],
+                [[3, datetime(2024, 1, 3)], [4, datetime(2024, 1, 3)]],
+            ]
+        )
+        result = extract_table(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2023, 1, 1), 0),
+            "extract_bucket",
+            s3_client,
+            chunk_size=2,
+            out_of_time=lambda: True,
+        )
+
+        assert result == "partial"
+        assert mock_db.run.call_count == 1
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 2), 2)
+        }
+
+    def test_defers_tables_not_started_in_time(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [],
+            FRUITS_CATALOG,
+            [["Fruits", datetime(2022, 11, 4, 9, 0, 0)]],
+            [],
+        ]
+        result = process_and_upload_tables(
+            mock_db, {}, client=s3_client, out_of_time=lambda: True
+        )
+
+        assert result["remaining"] == ["Fruits"]
+        assert result["updated"] == []
+        assert "Fruits" not in result["timings"]
+        assert read_watermarks("extract_bucket", client=s3_client) == {}
+
+    def test_continuation_round_trip(self, s3_client, s3_mock_bucket):
+        assert read_continuation("extract_bucket", client=s3_client) == []
+        write_continuation(["Fruits", "Berries"], "extract_bucket", client=s3_client)
+        assert read_continuation("extract_bucket", client=s3_client) == [
+            "Fruits",
+            "Berries",
+        ]
+        # kept out of the watermark manifest
+        assert read_watermarks("extract_bucket", client=s3_client) == {}
+
+    def test_handler_saves_continuation_and_invokes_itself(self, mocker):
+        mocker.patch("src.extract_lambda.read_schedule", return_value={})
+        mocker.patch("src.extract_lambda.write_schedule")
+        mocker.patch("src.extract_lambda.connect_to_database", return_value=MagicMock())
+        mocker.patch("src.extract_lambda.read_watermarks", return_value={})
+        mocker.patch("src.extract_lambda.read_continuation", return_value=["Berries"])
+        mock_write = mocker.patch("src.extract_lambda.write_continuation")
+        mock_process = mocker.patch(
+            "src.extract_lambda.process_and_upload_tables",
+            return_value={"updated": ["Berries"], "no change": [], "remaining": ["Fruits"]},
+        )
+        mocker.patch("src.extract_lambda.EXTRACT_SELF_INVOKE", True)
+        mock_lambda = MagicMock()
+        mocker.patch.object(context, "client", return_value=mock_lambda)
+
+        response = lambda_handler({}, FakeLambdaContext([600000]))
+
+        assert response["statusCode"] == 200
+        assert mock_process.call_args.kwargs["priority"] == ["Berries"]
+        mock_write.assert_called_once_with(["Fruits"])
+        mock_lambda.invoke.assert_called_once_with(
+            FunctionName=FakeLambdaContext.invoked_function_arn,
+            InvocationType="Event",
+            Payload=b'{"continuation": true}',
+        )
+
+    def test_handler_clears_finished_continuation(self, mocker):
+        mocker.patch("src.extract_lambda.read_schedule", return_value={})
+        mocker.patch("src.extract_lambda.write_schedule")
+        mocker.patch("src.extract_lambda.connect_to_database", return_value=MagicMock())
+        mocker.patch("src.extract_lambda.read_watermarks", return_value={})
+        mocker.patch("src.extract_lambda.read_continuation", return_value=["Fruits"])
+        mock_write = mocker.patch("src.extract_lambda.write_continuation")
+        mocker.patch(
+            "src.extract_lambda.process_and_upload_tables",
+            return_value={"updated": ["Fruits"], "no change": [], "remaining": []},
+        )
+
+        lambda_handler({}, {})
+
+        mock_write.assert_called_once_with([])
+
+
+class TestPollSchedule:
+    now = datetime(2024, 1, 1, 12, 0, 0)
+
+    def test_quiet_table_backs_off_with_time_since_last_change(self):
+        schedule = {}
+        policies = {"Fruits": {"min_interval": 0, "max_interval": 10000}}
+        intervals = []
+        for hour in range(0, 10, 2):
+            now = self.now + timedelta(hours=hour)
+            update_schedule(schedule, "Fruits", False, now, policies)
+            intervals.append(schedule["Fruits"]["interval"])
+        assert intervals == [0, 3600, 7200, 10000, 10000]
+
+        now = self.now + timedelta(hours=10)
+        update_schedule(schedule, "Fruits", True, now, policies)
+        assert schedule["Fruits"]["interval"] == 0
+        assert schedule["Fruits"]["changes"] == [now.isoformat()]
+
+    def test_interval_follows_observed_change_rate(self):
+        schedule = {}
+        policies = {"Fruits": {"min_interval": 0, "max_interval": 10000}}
+        for hour in range(0, 8, 2):
+            now = self.now + timedelta(hours=hour)
+            update_schedule(schedule, "Fruits", True, now, policies)
+        assert schedule["Fruits"]["interval"] == 3600
+
+        update_schedule(
+            schedule, "Fruits", False, now + timedelta(minutes=30), policies
+        )
+        assert schedule["Fruits"]["interval"] == 3600
+
+    def test_change_history_is_bounded(self):
+        schedule = {}
+        for minute in range(20):
+            now = self.now + timedelta(minutes=minute)
+            update_schedule(schedule, "Fruits", True, now)
+        assert len(schedule["Fruits"]["changes"]) == CHANGE_HISTORY
+        assert schedule["Fruits"]["changes"][-1] == now.isoformat()
+
+    def test_source_tables_of_facts_are_polled_every_run(self):
+        schedule = {}
+        for table in ("sales_order", "purchase_order", "payment", "transaction"):
+            for hour in (0, 6):
+                update_schedule(
+                    schedule, table, False, self.now + timedelta(hours=hour)
+                )
+            assert schedule[table]["interval"] == 0
+
+    def test_busy_policy_is_polled_every_run(self):
+        schedule = {}
+        update_schedule(schedule, "sales_order", False, self.now)
+        assert schedule["sales_order"]["interval"] == 0
+        assert is_due("sales_order", schedule, self.now)
+
+    def test_due_once_interval_has_passed(self):
+        schedule = {"Fruits": {"last_polled": "2024-01-01T11:00:00", "interval": 7200}}
+        assert is_due("Berries", schedule, self.now)
+        assert not is_due("Fruits", schedule, self.now)
+        assert is_due("Fruits", schedule, datetime(2024, 1, 1, 12, 59, 0))
+
+    def test_tables_not_due_are_not_probed(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [[], FRUITS_CATALOG, []]
+        schedule = {
+            "Fruits": {
+                "last_polled": datetime.today().isoformat(),
+                "interval": 3600,
+            }
+        }
+        result = process_and_upload_tables(
+            mock_db, {}, client=s3_client, schedule=schedule
+        )
+
+        assert result["no change"] == ["Fruits"]
+        assert mock_db.run.call_count == 3
+        assert schedule["Fruits"]["interval"] == 3600
+
+    def test_snapshot_policy_reloads_whole_table(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [],
+            FRUITS_CATALOG,
+            [["Fruits", datetime(2024, 1, 2)]],
+            [[1, "Berry", datetime(2020, 1, 1)], [2, "Citrus", datetime(2024, 1, 2)]],
+            [],
+        ]
+        mock_db.columns = [
+            {"name": "fruit_id"},
+            {"name": "Food_type"},
+            {"name": "last_updated"},
+        ]
+        schedule = {}
+        result = process_and_upload_tables(
+            mock_db,
+            {"Fruits": (datetime(2024, 1, 1), 5)},
+            client=s3_client,
+            schedule=schedule,
+            policies={"Fruits": {"mode": "snapshot", "min_interval": 600}},
+        )
+
+        assert result["updated"] == ["Fruits"]
+        assert mock_db.run.call_args_list[3].kwargs == {"latest": datetime(1990, 1, 1)}
+        assert schedule["Fruits"]["interval"] == 600
@@ -0,0 +1,316 @@
+import pytest
+import boto3
+from moto import mock_aws
+from unittest.mock import patch, MagicMock
+import os
+import logging
+import pyarrow as pa
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_catalog_cache():
+    extract_database._catalog.clear()
+    yield
+    extract_database._catalog.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_runtime_context():
+    context.reset()
+    yield
+    context.reset()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def s3_mock_bucket(s3_client):
+    bucket = s3_client.create_bucket(
+        Bucket="extract_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return bucket
+
+
+import src.extract_database as extract_database  # noqa: E402
+from src.runtime_context import context  # noqa: E402
+from src.extract_storage import (  # noqa: E402
+    S3MultipartWriter,
+    extract_bucket,
+    list_existing_s3_files,
+    read_watermarks,
+    stream_table_to_s3,
+    write_watermark,
+)
+from src.extract_lambda import (  # noqa: E402
+    process_and_upload_tables,
+)
+from datetime import datetime
+
+
+FRUITS_CATALOG = [
+    ["Fruits", "fruit_id", "integer", True],
+    ["Fruits", "Food_type", "text", False],
+    ["Fruits", "last_updated", "timestamp without time zone", False],
+]
+
+
+class TestExtractBucket:
+    def test_extract_bucket_returns_bucket_name(self, s3_client, s3_mock_bucket):
+        result = extract_bucket(s3_client)
+        assert result == "extract_bucket"
+
+    def test_bucket_returns_first_bucket(self, s3_client):
+        # Redefine what the test does
+        # Create two buckets and check that only extract_bucket is returned
+
+        s3_client.create_bucket(
+            Bucket="extract_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.create_bucket(
+            Bucket="bucket1",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        result = extract_bucket(s3_client)
+        assert result == "extract_bucket"
+
+    def test_raises_value_error_if_no_buckets(self, s3_client):
+        with pytest.raises(ValueError, match="No extract_bucket found"):
+            extract_bucket(s3_client)
+
+
+class TestListExistingS3Files:
+    def test_error_if_no_bucket(self, s3_client, caplog):
+        logger = logging.getLogger()
+        logger.info("Testing now.")
+        caplog.set_level(logging.ERROR)
+
+        # Mock the extract_bucket function to raise a ValueError!
+        with patch(
+            "src.extract_storage.extract_bucket",
+            side_effect=ValueError("No extract_bucket found"),
+        ):
+            with pytest.raises(ValueError, match="No extract_bucket found"):
+                list_existing_s3_files(client=s3_client)
+
+        assert "Error listing S3 objects" in caplog.text
+
+    def test_error_if_bucket_is_empty(self, s3_client, caplog, s3_mock_bucket):
+        list_existing_s3_files("extract_bucket", client=s3_client)
+        assert "The bucket is empty" in caplog.text
+
+    def test_lists_keys_without_reading_content(self, s3_client, s3_mock_bucket):
+        s3_client.upload_file("tests/dummy.txt", "extract_bucket", "dummy.txt")
+        with patch.object(s3_client, "get_object") as mock_get_object:
+            result = list_existing_s3_files("extract_bucket", client=s3_client)
+        assert list(result.keys()) == ["dummy.txt"]
+        mock_get_object.assert_not_called()
+
+
+class TestWatermarks:
+    def test_write_then_read_watermark(self, s3_client, s3_mock_bucket):
+        write_watermark(
+            "Fruits",
+            (datetime(2024, 8, 15, 16, 46, 30, 123000), 7),
+            "extract_bucket",
+            s3_client,
+        )
+        result = read_watermarks("extract_bucket", client=s3_client)
+        assert result == {"Fruits": (datetime(2024, 8, 15, 16, 46, 30, 123000), 7)}
+
+    def test_bootstraps_from_object_keys(self, s3_client, s3_mock_bucket):
+        s3_client.upload_file(
+            "tests/dummy_identical.csv",
+            "extract_bucket",
+            "Fruits/2024/08/15/Fruits_16:46:30.csv",
+        )
+        s3_client.upload_file(
+            "tests/dummy_identical.csv",
+            "extract_bucket",
+            "Fruits/2024/08/16/Fruits_09:00:00.csv",
+        )
+        s3_client.upload_file(
+            "tests/dummy_2.csv", "extract_bucket", "Cars/2024/08/14/Cars_10:00:00.csv"
+        )
+        result = read_watermarks("extract_bucket", client=s3_client)
+        assert result == {
+            "Fruits": (datetime(2024, 8, 16, 9, 0, 0), None),
+            "Cars": (datetime(2024, 8, 14, 10, 0, 0), None),
+        }
+
+    def test_bootstraps_from_part_and_typed_keys(self, s3_client, s3_mock_bucket):
+        s3_client.put_object(
+            Bucket="extract_bucket",
+            Key="Fruits/2024/08/16/Fruits_09:00:00_part0002.parquet",
+            Body=b"",
+        )
+        result = read_watermarks("extract_bucket", client=s3_client)
+        assert result == {"Fruits": (datetime(2024, 8, 16, 9, 0, 0), None)}
+
+    def test_manifest_takes_precedence_over_object_keys(
+        self, s3_client, s3_mock_bucket
+    ):
+        s3_client.upload_file(
+            "tests/dummy_identical.csv",
+            "extract_bucket",
+            "Fruits/2024/08/15/Fruits_16:46:30.csv",
+        )
+        write_watermark(
+            "Fruits", (datetime(2022, 11, 3), 2), "extract_bucket", s3_client
+        )
+        result = read_watermarks("extract_bucket", client=s3_client)
+        assert result == {"Fruits": (datetime(2022, 11, 3), 2)}
+
+
+class TestS3MultipartWriter:
+    def test_small_content_uses_single_put(self, s3_client, s3_mock_bucket):
+        with patch.object(s3_client, "create_multipart_upload") as mock_create:
+            with S3MultipartWriter(s3_client, "extract_bucket", "small.csv") as writer:
+                writer.write(b"a,b\n")
+                writer.write(b"1,2\n")
+        mock_create.assert_not_called()
+        body = s3_client.get_object(Bucket="extract_bucket", Key="small.csv")["Body"]
+        assert body.read() == b"a,b\n1,2\n"
+
+    def test_large_content_uploaded_in_parts(self, s3_client, s3_mock_bucket):
+        part_size = 5 * 1024 * 1024
+        with S3MultipartWriter(
+            s3_client, "extract_bucket", "large.csv", part_size=part_size
+        ) as writer:
+            for _ in range(6):
+                writer.write(b"x" * 1024 * 1024)
+        assert len(writer._parts) == 2
+        assert writer.bytes_written == 6 * 1024 * 1024
+        head = s3_client.head_object(Bucket="extract_bucket", Key="large.csv")
+        assert head["ContentLength"] == 6 * 1024 * 1024
+
+    def test_aborts_upload_on_error(self, s3_client, s3_mock_bucket):
+        part_size = 5 * 1024 * 1024
+        with pytest.raises(RuntimeError):
+            with S3MultipartWriter(
+                s3_client, "extract_bucket", "failed.csv", part_size=part_size
+            ) as writer:
+                writer.write(b"x" * part_size)
+                raise RuntimeError("COPY failed")
+        uploads = s3_client.list_multipart_uploads(Bucket="extract_bucket")
+        assert not uploads.get("Uploads")
+        assert "Contents" not in s3_client.list_objects_v2(Bucket="extract_bucket")
+
+
+class TestStreamTableToS3:
+    def test_streams_copy_output_and_returns_watermark(
+        self, s3_client, s3_mock_bucket
+    ):
+        def run(query, stream=None, **params):
+            if stream is None:
+                return [[datetime(2024, 1, 2), 9]]
+            stream.write(b"fruit_id,last_updated\n")
+            stream.write(b"9,2024-01-02 00:00:00\n")
+
+        mock_db = MagicMock()
+        mock_db.run.side_effect = run
+        result = stream_table_to_s3(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2024, 1, 1), 3),
+            "Fruits/stream.csv",
+            "extract_bucket",
+            s3_client,
+        )
+
+        assert result == (datetime(2024, 1, 2), 9)
+        copy_query = mock_db.run.call_args_list[1].args[0]
+        assert "COPY (" in copy_query
+        assert "> ('2024-01-01T00:00:00', 3)" in copy_query
+        assert "<= ('2024-01-02T00:00:00', 9)" in copy_query
+        body = s3_client.get_object(Bucket="extract_bucket", Key="Fruits/stream.csv")
+        assert body["Body"].read() == b"fruit_id,last_updated\n9,2024-01-02 00:00:00\n"
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst")])
+    def test_compresses_copy_output_from_key_suffix(
+        self, s3_client, s3_mock_bucket, compression, suffix
+    ):
+        def run(query, stream=None, **params):
+            if stream is None:
+                return [[datetime(2024, 1, 2), 9]]
+            stream.write(b"fruit_id,last_updated\n")
+            stream.write(b"9,2024-01-02 00:00:00\n")
+
+        mock_db = MagicMock()
+        mock_db.run.side_effect = run
+        stream_table_to_s3(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2024, 1, 1), 3),
+            f"Fruits/stream.csv{suffix}",
+            "extract_bucket",
+            s3_client,
+        )
+
+        body = s3_client.get_object(
+            Bucket="extract_bucket", Key=f"Fruits/stream.csv{suffix}"
+        )
+        assert body["ContentEncoding"] == compression
+        data = pa.CompressedInputStream(pa.BufferReader(body["Body"].read()), compression)
+        assert data.read() == b"fruit_id,last_updated\n9,2024-01-02 00:00:00\n"
+
+    def test_returns_none_without_new_rows(self, s3_client, s3_mock_bucket):
+        mock_db = MagicMock()
+        mock_db.run.return_value = []
+        result = stream_table_to_s3(
+            mock_db,
+            "Fruits",
+            "fruit_id",
+            (datetime(2024, 1, 1), 3),
+            "Fruits/stream.csv",
+            "extract_bucket",
+            s3_client,
+        )
+        assert result is None
+        assert mock_db.run.call_count == 1
+
+    def test_process_and_upload_tables_in_streaming_mode(
+        self, s3_client, s3_mock_bucket
+    ):
+        mock_db = MagicMock()
+        mock_db.run.side_effect = [
+            [],
+            FRUITS_CATALOG,
+            [["Fruits", datetime(2024, 1, 2)]],
+            [],
+        ]
+        with patch(
+            "src.extract_lambda.stream_table_to_s3",
+            return_value=(datetime(2024, 1, 2), 9),
+        ) as mock_stream:
+            result = process_and_upload_tables(
+                mock_db, {}, client=s3_client, stream=True
+            )
+        assert result["updated"] == ["Fruits"]
+        assert result["no change"] == []
+        mock_stream.assert_called_once()
+        assert read_watermarks("extract_bucket", client=s3_client) == {
+            "Fruits": (datetime(2024, 1, 2), 9)
+        }
@@ -0,0 +1,83 @@
+import threading
+from unittest.mock import MagicMock
+import pytest
+from src.transform_lambda.graph import TransformGraph
+
+
+class TestTransformGraph:
+    def test_builds_shared_nodes_once(self):
+        build_fact = MagicMock(return_value="fact")
+        build_date = MagicMock(return_value="date")
+        graph = TransformGraph(
+            {
+                "fact_sales_order": (build_fact, ["sales_order"]),
+                "dim_date": (build_date, ["fact_sales_order"]),
+            }
+        )
+
+        results, timings = graph.run(
+            {"sales_order": "rows"}, ["fact_sales_order", "dim_date"]
+        )
+
+        assert results == {"fact_sales_order": "fact", "dim_date": "date"}
+        build_fact.assert_called_once()
+        assert dict(build_date.call_args.args[0]) == {"fact_sales_order": "fact"}
+        assert set(timings) == {"fact_sales_order", "dim_date"}
+
+    def test_nodes_receive_read_only_inputs(self):
+        def build(inputs):
+            inputs["extra"] = 1
+
+        graph = TransformGraph({"dim_design": (build, ["design"])})
+
+        with pytest.raises(TypeError):
+            graph.run({"design": "rows"}, ["dim_design"])
+
+    def test_skips_nodes_without_available_inputs(self):
+        build_fact = MagicMock(return_value="fact")
+        build_date = MagicMock(return_value="date")
+        graph = TransformGraph(
+            {
+                "fact_payment": (build_fact, ["payment"]),
+                "dim_date": (build_date, ["fact_payment"]),
+            }
+        )
+
+        results, timings = graph.run({}, ["dim_date"])
+
+        assert results == {}
+        assert timings == {}
+        build_fact.assert_not_called()
+        build_date.assert_not_called()
+
+    def test_runs_independent_nodes_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def build(inputs):
+            barrier.wait()
+            return "built"
+
+        graph = TransformGraph(
+            {"dim_design": (build, ["design"]), "dim_location": (build, ["address"])}
+        )
+
+        results, _ = graph.run(
+            {"design": "rows", "address": "rows"}, ["dim_design", "dim_location"]
+        )
+
+        assert results == {"dim_design": "built", "dim_location": "built"}
+
+    def test_sources_of_follows_other_nodes(self):
+        graph = TransformGraph(
+            {
+                "fact_payment": (None, ["payment"]),
+                "fact_sales_order": (None, ["sales_order"]),
+                "dim_date": (None, ["fact_payment", "fact_sales_order"]),
+            }
+        )
+
+        assert graph.sources_of("dim_date") == {"payment", "sales_order"}
+
+    def test_rejects_cycles(self):
+        with pytest.raises(ValueError):
+            TransformGraph({"a": (None, ["b"]), "b": (None, ["a"])})
@@ -11,7 +11,10 @@ from src.load_lambda import (
     convert_parquet_files_to_dfs,
     get_transform_bucket,
     upload_dfs_to_database,
+    close_current_versions,
+    save_loaded_fingerprints,
 )
+from io import BytesIO
 import tempfile
 import json
 from unittest.mock import MagicMock, patch
@@ -201,6 +204,86 @@ class TestConvertParquetToDfs:
 
             pd.testing.assert_frame_equal(result["test_parquet.parquet"], test_df)
 
+    @staticmethod
+    def test_function_skips_files_already_loaded(mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="fingerprint_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        buffer = BytesIO()
+        pd.DataFrame({"date_id": ["2024-11-01"]}).to_parquet(buffer)
+        for table_name in ("dim_date", "dim_payment_type"):
+            mock_s3_client.put_object(
+                Bucket="fingerprint_bucket",
+                Key=f"{table_name}.parquet",
+                Body=buffer.getvalue(),
+                Metadata={"fingerprint": f"{table_name} v2"},
+            )
+        save_loaded_fingerprints(
+            {
+                "dim_date.parquet": "dim_date v2",
+                "dim_payment_type.parquet": "dim_payment_type v1",
+            },
+            bucket_name="fingerprint_bucket",
+            client=mock_s3_client,
+        )
+        fingerprints, unchanged = {}, []
+
+        result = convert_parquet_files_to_dfs(
+            bucket_name="fingerprint_bucket",
+            client=mock_s3_client,
+            fingerprints=fingerprints,
+            unchanged=unchanged,
+        )
+
+        assert list(result) == ["dim_payment_type.parquet"]
+        assert unchanged == ["dim_date"]
+        assert fingerprints == {
+            "dim_date.parquet": "dim_date v2",
+            "dim_payment_type.parquet": "dim_payment_type v2",
+        }
+
+    @staticmethod
+    def test_function_loads_each_dated_file_once(mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="dated_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        keys = [
+            "fact_payment/2026/10/17/fact_payment_09:00:00.parquet",
+            "fact_payment/2026/10/18/fact_payment_09:00:00.parquet",
+        ]
+        for payment_id, key in enumerate(keys, start=1):
+            buffer = BytesIO()
+            pd.DataFrame({"payment_id": [payment_id]}).to_parquet(buffer)
+            mock_s3_client.put_object(
+                Bucket="dated_bucket",
+                Key=key,
+                Body=buffer.getvalue(),
+                Metadata={"fingerprint": f"payments {payment_id}"},
+            )
+
+        runs = []
+        for _ in range(3):
+            fingerprints, unchanged = {}, []
+            result = convert_parquet_files_to_dfs(
+                bucket_name="dated_bucket",
+                client=mock_s3_client,
+                fingerprints=fingerprints,
+                unchanged=unchanged,
+            )
+            if result:
+                save_loaded_fingerprints(
+                    fingerprints, bucket_name="dated_bucket", client=mock_s3_client
+                )
+            runs.append((list(result), unchanged))
+
+        assert runs == [
+            (keys, []),
+            ([], ["fact_payment"]),
+            ([], ["fact_payment"]),
+        ]
+
 
 class TestUploadDfsToDatabase:
     @pytest.fixture
@@ -229,3 +312,74 @@ class TestUploadDfsToDatabase:
 
             assert "uploaded" in result
             assert "not_uploaded" in result
+
+
+class TestSlowlyChangingDimensionLoad:
+    @staticmethod
+    def test_dated_versions_are_applied_in_order_and_only_once(mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="scd_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        versions = [
+            ("dim_staff/2026/10/17/dim_staff_09:00:00.parquet", "Leeds", "2026-10-17"),
+            ("dim_staff/2026/10/18/dim_staff_09:00:00.parquet", "Manchester", "2026-10-18"),
+        ]
+        for key, location, valid_from in versions:
+            buffer = BytesIO()
+            pd.DataFrame(
+                {
+                    "staff_id": [1],
+                    "location": [location],
+                    "valid_from": [pd.Timestamp(valid_from)],
+                    "valid_to": [pd.NaT],
+                    "is_current": [True],
+                }
+            ).to_parquet(buffer)
+            mock_s3_client.put_object(
+                Bucket="scd_bucket",
+                Key=key,
+                Body=buffer.getvalue(),
+                Metadata={"fingerprint": location},
+            )
+        engine = MagicMock()
+        connection = engine.begin.return_value.__enter__.return_value
+        appended = []
+
+        def to_sql(df, *args, **kwargs):
+            appended.extend(df["location"])
+
+        with patch(
+            "src.load_lambda.runtime.connection", return_value=engine
+        ), patch.object(pd.DataFrame, "to_sql", to_sql):
+            first = upload_dfs_to_database("scd_bucket", mock_s3_client)
+            second = upload_dfs_to_database("scd_bucket", mock_s3_client)
+
+        assert appended == ["Leeds", "Manchester"]
+        assert connection.execute.call_count == 2
+        assert first["uploaded"] == ["dim_staff", "dim_staff"]
+        assert second["uploaded"] == []
+        assert second["unchanged"] == ["dim_staff"]
+
+
+class TestCloseCurrentVersions:
+    @staticmethod
+    def test_closes_previous_versions_and_returns_current_rows():
+        run = pd.Timestamp("2024-11-02 09:00:00")
+        df = pd.DataFrame(
+            {
+                "design_id": [2, 3, 4],
+                "design_name": ["Steel", "Granite", None],
+                "valid_from": [run, run, pd.NaT],
+                "valid_to": [pd.NaT, pd.NaT, run],
+                "is_current": [True, True, False],
+            }
+        )
+        connection = MagicMock()
+
+        result = close_current_versions(connection, "dim_design", df)
+
+        statement, params = connection.execute.call_args.args
+        assert "UPDATE project_team_2.dim_design" in str(statement)
+        assert params == {"closed_at": run.to_pydatetime(), "keys": [2, 3, 4]}
+        assert list(result["design_id"]) == [2, 3]
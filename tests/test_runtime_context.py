@@ -0,0 +1,116 @@
+import json
+import os
+from unittest.mock import MagicMock
+
+import boto3
+import botocore.exceptions
+import pytest
+from moto import mock_aws
+
+from src.runtime_context import RuntimeContext
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function", autouse=True)
+def aws_mocks():
+    with mock_aws():
+        yield
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestClient:
+    def test_client_created_once(self):
+        runtime = RuntimeContext()
+        assert runtime.client("s3") is runtime.client("s3")
+        assert runtime.client("s3") is not runtime.client("secretsmanager")
+
+
+class TestSecret:
+    def test_secret_cached_until_ttl_expires(self):
+        sm_client = boto3.client("secretsmanager", region_name="eu-west-2")
+        sm_client.create_secret(Name="test_secret", SecretString=json.dumps({"a": 1}))
+        clock = FakeClock()
+        runtime = RuntimeContext(secret_ttl=60, clock=clock)
+
+        assert json.loads(runtime.secret("test_secret")) == {"a": 1}
+        sm_client.put_secret_value(
+            SecretId="test_secret", SecretString=json.dumps({"a": 2})
+        )
+        clock.now = 59
+        assert json.loads(runtime.secret("test_secret")) == {"a": 1}
+        clock.now = 61
+        assert json.loads(runtime.secret("test_secret")) == {"a": 2}
+
+    def test_missing_secret_raises_client_error(self):
+        runtime = RuntimeContext()
+        with pytest.raises(botocore.exceptions.ClientError):
+            runtime.secret("no_such_secret")
+
+
+class TestBucket:
+    def test_discovers_and_caches_bucket(self):
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket="extract-bucket-123",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        runtime = RuntimeContext()
+        assert runtime.bucket("extract") == "extract-bucket-123"
+        s3_client.delete_bucket(Bucket="extract-bucket-123")
+        assert runtime.bucket("extract") == "extract-bucket-123"
+
+    def test_returns_none_if_no_bucket(self):
+        runtime = RuntimeContext()
+        assert runtime.bucket("extract") is None
+
+    def test_environment_override_skips_discovery(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_BUCKET", "named-bucket")
+        runtime = RuntimeContext()
+        runtime._clients["s3"] = MagicMock()
+        assert runtime.bucket("extract", "EXTRACT_BUCKET") == "named-bucket"
+        runtime._clients["s3"].list_buckets.assert_not_called()
+
+
+class TestConnection:
+    def test_reuses_healthy_connection(self):
+        db = MagicMock()
+        connect = MagicMock(return_value=db)
+        runtime = RuntimeContext()
+        assert runtime.connection("db", connect) is db
+        assert runtime.connection("db", connect) is db
+        connect.assert_called_once()
+        db.run.assert_called_once_with("SELECT 1;")
+
+    def test_replaces_unhealthy_connection(self):
+        stale, fresh = MagicMock(), MagicMock()
+        stale.run.side_effect = Exception("server closed the connection")
+        connect = MagicMock(side_effect=[stale, fresh])
+        runtime = RuntimeContext()
+        runtime.connection("db", connect)
+        assert runtime.connection("db", connect) is fresh
+        stale.close.assert_called_once()
+
+    def test_discard_and_reset_close_connections(self):
+        first, second = MagicMock(), MagicMock()
+        runtime = RuntimeContext()
+        runtime.connection("first", lambda: first)
+        runtime.connection("second", lambda: second)
+        runtime.discard_connection("first")
+        first.close.assert_called_once()
+        runtime.reset()
+        second.close.assert_called_once()
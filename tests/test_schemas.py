@@ -0,0 +1,40 @@
+import pyarrow as pa
+from src.transform_lambda.schemas import TABLE_SCHEMAS, CATEGORY, apply_schema, column_types
+
+
+class TestColumnTypes:
+    def test_returns_registered_types(self):
+        result = column_types("transaction")
+
+        assert result["transaction_id"] == pa.int32()
+        assert result["transaction_type"] == CATEGORY
+        assert result["created_at"] == pa.timestamp("us")
+
+    def test_delete_prefixes_use_their_table_schema(self):
+        assert column_types("_deletes/staff") == TABLE_SCHEMAS["staff"]
+
+    def test_returns_none_for_unregistered_tables(self):
+        assert column_types("Foods") is None
+
+
+class TestApplySchema:
+    def test_casts_typed_extract_columns(self):
+        table = pa.table(
+            {
+                "payment_id": pa.array([1, 2], pa.int64()),
+                "payment_date": pa.array(["2022-11-03", None], pa.string()),
+                "not_registered": pa.array(["a", "b"]),
+            }
+        )
+
+        result = apply_schema("payment", table)
+
+        assert result.schema.field("payment_id").type == pa.int32()
+        assert result.schema.field("payment_date").type == pa.date32()
+        assert result.schema.field("not_registered").type == pa.string()
+        assert result.column("payment_date").null_count == 1
+
+    def test_leaves_unregistered_tables_unchanged(self):
+        table = pa.table({"id": pa.array([1], pa.int64())})
+
+        assert apply_schema("Foods", table) is table
@@ -1,15 +1,21 @@
 from datetime import datetime
 import logging
 import io
+import gzip
 import os
 import numpy as np
 from unittest.mock import patch, MagicMock
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from moto import mock_aws
 from botocore.exceptions import ClientError
 import pytest
-from src.transform_lambda.transform_lambda import read_from_s3_subfolder_to_df, list_existing_s3_files, bucket_name, process_to_parquet_and_upload_to_s3, lambda_handler
+from src.transform_lambda.transform_lambda import read_from_s3_subfolder_to_df, list_existing_s3_files, bucket_name, process_to_parquet_and_upload_to_s3, lambda_handler, list_table_keys, ProcessedInputLedger, compact_latest, merge_table_state, merge_dimension_state, build_outputs, read_table_state, write_table_state, read_currency_names, refresh_currency_names, version_dimensions, content_fingerprint, drop_emitted_dates
+from src.transform_lambda.scd import row_hashes, scd_versions
+from src.transform_lambda.dataframes import create_dim_date
+from src.transform_lambda.graph import TransformGraph
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -139,6 +145,122 @@ class TestReadFromS3:
         assert list(result.keys()) == tables
         assert result["Foods"].eq(expected_foods_df, axis="columns").all(axis=None)
 
+    def test_reads_typed_parquet_and_arrow_extracts(
+        self, s3_client, mock_extract_bucket
+    ):
+        table = pa.table(
+            {
+                "box_id": pa.array([1, None], type=pa.int32()),
+                "last_updated": pa.array(
+                    [datetime(2024, 1, 1), datetime(2024, 1, 2)],
+                    type=pa.timestamp("us"),
+                ),
+            }
+        )
+        parquet_body = io.BytesIO()
+        pq.write_table(table, parquet_body)
+        arrow_body = io.BytesIO()
+        with pa.ipc.new_file(arrow_body, table.schema) as writer:
+            writer.write_table(table)
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Boxes/2024/08/21/Boxes_12:03:10.parquet",
+            Body=parquet_body.getvalue(),
+        )
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Boxes/2024/08/21/Boxes_12:23:10.arrow",
+            Body=arrow_body.getvalue(),
+        )
+
+        result = read_from_s3_subfolder_to_df(
+            ["Boxes"], bucket="dummy_extract_buc", client=s3_client
+        )
+
+        assert str(result["Boxes"]["box_id"].dtype) == "Int32"
+        assert result["Boxes"]["box_id"].isna().sum() == 2
+        assert pd.api.types.is_datetime64_any_dtype(result["Boxes"]["last_updated"])
+        assert len(result["Boxes"]) == 4
+
+    def test_reads_compressed_csv_extracts(self, s3_client, mock_extract_bucket):
+        csv_body = b"box_id,is_open\n1,t\n2,f\n"
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Crates/2024/08/21/Crates_12:03:10.csv.gz",
+            Body=gzip.compress(csv_body),
+            ContentEncoding="gzip",
+        )
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Crates/2024/08/21/Crates_12:23:10.csv.zst",
+            Body=pa.compress(csv_body, codec="zstd", asbytes=True),
+            ContentEncoding="zstd",
+        )
+
+        result = read_from_s3_subfolder_to_df(
+            ["Crates"], bucket="dummy_extract_buc", client=s3_client
+        )
+
+        assert list(result["Crates"]["box_id"]) == [1, 2, 1, 2]
+        assert list(result["Crates"]["is_open"]) == [True, False, True, False]
+
+
+    def test_reports_objects_bytes_and_seconds_per_table(self, s3_client, mock_extract_bucket):
+        bodies = [b"pot_id,size\n1,small\n", b"pot_id,size\n2,large\n3,medium\n"]
+        for i, body in enumerate(bodies):
+            s3_client.put_object(
+                Bucket="dummy_extract_buc",
+                Key=f"Pots/2024/08/21/Pots_12:0{i}:10.csv",
+                Body=body,
+            )
+        stats = {}
+
+        result = read_from_s3_subfolder_to_df(
+            ["Pots"], bucket="dummy_extract_buc", client=s3_client, stats=stats
+        )
+
+        assert list(result["Pots"]["pot_id"]) == [1, 2, 3]
+        assert stats["Pots"]["objects"] == 2
+        assert stats["Pots"]["bytes"] == sum(len(body) for body in bodies)
+        assert stats["Pots"]["seconds"] >= 0
+
+    def test_applies_schema_registry_to_csv_extracts(self, s3_client, mock_extract_bucket):
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="transaction/2024/08/21/transaction_12:03:10.csv",
+            Body=(
+                "transaction_id,transaction_type,sales_order_id,purchase_order_id,"
+                "created_at,last_updated\n"
+                "1,PURCHASE,,2,2022-11-03 14:20:52.186,2022-11-03 14:20:52.186\n"
+                "2,SALE,3,,2022-11-03 14:20:52.187,2022-11-03 14:20:52.187\n"
+            ),
+        )
+
+        result = read_from_s3_subfolder_to_df(
+            ["transaction"], bucket="dummy_extract_buc", client=s3_client
+        )["transaction"]
+
+        assert str(result["transaction_id"].dtype) == "Int32"
+        assert str(result["sales_order_id"].dtype) == "Int32"
+        assert result["sales_order_id"].isna().tolist() == [True, False]
+        assert str(result["transaction_type"].dtype) == "category"
+        assert str(result["created_at"].dtype) == "datetime64[us]"
+
+    def test_list_table_keys_follows_pagination(self):
+        client = MagicMock()
+        client.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [{"Key": f"Jars/{i}.csv"} for i in range(1000)]},
+            {"Contents": [{"Key": "Jars/1000.csv"}]},
+            {},
+        ]
+
+        keys = list_table_keys("Jars/", "dummy_extract_buc", client)
+
+        assert len(keys) == 1001
+        client.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket="dummy_extract_buc", Prefix="Jars/"
+        )
+
 
 class TestListExistingFiles:
     def test_functions_receives_error_if_no_bucket(self, s3_client, caplog):
@@ -192,7 +314,7 @@ class TestBucketName:
 
 
 class TestProcessToParquetUploadS3:
-    def test_func_doesnt_upload_if_file_exists(self, mock_transform_bucket, s3_client):
+    def test_func_doesnt_upload_if_fingerprint_matches(self, mock_transform_bucket, s3_client):
         expected_cars_df = pd.DataFrame(
             np.array(
                 [
@@ -204,16 +326,65 @@ class TestProcessToParquetUploadS3:
             columns=["Car_type", "Brand", "Colour"],
         )
         mock_dim_dict = {"car_data": expected_cars_df}
+        process_to_parquet_and_upload_to_s3(
+            [], mock_dim_dict, {}, "dummy_transform_buc", s3_client
+        )
+        existing = list_existing_s3_files("dummy_transform_buc", client=s3_client)
 
         response = process_to_parquet_and_upload_to_s3(
-            ['car_data'], mock_dim_dict, {}, "dummy_transform_buc", s3_client
+            existing, mock_dim_dict, {}, "dummy_transform_buc", s3_client
         )
 
-        object_list = s3_client.list_objects_v2(Bucket='dummy_transform_buc')
-        s3_uploaded_files = [obj['Key'] for obj in object_list.get('Contents', [])]
-        assert 'car_data.parquet' not in s3_uploaded_files
+        head = s3_client.head_object(Bucket='dummy_transform_buc', Key='car_data.parquet')
+        assert head["Metadata"]["fingerprint"] == content_fingerprint(expected_cars_df)
         assert response == {"uploaded": [], "not_uploaded": ['car_data']}
 
+    def test_func_uploads_changed_content(self, mock_transform_bucket, s3_client):
+        changed_cars_df = pd.DataFrame(
+            {"Car_type": ["Truck"], "Brand": ["Ford"], "Colour": ["Grey"]}
+        )
+        existing = list_existing_s3_files("dummy_transform_buc", client=s3_client)
+
+        response = process_to_parquet_and_upload_to_s3(
+            existing, {"car_data": changed_cars_df}, {}, "dummy_transform_buc", s3_client
+        )
+
+        assert response == {"uploaded": ['car_data'], "not_uploaded": []}
+
+    def test_func_skips_mutable_matching_latest_upload(self, mock_transform_bucket, s3_client):
+        fish_df = pd.DataFrame({"Fish": ["Cod", "Hake"]})
+        s3_client.put_object(
+            Bucket="dummy_transform_buc",
+            Key="fish_data/2024/11/01/fish_data_09:00:00.parquet",
+            Body=b"",
+            Metadata={"fingerprint": content_fingerprint(fish_df)},
+        )
+        s3_client.put_object(
+            Bucket="dummy_transform_buc",
+            Key="fish_data/2024/11/02/fish_data_09:00:00.parquet",
+            Body=b"",
+            Metadata={"fingerprint": "older content"},
+        )
+        existing = list_existing_s3_files("dummy_transform_buc", client=s3_client)
+
+        response = process_to_parquet_and_upload_to_s3(
+            existing, {}, {"fish_data": fish_df}, "dummy_transform_buc", s3_client
+        )
+
+        assert response == {"uploaded": ['fish_data'], "not_uploaded": []}
+
+    def test_fingerprint_is_the_same_from_either_engine(self):
+        df = pd.DataFrame({"staff_id": pd.array([1, None], "Int32"), "name": ["a", None]})
+        table = pa.table(
+            {
+                "staff_id": pa.array([1, None], pa.int32()),
+                "name": pa.array(["a", None]).dictionary_encode(),
+            }
+        )
+
+        assert content_fingerprint(df) == content_fingerprint(table)
+        assert content_fingerprint(df) != content_fingerprint(df.rename(columns={"name": "n"}))
+
     def test_func_uploads_data_if_doesnt_exist(self, mock_transform_bucket, s3_client):
         expected_flower_df = pd.DataFrame(
             np.array(
@@ -263,12 +434,12 @@ class TestProcessToParquetUploadS3:
         mock_fact_dict = {"meat_data": expected_meat_df}
 
         ##mocked an existing file 
-        expected_vegetable_df.to_parquet("vegetable_data.parquet", engine="pyarrow")
-        s3_client.upload_file("vegetable_data.parquet", 'dummy_transform_buc', "vegetable_data.parquet")
+        process_to_parquet_and_upload_to_s3(
+            [], mock_dim_dict, {}, "dummy_transform_buc", s3_client
+        )
 
-    
         response = process_to_parquet_and_upload_to_s3(
-            ['vegetable_data'], mock_dim_dict, mock_fact_dict, "dummy_transform_buc", s3_client
+            ['vegetable_data.parquet'], mock_dim_dict, mock_fact_dict, "dummy_transform_buc", s3_client
         )
         object_list = s3_client.list_objects_v2(Bucket='dummy_transform_buc')
         s3_uploaded_files = [obj['Key'] for obj in object_list.get('Contents', [])]
@@ -285,6 +456,384 @@ class TestProcessToParquetUploadS3:
 
         assert response == {"uploaded": [], "not_uploaded": []}
 
+class TestProcessedInputLedger:
+    def test_only_reads_objects_it_has_not_seen(self, s3_client, mock_extract_bucket, mock_transform_bucket):
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Plums/2024/08/21/Plums_12:03:10.csv",
+            Body="plum_id,name\n1,Victoria\n",
+        )
+        ledger = ProcessedInputLedger()
+        first = read_from_s3_subfolder_to_df(
+            ["Plums"], bucket="dummy_extract_buc", client=s3_client, ledger=ledger
+        )
+        ledger.save("dummy_transform_buc", s3_client)
+
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Plums/2024/08/21/Plums_12:23:10.csv",
+            Body="plum_id,name\n2,Opal\n",
+        )
+        ledger = ProcessedInputLedger.load("dummy_transform_buc", s3_client)
+        second = read_from_s3_subfolder_to_df(
+            ["Plums"], bucket="dummy_extract_buc", client=s3_client, ledger=ledger
+        )
+        ledger.save("dummy_transform_buc", s3_client)
+        ledger = ProcessedInputLedger.load("dummy_transform_buc", s3_client)
+        third = read_from_s3_subfolder_to_df(
+            ["Plums"], bucket="dummy_extract_buc", client=s3_client, ledger=ledger
+        )
+
+        assert list(first["Plums"]["name"]) == ["Victoria"]
+        assert list(second["Plums"]["name"]) == ["Opal"]
+        assert third == {}
+
+    def test_does_not_match_tables_sharing_a_prefix(self, s3_client, mock_extract_bucket):
+        s3_client.put_object(
+            Bucket="dummy_extract_buc",
+            Key="Pear_type/2024/08/21/Pear_type_12:03:10.csv",
+            Body="pear_type_id\n1\n",
+        )
+
+        result = read_from_s3_subfolder_to_df(
+            ["Pear"], bucket="dummy_extract_buc", client=s3_client,
+            ledger=ProcessedInputLedger(),
+        )
+
+        assert result == {}
+
+    def test_prunes_old_entries_into_start_after(self, s3_client, mock_transform_bucket):
+        ledger = ProcessedInputLedger(
+            {
+                "Figs/": {
+                    "start_after": "",
+                    "objects": {
+                        "Figs/2024/08/01/Figs_12:00:00.csv": ['"a"', "2024-08-01T12:00:00+00:00"],
+                        "Figs/2024/08/02/Figs_12:00:00.csv": ['"b"', "2024-08-02T12:00:00+00:00"],
+                        "Figs/2099/01/01/Figs_12:00:00.csv": ['"c"', "2099-01-01T12:00:00+00:00"],
+                    },
+                }
+            }
+        )
+
+        ledger.save("dummy_transform_buc", s3_client)
+
+        entry = ledger.prefixes["Figs/"]
+        assert entry["start_after"] == "Figs/2024/08/02/Figs_12:00:00.csv"
+        assert list(entry["objects"]) == ["Figs/2099/01/01/Figs_12:00:00.csv"]
+
+
+class TestDimensionState:
+    def test_merge_keeps_latest_row_and_drops_deleted_keys(self):
+        state = pa.table({"design_id": [1, 2, 3], "design_name": ["a", "b", "c"]})
+        delta = pa.table({"design_id": [2, 4, 2], "design_name": ["B", "d", "BB"]})
+        deletes = pa.table(
+            {"design_id": pa.array([3], pa.int32()), "deleted_at": ["2024-08-21"]}
+        )
+
+        result = merge_table_state(state, delta, deletes, "design_id")
+
+        assert result.column("design_id").to_pylist() == [1, 4, 2]
+        assert result.column("design_name").to_pylist() == ["a", "d", "BB"]
+
+    def test_compact_latest_keeps_the_last_updated_version(self):
+        days = [5, 1, 3, 2, 4]
+        table = pa.table(
+            {
+                "staff_id": [1, 2, 1, 3, 2, 1],
+                "last_updated": pa.array(
+                    [datetime(2024, 8, day) for day in days] + [None],
+                    pa.timestamp("us"),
+                ),
+                "first_name": ["new", "old", "older", "only", "newer", "undated"],
+            }
+        )
+
+        result = compact_latest(table, "staff_id")
+
+        assert result.column("staff_id").to_pylist() == [1, 3, 2]
+        assert result.column("first_name").to_pylist() == ["new", "only", "newer"]
+
+    def test_compact_latest_prefers_the_later_row_on_a_tie(self):
+        table = pa.table(
+            {
+                "design_id": [8, 8],
+                "last_updated": pa.array(
+                    [datetime(2024, 8, 1)] * 2, pa.timestamp("us")
+                ),
+                "design_name": ["Wooden", "Oak"],
+            }
+        )
+
+        result = compact_latest(table, "design_id")
+
+        assert result.column("design_name").to_pylist() == ["Oak"]
+
+    def test_fact_sources_are_compacted(self, s3_client, mock_transform_bucket):
+        inputs = {
+            "sales_order": pa.table(
+                {
+                    "sales_order_id": [7, 7],
+                    "last_updated": pa.array(
+                        [datetime(2024, 8, 2), datetime(2024, 8, 1)],
+                        pa.timestamp("us"),
+                    ),
+                    "units_sold": [10, 5],
+                }
+            )
+        }
+
+        dict_of_df, _, _ = merge_dimension_state(
+            inputs, "dummy_transform_buc", s3_client
+        )
+
+        assert dict_of_df["sales_order"].column("units_sold").to_pylist() == [10]
+
+    def test_state_round_trips_through_s3(self, s3_client, mock_transform_bucket):
+        table = pa.table({"design_id": [1, 2], "design_name": ["a", "b"]})
+
+        assert read_table_state("design", "dummy_transform_buc", s3_client) is None
+        write_table_state("design", table, "dummy_transform_buc", s3_client)
+        result = read_table_state("design", "dummy_transform_buc", s3_client)
+
+        assert result.equals(table)
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(Bucket="dummy_transform_buc")["Contents"]
+        ]
+        assert keys == ["_state/tables/design.arrow"]
+
+    def test_reads_state_saved_as_parquet(self, s3_client, mock_transform_bucket):
+        table = pa.table({"design_id": [1, 2], "design_name": ["a", "b"]})
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer)
+        s3_client.put_object(
+            Bucket="dummy_transform_buc",
+            Key="_state/tables/design.parquet",
+            Body=buffer.getvalue(),
+        )
+
+        result = read_table_state("design", "dummy_transform_buc", s3_client)
+
+        assert result.equals(table)
+
+    def test_unchanged_dimensions_come_from_cached_state(self, s3_client, mock_transform_bucket):
+        cached = pa.table({"currency_id": [1], "currency_code": ["GBP"]})
+        write_table_state("currency", cached, "dummy_transform_buc", s3_client)
+        inputs = {"sales_order": pa.table({"sales_order_id": [7]})}
+
+        dict_of_df, changed, states = merge_dimension_state(
+            inputs, "dummy_transform_buc", s3_client
+        )
+
+        assert changed == {"sales_order"}
+        assert states == {}
+        assert dict_of_df["currency"].column("currency_code").to_pylist() == ["GBP"]
+
+    def test_only_builds_outputs_with_changed_sources(self):
+        build_design = MagicMock(return_value="dim_design")
+        build_staff = MagicMock(return_value="dim_staff")
+        graph = TransformGraph(
+            {
+                "dim_design": (build_design, ["design"]),
+                "dim_staff": (build_staff, ["staff", "department"]),
+            }
+        )
+        dict_of_df = {"design": pd.DataFrame(), "department": pd.DataFrame()}
+
+        result = build_outputs(graph, dict_of_df, {"design", "department"})
+
+        assert result == {"dim_design": "dim_design"}
+        build_staff.assert_not_called()
+
+
+class TestSlowlyChangingDimensions:
+    FIRST_RUN = datetime(2024, 11, 1, 9)
+    SECOND_RUN = datetime(2024, 11, 2, 9)
+
+    @staticmethod
+    def design(names):
+        return pa.table(
+            {
+                "design_id": pa.array(range(1, len(names) + 1), pa.int32()),
+                "design_name": names,
+            }
+        )
+
+    def test_first_run_emits_every_row_as_current(self):
+        versions, snapshot = scd_versions(
+            self.design(["Wooden", "Bronze"]), "design_id", None, self.FIRST_RUN
+        )
+
+        assert versions.column_names == [
+            "design_id",
+            "design_name",
+            "valid_from",
+            "valid_to",
+            "is_current",
+        ]
+        assert versions.column("is_current").to_pylist() == [True, True]
+        assert versions.column("valid_from").to_pylist() == [self.FIRST_RUN] * 2
+        assert versions.column("valid_to").to_pylist() == [None, None]
+        assert snapshot.column("key").to_pylist() == [1, 2]
+
+    def test_unchanged_rows_emit_nothing(self):
+        _, snapshot = scd_versions(
+            self.design(["Wooden", "Bronze"]), "design_id", None, self.FIRST_RUN
+        )
+
+        versions, unchanged = scd_versions(
+            self.design(["Wooden", "Bronze"]), "design_id", snapshot, self.SECOND_RUN
+        )
+
+        assert versions is None
+        assert unchanged.equals(snapshot)
+
+    def test_emits_only_new_and_changed_rows(self):
+        _, snapshot = scd_versions(
+            self.design(["Wooden", "Bronze"]), "design_id", None, self.FIRST_RUN
+        )
+
+        versions, snapshot = scd_versions(
+            self.design(["Wooden", "Steel", "Granite"]),
+            "design_id",
+            snapshot,
+            self.SECOND_RUN,
+        )
+
+        assert versions.column("design_id").to_pylist() == [2, 3]
+        assert versions.column("design_name").to_pylist() == ["Steel", "Granite"]
+        assert snapshot.column("valid_from").to_pylist() == [
+            self.FIRST_RUN,
+            self.SECOND_RUN,
+            self.SECOND_RUN,
+        ]
+
+    def test_closes_keys_missing_from_the_dimension(self):
+        _, snapshot = scd_versions(
+            self.design(["Wooden", "Bronze"]), "design_id", None, self.FIRST_RUN
+        )
+
+        versions, snapshot = scd_versions(
+            self.design(["Wooden"]), "design_id", snapshot, self.SECOND_RUN
+        )
+
+        assert versions.to_pylist() == [
+            {
+                "design_id": 2,
+                "design_name": None,
+                "valid_from": None,
+                "valid_to": self.SECOND_RUN,
+                "is_current": False,
+            }
+        ]
+        assert snapshot.column("key").to_pylist() == [1]
+
+    def test_row_hashes_match_across_engines(self):
+        arrow_built = pa.table(
+            {
+                "staff_id": pa.array([1, 2], pa.int32()),
+                "location": pa.array(["Leeds", None]).dictionary_encode(),
+            }
+        )
+        pandas_built = pd.DataFrame(
+            {
+                "staff_id": pd.array([1, 2], "Int32"),
+                "location": pd.Categorical(["Leeds", None]),
+            }
+        )
+
+        assert row_hashes(arrow_built, "staff_id").equals(
+            row_hashes(pa.Table.from_pandas(pandas_built), "staff_id")
+        )
+
+    def test_version_dimensions_keeps_snapshots_between_runs(
+        self, s3_client, mock_transform_bucket
+    ):
+        outputs = {
+            "dim_design": self.design(["Wooden"]).to_pandas(),
+            "fact_payment": "fact_payment",
+        }
+
+        snapshots = version_dimensions(
+            outputs, "dummy_transform_buc", s3_client, self.FIRST_RUN
+        )
+        for table, snapshot in snapshots.items():
+            write_table_state(
+                table, snapshot, "dummy_transform_buc", s3_client, folder="scd"
+            )
+        rerun = {"dim_design": self.design(["Wooden"])}
+        version_dimensions(rerun, "dummy_transform_buc", s3_client, self.SECOND_RUN)
+
+        assert outputs["fact_payment"] == "fact_payment"
+        assert outputs["dim_design"].num_rows == 1
+        assert read_table_state(
+            "dim_design", "dummy_transform_buc", s3_client, folder="scd"
+        ).num_rows == 1
+        assert rerun == {}
+
+
+class TestDimDate:
+    @staticmethod
+    def dim_date(days):
+        return create_dim_date(
+            {"fact_payment": pd.DataFrame({"payment_date": [f"2022-11-{day:02d}" for day in days]})}
+        )
+
+    def test_only_dates_not_emitted_before_are_kept(self, s3_client, mock_transform_bucket):
+        outputs = {"dim_date": self.dim_date([3, 4])}
+        emitted = drop_emitted_dates(outputs, "dummy_transform_buc", s3_client)
+        write_table_state("dim_date", emitted, "dummy_transform_buc", s3_client, "emitted")
+
+        rerun = {"dim_date": self.dim_date([4, 7, 8])}
+        emitted = drop_emitted_dates(rerun, "dummy_transform_buc", s3_client)
+
+        assert outputs["dim_date"].num_rows == 2
+        assert [d.day for d in rerun["dim_date"].column("date_id").to_pylist()] == [7, 8]
+        assert emitted.num_rows == 4
+
+    def test_drops_dim_date_when_every_date_was_emitted(self, s3_client, mock_transform_bucket):
+        outputs = {"dim_date": self.dim_date([10])}
+        emitted = drop_emitted_dates(outputs, "dummy_transform_buc", s3_client)
+        write_table_state("dim_date", emitted, "dummy_transform_buc", s3_client, "emitted")
+
+        rerun = {"dim_date": self.dim_date([10])}
+
+        assert drop_emitted_dates(rerun, "dummy_transform_buc", s3_client) is None
+        assert rerun == {}
+
+
+class TestCurrencyNames:
+    def test_reads_cached_names_if_present(self, s3_client, mock_transform_bucket):
+        assert read_currency_names("dummy_transform_buc", s3_client) is None
+
+        s3_client.put_object(
+            Bucket="dummy_transform_buc",
+            Key="_reference/currency_names.csv",
+            Body="currency_code,currency_name\nNAD,Namibia Dollar\n",
+        )
+        result = read_currency_names("dummy_transform_buc", s3_client)
+
+        assert list(result["currency_code"]) == ["NAD"]
+
+    def test_refresh_caches_iso_4217_names(self, s3_client, mock_transform_bucket):
+        xml = b"""<ISO_4217><CcyTbl>
+            <CcyNtry><CtryNm>AUSTRIA</CtryNm><CcyNm>Euro</CcyNm><Ccy>EUR</Ccy></CcyNtry>
+            <CcyNtry><CtryNm>BELGIUM</CtryNm><CcyNm>Euro</CcyNm><Ccy>EUR</Ccy></CcyNtry>
+            <CcyNtry><CtryNm>ANTARCTICA</CtryNm><CcyNm>No universal currency</CcyNm></CcyNtry>
+            <CcyNtry><CtryNm>UNITED KINGDOM</CtryNm><CcyNm>Pound Sterling</CcyNm><Ccy>GBP</Ccy></CcyNtry>
+        </CcyTbl></ISO_4217>"""
+        with patch("src.transform_lambda.transform_lambda.requests.get") as mock_get:
+            mock_get.return_value.content = xml
+
+            count = refresh_currency_names("dummy_transform_buc", s3_client)
+
+        result = read_currency_names("dummy_transform_buc", s3_client)
+        assert count == 2
+        assert list(result["currency_code"]) == ["EUR", "GBP"]
+        assert list(result["currency_name"]) == ["Euro", "Pound Sterling"]
+
+
 class TestLambdaHandler:
     def test_func_reads_from_extract_bucket(self, s3_client, mock_db_connection, mock_extract_bucket, mock_transform_bucket):
         mock_csv = "id,name\n1,Lauryn\n2,Hill"